@@ -0,0 +1,69 @@
+"""
+Share ID allocation as the number of active shares grows.
+
+Allocates IDs into a fresh SQLite metadata store until it holds the
+requested number of active shares, and reports keyspace occupancy,
+collisions (retried candidates) and allocation latency as it fills.
+Run from the repository root:
+
+    python benchmarks/id_allocation.py --shares 1000000 --length 6
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from id_utils import IdAllocator, SHARE_ID_ALPHABET
+from metadata_utils import SQLiteMetadataStore
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """Return the given percentile of samples (0 if empty)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main(args) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        store = SQLiteMetadataStore(os.path.join(directory, "ids.db"))
+        allocator = IdAllocator(store, alphabet=args.alphabet, length=args.length,
+                                token_bytes=args.token_bytes, max_attempts=args.max_attempts)
+        expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+        print(f"keyspace {allocator.keyspace:,} ({len(args.alphabet)} characters x {args.length}"
+              f"{f' + {args.token_bytes}-byte token' if args.token_bytes else ''})")
+        print(f"{'active':>10}  {'occupancy':>9}  {'collisions':>10}  {'p50':>8}  {'p99':>8}  {'max':>8}")
+
+        latencies = []
+        collisions = 0
+        for count in range(1, args.shares + 1):
+            started = time.perf_counter()
+            allocator.allocate(expires_at)
+            latencies.append(time.perf_counter() - started)
+            if count % args.report_every == 0 or count == args.shares:
+                print(
+                    f"{count:>10,}  {count / allocator.keyspace:>9.4%}  "
+                    f"{allocator.collisions - collisions:>10}  "
+                    f"{percentile(latencies, 0.5) * 1e6:>6.0f}us  "
+                    f"{percentile(latencies, 0.99) * 1e6:>6.0f}us  "
+                    f"{max(latencies) * 1e6:>6.0f}us"
+                )
+                latencies = []
+                collisions = allocator.collisions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--shares", type=int, default=1000000)
+    parser.add_argument("--report-every", type=int, default=100000)
+    parser.add_argument("--alphabet", default=SHARE_ID_ALPHABET)
+    parser.add_argument("--length", type=int, default=6)
+    parser.add_argument("--token-bytes", type=int, default=0)
+    parser.add_argument("--max-attempts", type=int, default=8)
+    main(parser.parse_args())
@@ -0,0 +1,114 @@
+"""
+Password verification cost versus concurrency.
+
+Runs bursts of concurrent password checks through PasswordVerifier on
+its own bounded pool and reports throughput, latency and how many
+attempts were turned away. Alongside each burst it keeps encrypting
+64 KiB chunks on the CPU pool, as downloads do, to show how much a
+guessing burst slows them down. Each burst is run twice: with every
+attempt on its own file ID, so only the pool bounds it, and with every
+attempt on the same file ID, as when one share is being guessed, where
+all but PASSWORD_MAX_FAILURES attempts should get a 429 without running
+scrypt. Run from the repository root:
+
+    python benchmarks/password_kdf.py --concurrency 1 4 16 64 --attempts 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from fastapi import HTTPException
+
+import password_utils
+from pool_utils import WorkerPool, cpu_pool
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """Return the given percentile of samples (0 if empty)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def bystander(stop: asyncio.Event, latencies: list) -> None:
+    """Encrypt 64 KiB chunks on the CPU pool until stopped, recording latency."""
+    aesgcm = AESGCM(AESGCM.generate_key(bit_length=256))
+    chunk = os.urandom(64 * 1024)
+    nonce = os.urandom(12)
+    while not stop.is_set():
+        started = time.perf_counter()
+        await cpu_pool.run(aesgcm.encrypt, nonce, chunk, None)
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.005)
+
+
+async def run_burst(record: dict, concurrency: int, attempts: int, workers: int,
+                    queue: int, correct: bool, same_file_id: bool) -> None:
+    # A fresh verifier per burst so failure counts do not carry over
+    verifier = password_utils.PasswordVerifier(WorkerPool(max_workers=workers, max_queue=queue))
+    password = "correct horse" if correct else "wrong guess"
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, rejected, limited = [], 0, 0
+
+    async def attempt(index: int) -> None:
+        nonlocal rejected, limited
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await verifier.verify("000000" if same_file_id else f"{index:06d}", password, record)
+            except HTTPException as e:
+                if e.status_code == 503:
+                    rejected += 1
+                    return
+                if e.status_code == 429:
+                    limited += 1
+                    return
+            latencies.append(time.perf_counter() - started)
+
+    stop = asyncio.Event()
+    bystander_latencies = []
+    bystander_task = asyncio.create_task(bystander(stop, bystander_latencies))
+    started = time.perf_counter()
+    await asyncio.gather(*(attempt(index) for index in range(attempts)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await bystander_task
+
+    print(
+        f"{concurrency:>11}  {len(latencies) / elapsed:>8.1f}/s  "
+        f"p50 {percentile(latencies, 0.5) * 1000:>7.1f} ms  "
+        f"p99 {percentile(latencies, 0.99) * 1000:>7.1f} ms  "
+        f"503s {rejected:>4}  429s {limited:>4}  "
+        f"encrypt p99 {percentile(bystander_latencies, 0.99) * 1000:>6.2f} ms"
+    )
+
+
+async def main(args) -> None:
+    started = time.perf_counter()
+    record = password_utils.protect("correct horse", os.urandom(32))
+    print(f"scrypt n={password_utils.PASSWORD_SCRYPT_N} r={password_utils.PASSWORD_SCRYPT_R} "
+          f"p={password_utils.PASSWORD_SCRYPT_P}: one hash takes {(time.perf_counter() - started) * 1000:.1f} ms")
+    print(f"KDF pool: {args.workers} workers, queue {args.queue}; "
+          f"{'correct' if args.correct else 'wrong'} passwords, {args.attempts} attempts per burst")
+    for same_file_id in (False, True):
+        print("every attempt on the same file ID" if same_file_id else "every attempt on its own file ID")
+        print(f"{'concurrency':>11}  {'checks':>10}")
+        for concurrency in args.concurrency:
+            await run_burst(record, concurrency, args.attempts, args.workers, args.queue, args.correct, same_file_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--attempts", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=password_utils.KDF_WORKERS)
+    parser.add_argument("--queue", type=int, default=password_utils.KDF_QUEUE_DEPTH)
+    parser.add_argument("--correct", action="store_true", help="verify the right password instead of guesses")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,221 @@
+"""
+Concurrent upload/download load test against a local S3 stand-in.
+
+Starts a moto S3 server and a single uvicorn worker pointed at it, then
+drives concurrent uploads and downloads over HTTP. Alongside the load it
+polls the homepage, whose latency shows how long the worker's event loop
+is blocked. A local emulator answers in well under a millisecond, so
+S3 traffic goes through a proxy that adds a fixed one-way delay to
+approximate a real S3 round-trip. Run from the repository root:
+
+    pip install "moto[server]" httpx uvicorn
+    python benchmarks/s3_load.py --requests 300 --concurrency 32 --size 65536
+"""
+import argparse
+import asyncio
+import base64
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def delayed_pipe(reader, writer, delay: float) -> None:
+    """Forward bytes from reader to writer, each one `delay` seconds late."""
+    queue = asyncio.Queue()
+
+    async def forward():
+        while True:
+            due, data = await queue.get()
+            await asyncio.sleep(max(0.0, due - time.monotonic()))
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    forwarder = asyncio.create_task(forward())
+    try:
+        while True:
+            data = await reader.read(65536)
+            queue.put_nowait((time.monotonic() + delay, data))
+            if not data:
+                break
+    except ConnectionError:
+        queue.put_nowait((0.0, b""))
+    await forwarder
+
+
+async def start_latency_proxy(listen_port: int, target_port: int, delay: float):
+    """Start a TCP proxy to the S3 server that delays traffic in both directions."""
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        await asyncio.gather(
+            delayed_pipe(client_reader, server_writer, delay),
+            delayed_pipe(server_reader, client_writer, delay),
+            return_exceptions=True,
+        )
+
+    return await asyncio.start_server(handle, "127.0.0.1", listen_port)
+
+
+def app_environment(s3_port: int) -> dict:
+    """Environment that points the app at the local S3 server."""
+    return {
+        **os.environ,
+        "TESTING": "true",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_REGION": "us-east-1",
+        "S3_BUCKET_NAME": "swiftshare-load-test",
+        "S3_ENDPOINT_URL": f"http://127.0.0.1:{s3_port}",
+        "AWS_ENDPOINT_URL_S3": f"http://127.0.0.1:{s3_port}",
+        "ENCRYPTION_KEY": os.getenv("ENCRYPTION_KEY") or base64.b64encode(os.urandom(32)).decode(),
+    }
+
+
+def wait_for_port(port: int, timeout: float = 30.0) -> None:
+    """Wait until the S3 server accepts connections."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """Return the given percentile of the samples in milliseconds."""
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+
+
+async def run_phase(name: str, total: int, concurrency: int, request, probe) -> list:
+    """
+    Run `total` requests with at most `concurrency` in flight and report
+    throughput, plus the latency of a trivial request issued alongside
+    them, which shows how long the event loop is blocked.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    results = []
+
+    async def one(index: int):
+        async with semaphore:
+            started = time.perf_counter()
+            results.append(await request(index))
+            latencies.append(time.perf_counter() - started)
+
+    probe_latencies = []
+    done = asyncio.Event()
+
+    async def probe_loop():
+        while not done.is_set():
+            started = time.perf_counter()
+            await probe()
+            probe_latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0.01)
+
+    started = time.perf_counter()
+    prober = asyncio.create_task(probe_loop())
+    await asyncio.gather(*(one(i) for i in range(total)))
+    done.set()
+    await prober
+    elapsed = time.perf_counter() - started
+    print(
+        f"{name:>9}: {total / elapsed:8.1f} req/s  "
+        f"p50 {percentile(latencies, 0.5):7.1f} ms  p99 {percentile(latencies, 0.99):7.1f} ms  "
+        f"homepage p99 {percentile(probe_latencies, 0.99):7.1f} ms"
+    )
+    return results
+
+
+async def main(args) -> None:
+    proxy = await start_latency_proxy(args.proxy_port, args.s3_port, args.s3_latency / 2000)
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.app_port),
+         "--workers", "1", "--log-level", "warning"],
+        cwd=ROOT,
+        env=app_environment(args.proxy_port),
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        await asyncio.to_thread(wait_for_port, args.app_port)
+        await run_load(args)
+    finally:
+        app.terminate()
+        await asyncio.to_thread(app.wait)
+        proxy.close()
+
+
+async def run_load(args) -> None:
+    import httpx
+
+    payload = os.urandom(args.size)
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    base_url = f"http://127.0.0.1:{args.app_port}"
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+
+        async def upload(index: int) -> str:
+            response = await client.post(
+                "/upload/",
+                data={"expiration_policy": "store_1_hour"},
+                files=[("files", (f"file-{index}.bin", payload, "application/octet-stream"))],
+            )
+            response.raise_for_status()
+            return response.json()["uploads"][0]["file_id"]
+
+        async def homepage() -> None:
+            (await client.get("/")).raise_for_status()
+
+        file_ids = await run_phase("upload", args.requests, args.concurrency, upload, homepage)
+
+        async def download(index: int) -> None:
+            response = await client.get(f"/download/{file_ids[index]}")
+            response.raise_for_status()
+            assert len(response.content) == args.size
+
+        await run_phase("download", args.requests, args.concurrency, download, homepage)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--s3-port", type=int, default=5055)
+    parser.add_argument("--proxy-port", type=int, default=5056)
+    parser.add_argument("--app-port", type=int, default=5057)
+    parser.add_argument("--s3-latency", type=float, default=20.0,
+                        help="added S3 round-trip time in milliseconds")
+    args = parser.parse_args()
+
+    import boto3
+
+    s3 = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "-p", str(args.s3_port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(args.s3_port)
+        env = app_environment(args.s3_port)
+        boto3.client(
+            "s3",
+            region_name="us-east-1",
+            endpoint_url=env["S3_ENDPOINT_URL"],
+            aws_access_key_id="testing",
+            aws_secret_access_key="testing",
+        ).create_bucket(Bucket=env["S3_BUCKET_NAME"])
+        asyncio.run(main(args))
+    finally:
+        s3.terminate()
+        s3.wait()
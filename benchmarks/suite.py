@@ -0,0 +1,486 @@
+"""
+Reproducible upload/download benchmark suite against a local S3 stand-in.
+
+Starts a moto S3 server and the app (TESTING=true) with the requested
+number of uvicorn workers, then runs a fixed set of workloads, from 1 KB
+text shares to multi-GB binaries and multi-file bundles, each at its own
+concurrency. For every workload it reports upload and download
+throughput, p50/p99 latency, peak RSS per worker and the S3 requests made,
+counted by a proxy in front of the S3 server (so every worker is seen).
+Payloads are generated from a fixed seed, so runs are comparable.
+
+Results can be saved as a baseline; later runs compared against it
+report every workload that got slower, bigger or made more S3 requests
+than the tolerance allows, and exit non-zero. Run from the repository root:
+
+    pip install "moto[server]" httpx uvicorn
+    python benchmarks/suite.py --baseline benchmarks/baselines/local.json
+
+benchmarks/baselines/local.json is a reference run with the default
+options (its config is saved with it) on a single-CPU Linux machine with
+Python 3.11. S3 request counts and peak RSS carry over between machines,
+but throughput and latency do not: to compare those, first record a
+baseline on the machine that runs the comparison:
+
+    python benchmarks/suite.py --save-baseline /tmp/baseline.json
+
+Add --workloads file-2g to include the multi-GB case. Peak RSS is read
+from /proc, so it is only reported on Linux.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from io import RawIOBase
+from typing import Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from s3_load import ROOT, app_environment, percentile, wait_for_port
+
+KiB = 1024
+MiB = 1024 * KiB
+GiB = 1024 * MiB
+
+
+class Workload(NamedTuple):
+    kind: str  # "text", "file" or "bundle"
+    size: int  # bytes per file
+    files: int  # files per share
+    shares: int
+    concurrency: int
+
+
+WORKLOADS = {
+    "text-1k": Workload("text", 1 * KiB, 1, 200, 16),
+    "file-64k": Workload("file", 64 * KiB, 1, 200, 16),
+    "file-8m": Workload("file", 8 * MiB, 1, 40, 8),
+    "file-256m": Workload("file", 256 * MiB, 1, 4, 2),
+    "file-2g": Workload("file", 2 * GiB, 1, 1, 1),
+    "bundle-10x256k": Workload("bundle", 256 * KiB, 10, 40, 8),
+}
+DEFAULT_WORKLOADS = ["text-1k", "file-64k", "file-8m", "bundle-10x256k", "file-256m"]
+
+WORDS = ("share", "file", "upload", "download", "expire", "secure", "link", "text",
+         "bundle", "password", "swift", "object", "bucket", "stream", "chunk", "key")
+
+
+class GeneratedFile(RawIOBase):
+    """
+    Incompressible, seeded pseudo-random file content (an AES-CTR keystream)
+    produced while it is read, so multi-GB uploads need neither memory nor
+    disk. Only rewinding and seeking to the end (for its length) are supported.
+    """
+
+    def __init__(self, size: int, seed: int, index: int):
+        self.size = size
+        self.key = random.Random(seed).randbytes(32)
+        self.nonce = index.to_bytes(16, "big")
+        self.seek(0)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        position = offset if whence == os.SEEK_SET else self.size + offset
+        if position == 0:
+            self.keystream = Cipher(algorithms.AES(self.key), modes.CTR(self.nonce)).encryptor()
+        elif position != self.size:
+            raise OSError("GeneratedFile can only seek to its start or end")
+        self.position = position
+        return position
+
+    def readinto(self, buffer) -> int:
+        count = min(len(buffer), self.size - self.position)
+        buffer[:count] = self.keystream.update(bytes(count))
+        self.position += count
+        return count
+
+
+def generated_text(size: int, seed: int, index: int) -> str:
+    """Seeded, compressible text of exactly `size` characters."""
+    rng = random.Random(seed * 1000003 + index)
+    text = " ".join(rng.choice(WORDS) for _ in range(size // 4 + 1))
+    return text[:size]
+
+
+def s3_operation(method: str, target: str) -> str:
+    """Name the S3 API call an HTTP request line stands for."""
+    path, _, query = target.partition("?")
+    params = parse_qs(query, keep_blank_values=True)
+    has_key = "/" in path.strip("/")
+    if method == "POST":
+        if "delete" in params:
+            return "DeleteObjects"
+        return "CreateMultipartUpload" if "uploads" in params else "CompleteMultipartUpload"
+    if method == "PUT":
+        if "partNumber" in params:
+            return "UploadPart"
+        return "PutObject" if has_key else "CreateBucket"
+    if method == "GET":
+        if "uploadId" in params:
+            return "ListParts"
+        return "GetObject" if has_key else "ListObjects"
+    if method == "HEAD":
+        return "HeadObject" if has_key else "HeadBucket"
+    if method == "DELETE":
+        return "AbortMultipartUpload" if "uploadId" in params else "DeleteObject"
+    return method
+
+
+async def forward_requests(reader, writer, counts: Counter, delay: float) -> None:
+    """Forward HTTP requests to the S3 server, counting each by operation."""
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            lines = head.decode("latin-1").split("\r\n")
+            method, target, _ = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                if line:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+            counts[s3_operation(method, target)] += 1
+            if delay:
+                await asyncio.sleep(delay)
+            writer.write(head)
+
+            if "chunked" in headers.get("transfer-encoding", "").lower():
+                while True:
+                    size_line = await reader.readuntil(b"\r\n")
+                    writer.write(size_line)
+                    size = int(size_line.split(b";")[0], 16)
+                    if size == 0:
+                        # Trailers up to the blank line that ends the body
+                        while True:
+                            line = await reader.readuntil(b"\r\n")
+                            writer.write(line)
+                            if line == b"\r\n":
+                                break
+                        break
+                    writer.write(await reader.readexactly(size + 2))
+                    await writer.drain()
+            else:
+                remaining = int(headers.get("content-length", "0"))
+                while remaining:
+                    data = await reader.read(min(remaining, 256 * KiB))
+                    if not data:
+                        return
+                    writer.write(data)
+                    remaining -= len(data)
+                    await writer.drain()
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def forward_responses(reader, writer) -> None:
+    """Forward S3 responses back to the app unchanged."""
+    try:
+        while data := await reader.read(256 * KiB):
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_counting_proxy(listen_port: int, target_port: int, counts: Counter, delay: float):
+    """Start an HTTP proxy to the S3 server that counts requests per S3 operation."""
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        await asyncio.gather(
+            forward_requests(client_reader, server_writer, counts, delay),
+            forward_responses(server_reader, client_writer),
+            return_exceptions=True,
+        )
+
+    return await asyncio.start_server(handle, "127.0.0.1", listen_port)
+
+
+def worker_pids(app_pid: int, workers: int) -> List[int]:
+    """PIDs of the uvicorn processes that serve requests."""
+    if workers == 1:
+        return [app_pid]
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                command = f.read()
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == app_pid and b"spawn_main" in command:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def wait_for_workers(app_pid: int, workers: int, timeout: float = 30.0) -> List[int]:
+    """Wait until every worker has been spawned; the port is bound before they are."""
+    deadline = time.monotonic() + timeout
+    while True:
+        pids = worker_pids(app_pid, workers)
+        if len(pids) >= workers or time.monotonic() > deadline:
+            return pids
+        time.sleep(0.1)
+
+
+def reset_peak_rss(pids: List[int]) -> None:
+    """Restart peak RSS tracking so it covers only the next workload."""
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+
+def peak_rss(pids: List[int]) -> List[float]:
+    """Peak resident memory of each process in MiB (empty if /proc is unavailable)."""
+    peaks = []
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peaks.append(int(line.split()[1]) / 1024)
+        except OSError:
+            pass
+    return peaks
+
+
+async def run_phase(total: int, concurrency: int, request) -> Dict[str, float]:
+    """Run `total` requests with at most `concurrency` in flight and summarise them."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    transferred = 0
+    errors = 0
+
+    async def one(index: int) -> None:
+        nonlocal transferred, errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                transferred += await request(index)
+            except Exception as e:
+                errors += 1
+                print(f"    request {index} failed: {e}", file=sys.stderr)
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        "ops_per_s": round(len(latencies) / elapsed, 2),
+        "mib_per_s": round(transferred / MiB / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5), 2) if latencies else 0.0,
+        "p99_ms": round(percentile(latencies, 0.99), 2) if latencies else 0.0,
+        "errors": errors,
+    }
+
+
+async def run_workload(client, workload: Workload, shares: int, concurrency: int, seed: int) -> Dict[str, dict]:
+    """Upload `shares` shares of a workload, then download each of them once."""
+    file_ids: List[Optional[str]] = [None] * shares
+
+    async def upload(index: int) -> int:
+        if workload.kind == "text":
+            text = generated_text(workload.size, seed, index)
+            response = await client.post("/upload/", data={"expiration_policy": "store_1_hour", "text_content": text})
+        else:
+            files = [
+                ("files", (f"file-{index}-{member}.bin",
+                           GeneratedFile(workload.size, seed, index * workload.files + member),
+                           "application/octet-stream"))
+                for member in range(workload.files)
+            ]
+            response = await client.post("/upload/", data={"expiration_policy": "store_1_hour"}, files=files)
+        response.raise_for_status()
+        file_ids[index] = response.json()["uploads"][0]["file_id"]
+        return workload.size * workload.files
+
+    async def download(index: int) -> int:
+        if file_ids[index] is None:
+            raise RuntimeError("upload failed")
+        received = 0
+        async with client.stream("GET", f"/download/{file_ids[index]}") as response:
+            response.raise_for_status()
+            if workload.kind == "text":
+                content = json.loads(await response.aread())["content"]
+                received = len(content)
+            else:
+                async for piece in response.aiter_bytes():
+                    received += len(piece)
+        if workload.kind != "bundle" and received != workload.size:
+            raise RuntimeError(f"expected {workload.size} bytes, got {received}")
+        return received
+
+    return {
+        "upload": await run_phase(shares, concurrency, upload),
+        "download": await run_phase(shares, concurrency, download),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Describe every way results are worse than the baseline beyond the tolerance."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for phase in ("upload", "download"):
+            now, before = result[phase], base[phase]
+            if now["mib_per_s"] < before["mib_per_s"] * (1 - tolerance):
+                regressions.append(f"{name} {phase} throughput {now['mib_per_s']} MiB/s < baseline {before['mib_per_s']}")
+            for key in ("p50_ms", "p99_ms"):
+                if now[key] > before[key] * (1 + tolerance):
+                    regressions.append(f"{name} {phase} {key} {now[key]} > baseline {before[key]}")
+        if base["peak_rss_mib"] and result["peak_rss_mib"] > base["peak_rss_mib"] * (1 + tolerance):
+            regressions.append(f"{name} peak RSS {result['peak_rss_mib']} MiB > baseline {base['peak_rss_mib']}")
+        # The same workload should make exactly the same S3 calls
+        for operation, count in result["s3_requests"].items():
+            if count > base["s3_requests"].get(operation, 0):
+                regressions.append(f"{name} {operation} requests {count} > baseline "
+                                   f"{base['s3_requests'].get(operation, 0)}")
+    return regressions
+
+
+def print_result(name: str, result: dict) -> None:
+    print(f"{name}")
+    for phase in ("upload", "download"):
+        r = result[phase]
+        print(f"  {phase:>8}: {r['ops_per_s']:8.1f} ops/s  {r['mib_per_s']:8.1f} MiB/s  "
+              f"p50 {r['p50_ms']:8.1f} ms  p99 {r['p99_ms']:8.1f} ms  errors {r['errors']}")
+    rss = ", ".join(f"{peak:.0f}" for peak in result["rss_per_worker_mib"]) or "n/a"
+    print(f"  peak RSS per worker (MiB): {rss}")
+    print("  S3 requests: " + ", ".join(f"{op} {count}" for op, count in sorted(result["s3_requests"].items())))
+
+
+async def main(args, config: dict) -> int:
+    import httpx
+
+    s3_counts = Counter()
+    proxy = await start_counting_proxy(args.proxy_port, args.s3_port, s3_counts, args.s3_latency / 1000)
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **app_environment(args.proxy_port),
+            "METADATA_DB_PATH": os.path.join(directory, "benchmark.db"),
+            "LOG_LEVEL": "WARNING",
+        }
+        app = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.app_port),
+             "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=ROOT,
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            await asyncio.to_thread(wait_for_port, args.app_port)
+            pids = await asyncio.to_thread(wait_for_workers, app.pid, args.workers)
+            results = {}
+            limits = httpx.Limits(max_connections=64)
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.app_port}",
+                                         limits=limits, timeout=None) as client:
+                for name in args.workloads:
+                    workload = WORKLOADS[name]
+                    shares = max(1, round(workload.shares * args.scale))
+                    reset_peak_rss(pids)
+                    s3_counts.clear()
+                    result = await run_workload(client, workload, shares,
+                                                args.concurrency or workload.concurrency, args.seed)
+                    result["rss_per_worker_mib"] = [round(peak, 1) for peak in peak_rss(pids)]
+                    result["peak_rss_mib"] = max(result["rss_per_worker_mib"], default=0.0)
+                    result["s3_requests"] = dict(s3_counts)
+                    results[name] = result
+                    print_result(name, result)
+        finally:
+            app.terminate()
+            await asyncio.to_thread(app.wait)
+            proxy.close()
+
+    failed = any(result[phase]["errors"] for result in results.values() for phase in ("upload", "download"))
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(f"Warning: baseline was recorded with {baseline['config']}")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if not regressions:
+            print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workloads", nargs="+", choices=sorted(WORKLOADS), default=DEFAULT_WORKLOADS)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the number of shares per workload")
+    parser.add_argument("--concurrency", type=int, default=0, help="override every workload's concurrency")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--s3-latency", type=float, default=0.0,
+                        help="delay added to every S3 request in milliseconds")
+    parser.add_argument("--baseline", help="compare against results saved with --save-baseline")
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative slowdown or growth before a regression is reported")
+    parser.add_argument("--s3-port", type=int, default=5065)
+    parser.add_argument("--proxy-port", type=int, default=5066)
+    parser.add_argument("--app-port", type=int, default=5067)
+    args = parser.parse_args()
+    config = {key: getattr(args, key) for key in ("workloads", "scale", "concurrency", "workers", "seed", "s3_latency")}
+
+    import boto3
+
+    s3 = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "-p", str(args.s3_port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(args.s3_port)
+        env = app_environment(args.s3_port)
+        boto3.client(
+            "s3",
+            region_name="us-east-1",
+            endpoint_url=env["S3_ENDPOINT_URL"],
+            aws_access_key_id="testing",
+            aws_secret_access_key="testing",
+        ).create_bucket(Bucket=env["S3_BUCKET_NAME"])
+        status = asyncio.run(main(args, config))
+    finally:
+        s3.terminate()
+        s3.wait()
+    sys.exit(status)
@@ -0,0 +1,207 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import asyncio
+import hashlib
+import mmap
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+from pool_utils import cpu_pool
+from s3_utils import AsyncS3Manager, s3_manager
+
+# Bytes of encrypted objects to keep cached; 0 disables the cache
+OBJECT_CACHE_SIZE = int(os.getenv("OBJECT_CACHE_SIZE", "0"))
+# Keep cached blocks in files under this directory instead of in memory
+OBJECT_CACHE_DIR = os.getenv("OBJECT_CACHE_DIR") or None
+# Objects are cached (and fetched from S3) in blocks of this many bytes
+OBJECT_CACHE_BLOCK_SIZE = int(os.getenv("OBJECT_CACHE_BLOCK_SIZE", str(4 * 1024 * 1024)))
+
+BlockId = Tuple[str, str, int]
+
+class MemoryBlockStore:
+    """Keeps cached blocks in process memory."""
+
+    def __init__(self):
+        self._blocks: Dict[BlockId, bytes] = {}
+
+    def get(self, block_id: BlockId) -> Optional[bytes]:
+        return self._blocks.get(block_id)
+
+    def put(self, block_id: BlockId, data: bytes) -> None:
+        self._blocks[block_id] = data
+
+    def remove(self, block_id: BlockId) -> None:
+        self._blocks.pop(block_id, None)
+
+class DiskBlockStore:
+    """
+    Keeps cached blocks in files on local disk, read back through mmap.
+    Only S3 objects are cached and those are encrypted, so no plaintext
+    is ever written here.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # The index of cached blocks lives in memory; leftovers are unusable
+        for name in os.listdir(directory):
+            if name.endswith(".blk"):
+                os.unlink(os.path.join(directory, name))
+
+    def _path(self, block_id: BlockId) -> str:
+        name = hashlib.sha256(repr(block_id).encode()).hexdigest()
+        return os.path.join(self.directory, f"{name}.blk")
+
+    def get(self, block_id: BlockId) -> Optional[bytes]:
+        try:
+            with open(self._path(block_id), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b""
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return mapped[:]
+        except FileNotFoundError:
+            return None
+
+    def put(self, block_id: BlockId, data: bytes) -> None:
+        path = self._path(block_id)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def remove(self, block_id: BlockId) -> None:
+        try:
+            os.unlink(self._path(block_id))
+        except FileNotFoundError:
+            pass
+
+class ObjectCache:
+    """
+    Bounded cache of encrypted S3 objects for shares downloaded many times.
+    Objects are cached in fixed-size blocks keyed by S3 key and a version
+    (the stream header's random nonce prefix, which changes whenever an
+    object is rewritten, like an ETag but without a HEAD request). Blocks
+    are evicted least recently used first once their total size exceeds
+    the capacity, and concurrent misses for a block share one S3 request.
+    """
+
+    def __init__(self, s3: AsyncS3Manager, capacity: int = OBJECT_CACHE_SIZE,
+                 block_size: int = OBJECT_CACHE_BLOCK_SIZE, directory: Optional[str] = OBJECT_CACHE_DIR):
+        self.s3 = s3
+        self.capacity = capacity
+        self.block_size = block_size
+        self.store = DiskBlockStore(directory) if directory and capacity > 0 else MemoryBlockStore()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._sizes: "OrderedDict[BlockId, int]" = OrderedDict()
+        self._by_key: Dict[str, Set[BlockId]] = {}
+        self._inflight: Dict[BlockId, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """Counters describing the cache's use so far."""
+        return {
+            "size_bytes": self.size,
+            "blocks": len(self._sizes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, block_id: BlockId) -> None:
+        self.size -= self._sizes.pop(block_id)
+        blocks = self._by_key.get(block_id[0])
+        if blocks is not None:
+            blocks.discard(block_id)
+            if not blocks:
+                del self._by_key[block_id[0]]
+        self.store.remove(block_id)
+
+    def _admit(self, block_id: BlockId, size: int) -> bool:
+        """Make room for a block and account for it; False if it cannot be cached."""
+        if size > self.capacity or block_id in self._sizes:
+            return False
+        while self.size + size > self.capacity:
+            self._remove(next(iter(self._sizes)))
+            self.evictions += 1
+        self._sizes[block_id] = size
+        self._by_key.setdefault(block_id[0], set()).add(block_id)
+        self.size += size
+        return True
+
+    async def _fetch(self, block_id: BlockId, object_size: int) -> bytes:
+        key, _, index = block_id
+        start = index * self.block_size
+        end = min(start + self.block_size, object_size) - 1
+        body = await self.s3.stream_file(key, (start, end))
+        data = b"".join([piece async for piece in body])
+        # Bookkeeping stays on the event loop; only the store's I/O runs on the pool
+        if self._admit(block_id, len(data)):
+            await cpu_pool.run(self.store.put, block_id, data)
+            if block_id not in self._sizes:
+                # Evicted or discarded while being written
+                self.store.remove(block_id)
+        return data
+
+    async def _get_block(self, block_id: BlockId, object_size: int) -> bytes:
+        if block_id in self._sizes:
+            data = await cpu_pool.run(self.store.get, block_id)
+            if data is not None:
+                self.hits += 1
+                self._sizes.move_to_end(block_id)
+                return data
+        task = self._inflight.get(block_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._fetch(block_id, object_size))
+            self._inflight[block_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(block_id, None))
+        # Shielded so that one client going away does not fail the others
+        return await asyncio.shield(task)
+
+    async def stream(self, key: str, version: str, byte_range: Tuple[int, int],
+                     object_size: int) -> AsyncIterator[bytes]:
+        """
+        Stream an inclusive byte range of an object through the cache.
+        Like AsyncS3Manager.stream_file, the first block is fetched before
+        returning so missing keys fail early.
+        """
+        start, end = byte_range
+        first_block = start // self.block_size
+        last_block = end // self.block_size
+        first = await self._get_block((key, version, first_block), object_size)
+
+        async def iter_blocks() -> AsyncIterator[bytes]:
+            data = first
+            prefetch = None
+            try:
+                for index in range(first_block, last_block + 1):
+                    if index > first_block:
+                        data = await prefetch
+                    # Read ahead one block while this one is being sent
+                    if index < last_block:
+                        prefetch = asyncio.ensure_future(self._get_block((key, version, index + 1), object_size))
+                    offset = index * self.block_size
+                    yield data[max(start - offset, 0):end - offset + 1]
+            finally:
+                if prefetch is not None and not prefetch.done():
+                    prefetch.cancel()
+
+        return iter_blocks()
+
+    def discard(self, keys: List[str]) -> None:
+        """Drop every cached block of the given objects, e.g. once they are deleted."""
+        for key in keys:
+            for block_id in list(self._by_key.get(key, ())):
+                self._remove(block_id)
+
+# Create a singleton instance
+object_cache = ObjectCache(s3_manager)
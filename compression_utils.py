@@ -0,0 +1,149 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import zlib
+from typing import AsyncIterable, AsyncIterator, Optional
+import zstandard
+from pool_utils import cpu_pool
+from metrics_utils import timed
+from zip_utils import should_compress
+
+# Compress compressible single-file and text uploads before encryption
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+# Codec for compressible files: zstd, or gzip (DEFLATE) for older clients
+COMPRESSION_CODEC = os.getenv("COMPRESSION_CODEC", "zstd").lower()
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+# Leading bytes of a file compressed to estimate how well it compresses
+COMPRESSION_SAMPLE_SIZE = int(os.getenv("COMPRESSION_SAMPLE_SIZE", str(256 * 1024)))
+# Largest compressed-to-original size ratio of the sample worth storing compressed
+COMPRESSION_MAX_RATIO = float(os.getenv("COMPRESSION_MAX_RATIO", "0.9"))
+# Files smaller than this are stored as they are
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+
+# Media that is already compressed; images, video and audio are, except these
+INCOMPRESSIBLE_PREFIXES = ("image/", "video/", "audio/")
+COMPRESSIBLE_MEDIA = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "audio/wav", "audio/x-wav"}
+INCOMPRESSIBLE_TYPES = {
+    "application/zip", "application/gzip", "application/x-gzip", "application/zstd",
+    "application/x-7z-compressed", "application/x-rar-compressed", "application/vnd.rar",
+    "application/x-bzip2", "application/x-xz", "application/pdf", "application/epub+zip",
+    "application/java-archive", "font/woff", "font/woff2",
+}
+
+def compressible_type(content_type: str, filename: str) -> bool:
+    """Whether a file may be worth compressing, judged by its content type and extension."""
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type in INCOMPRESSIBLE_TYPES or media_type.startswith("application/vnd.openxmlformats"):
+        return False
+    if media_type.startswith(INCOMPRESSIBLE_PREFIXES) and media_type not in COMPRESSIBLE_MEDIA:
+        return False
+    return should_compress(filename)
+
+def sample_ratio(sample: bytes) -> float:
+    """Compressed-to-original size ratio of a sample, estimated with fast zstd."""
+    return len(zstandard.ZstdCompressor(level=1).compress(sample)) / len(sample)
+
+def new_compressor(codec: str):
+    """Streaming compressor for a codec, with compress() and flush()."""
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    if codec == "gzip":
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+def new_decompressor(codec: str):
+    """Streaming decompressor for a codec, with decompress() and eof."""
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == "gzip":
+        return zlib.decompressobj(31)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+def accepts_encoding(accept_encoding: Optional[str], codec: str) -> bool:
+    """Whether an Accept-Encoding header explicitly allows a codec."""
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.partition(";")
+        if name.strip().lower() != codec:
+            continue
+        params = params.strip().replace(" ", "")
+        try:
+            return not params.startswith("q=") or float(params[2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+class CompressedStream:
+    """
+    Plaintext of an upload on its way to encryption. choose_codec() picks
+    zstd/gzip or no compression from the content type and how well the
+    first COMPRESSION_SAMPLE_SIZE bytes compress; stream() then yields the
+    (compressed) bytes to encrypt. size counts the original bytes read.
+    """
+
+    def __init__(self, pieces: AsyncIterable[bytes], content_type: str, filename: str):
+        self._pieces = pieces.__aiter__()
+        self._sample = b""
+        self.content_type = content_type
+        self.filename = filename
+        self.codec: Optional[str] = None
+        self.size = 0
+
+    async def choose_codec(self) -> Optional[str]:
+        """Decide how to store the upload. Returns the codec, or None to store it as is."""
+        if not COMPRESSION_ENABLED or not compressible_type(self.content_type, self.filename):
+            return None
+        sample = bytearray()
+        complete = False
+        while len(sample) < COMPRESSION_SAMPLE_SIZE:
+            try:
+                sample += await self._pieces.__anext__()
+            except StopAsyncIteration:
+                complete = True
+                break
+        self._sample = bytes(sample)
+        if not sample or (complete and len(sample) < COMPRESSION_MIN_SIZE):
+            return None
+        with timed("compress"):
+            ratio = await cpu_pool.run(sample_ratio, self._sample[:COMPRESSION_SAMPLE_SIZE])
+        if ratio <= COMPRESSION_MAX_RATIO:
+            self.codec = COMPRESSION_CODEC
+        return self.codec
+
+    async def _plaintext(self) -> AsyncIterator[bytes]:
+        if self._sample:
+            self.size += len(self._sample)
+            yield self._sample
+        async for piece in self._pieces:
+            self.size += len(piece)
+            yield piece
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """The bytes to encrypt: the upload, compressed with the chosen codec."""
+        if self.codec is None:
+            async for piece in self._plaintext():
+                yield piece
+            return
+        compressor = new_compressor(self.codec)
+        async for piece in self._plaintext():
+            with timed("compress"):
+                compressed = await cpu_pool.run(compressor.compress, piece)
+            if compressed:
+                yield compressed
+        with timed("compress"):
+            compressed = await cpu_pool.run(compressor.flush)
+        yield compressed
+
+async def decompress_stream(body: AsyncIterable[bytes], codec: str) -> AsyncIterator[bytes]:
+    """Decompress a stored file's content while streaming it."""
+    decompressor = new_decompressor(codec)
+    async for piece in body:
+        with timed("decompress"):
+            plaintext = await cpu_pool.run(decompressor.decompress, piece)
+        if plaintext:
+            yield plaintext
+    if not decompressor.eof:
+        raise ValueError("Compressed stream is truncated")
@@ -0,0 +1,78 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from metadata_utils import MetadataStore, blob_store
+
+# Store the content of identical uploads once. Shares with a password keep
+# their own copy, encrypted with a key only the password unlocks.
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "").lower() == "true"
+
+def blob_hashes(record: Dict[str, Any]) -> List[str]:
+    """Content hashes of the deduplicated content a share record references."""
+    return [entry["blob"] for entry in record.get("members", [record]) if "blob" in entry]
+
+class BlobIndex:
+    """
+    Index of deduplicated content: one encrypted S3 object (a blob) per
+    distinct plaintext, found by its keyed content hash and reference
+    counted by the shares that use it. A blob expires with the last share
+    that referenced it, or as soon as its last reference is released,
+    after which the blob reaper removes it.
+    """
+
+    def __init__(self, store: MetadataStore):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """Deduplication counters."""
+        return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved, "blobs": len(self.store)}
+
+    def acquire(self, content_hash: str, expires_at: datetime) -> Optional[Dict[str, Any]]:
+        """
+        Reference stored content for a share that expires at expires_at.
+        Returns the blob record, or None if the content is not stored yet.
+        """
+        blob = self.store.acquire(content_hash, expires_at)
+        if blob is not None:
+            self.hits += 1
+            self.bytes_saved += blob["size"]
+        return blob
+
+    def register(self, content_hash: str, blob: Dict[str, Any], expires_at: datetime) -> Dict[str, Any]:
+        """
+        Record newly stored content, referenced by the share that stored it.
+        Returns the blob record to use, which is another upload's if an
+        identical one was registered first.
+        """
+        while True:
+            record = {**blob, "refs": 1, "expires_at": expires_at}
+            if self.store.reserve(content_hash, record):
+                self.misses += 1
+                return record
+            existing = self.acquire(content_hash, expires_at)
+            if existing is not None:
+                return existing
+
+    def release(self, record: Dict[str, Any]) -> bool:
+        """
+        Drop a removed share's references to deduplicated content.
+        Returns whether any content lost its last reference.
+        """
+        now = datetime.now(timezone.utc)
+        freed = False
+        for content_hash in blob_hashes(record):
+            blob = self.store.release(content_hash, now)
+            freed = freed or (blob is not None and blob["refs"] <= 0)
+        return freed
+
+# Create a singleton instance
+blob_index = BlobIndex(blob_store)
@@ -1,29 +1,278 @@
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import os
-from typing import Tuple
+import json
+import struct
+import hashlib
+import hmac
+from typing import AsyncIterable, AsyncIterator, Dict, NamedTuple, Optional, Tuple
 import base64
+import threading
+from collections import OrderedDict
 from fastapi import HTTPException
+from pool_utils import cpu_pool
+from metrics_utils import timed
+
+# Chunked stream format:
+#   header = magic (4) | version (1) | chunk_size (4) | nonce_prefix (7)
+#            | metadata length (2) | metadata (JSON, version 2 only)
+#   body   = one or more chunks of AES-GCM(ciphertext + 16-byte tag)
+# Every chunk holds chunk_size bytes of plaintext except the final one.
+# The nonce of chunk i is nonce_prefix | i (4 bytes) | final flag (1 byte),
+# and the header is authenticated as associated data of every chunk, so
+# chunks cannot be reordered, truncated or moved between objects.
+# The metadata (filename, content type) makes objects self-describing,
+# so serving one never needs a separate HEAD request.
+STREAM_MAGIC = b"SWSH"
+STREAM_VERSION = 2
+STREAM_HEADER = struct.Struct(">4sBI7s")
+STREAM_METADATA_LENGTH = struct.Struct(">H")
+TAG_SIZE = 16
+# Associated data binding wrapped data keys to their purpose
+DATA_KEY_AAD = b"swiftshare-data-key"
+# Derivation label of the key for content hashes used to find duplicate uploads
+CONTENT_HASH_LABEL = b"swiftshare-content-hash"
+DEFAULT_CHUNK_SIZE = int(os.getenv("ENCRYPTION_CHUNK_SIZE", str(64 * 1024)))
+# Unwrapped data keys kept in memory, most recently used first
+DATA_KEY_CACHE_SIZE = int(os.getenv("DATA_KEY_CACHE_SIZE", "4096"))
+
+# Envelope encryption: every file is encrypted with its own random data
+# key, stored wrapped (encrypted) by a versioned master key as
+# "<version>:<base64>". ENCRYPTION_KEY is master key version 1, and
+# ENCRYPTION_KEYS adds others as "<version>:<base64 key>,...". New data
+# keys are wrapped with ENCRYPTION_KEY_VERSION, by default the highest;
+# rotating means adding a version, making it current and re-wrapping the
+# stored data keys (see rotation_utils), after which older versions can
+# be retired. Wrapped keys without a version predate versioning and use
+# version 1, as do files from before per-file keys, so it is kept.
+LEGACY_KEY_VERSION = 1
+
+
+class StreamHeader(NamedTuple):
+    """Parsed stream header."""
+    version: int
+    chunk_size: int
+    nonce_prefix: bytes
+    metadata: Dict[str, str]
+    size: int
+
+
+def _chunk_nonce(nonce_prefix: bytes, index: int, final: bool) -> bytes:
+    """Build the 12-byte nonce for a chunk."""
+    return nonce_prefix + struct.pack(">IB", index, 1 if final else 0)
+
+
+def build_stream_header(chunk_size: int, nonce_prefix: bytes, metadata: Optional[Dict[str, str]] = None) -> bytes:
+    """Serialize a stream header."""
+    encoded = json.dumps(metadata or {}, separators=(",", ":")).encode()
+    return (
+        STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, chunk_size, nonce_prefix)
+        + STREAM_METADATA_LENGTH.pack(len(encoded))
+        + encoded
+    )
+
+
+def parse_stream_header(header: bytes) -> StreamHeader:
+    """
+    Validate a stream header. header may be longer than the header itself,
+    e.g. the start of the object; the parsed size says where chunks begin.
+    """
+    if len(header) < STREAM_HEADER.size:
+        raise ValueError("Encrypted stream header is truncated")
+    magic, version, chunk_size, nonce_prefix = STREAM_HEADER.unpack_from(header)
+    if magic != STREAM_MAGIC or version not in (1, 2):
+        raise ValueError("Unsupported encrypted stream format")
+    if version == 1:
+        return StreamHeader(version, chunk_size, nonce_prefix, {}, STREAM_HEADER.size)
+
+    offset = STREAM_HEADER.size + STREAM_METADATA_LENGTH.size
+    if len(header) < offset:
+        raise ValueError("Encrypted stream header is truncated")
+    (metadata_length,) = STREAM_METADATA_LENGTH.unpack_from(header, STREAM_HEADER.size)
+    if len(header) < offset + metadata_length:
+        raise ValueError("Encrypted stream header is truncated")
+    metadata = json.loads(header[offset:offset + metadata_length])
+    return StreamHeader(version, chunk_size, nonce_prefix, metadata, offset + metadata_length)
+
+
+def chunk_count(size: int, chunk_size: int) -> int:
+    """Number of encrypted chunks used for a plaintext of the given size."""
+    return max(1, -(-size // chunk_size))
+
+
+def encrypted_size(size: int, chunk_size: int, header_size: int) -> int:
+    """Size of the stored object for a plaintext of the given size."""
+    return header_size + size + chunk_count(size, chunk_size) * TAG_SIZE
+
+
+class StreamEncryptor:
+    """Incrementally encrypts plaintext into the chunked stream format.
+
+    The last chunk is held back until finalize() so it can be flagged as
+    final; at most chunk_size bytes of plaintext are buffered. Given an
+    existing header and first_index, it encrypts a run of chunks in the
+    middle of that stream instead, e.g. one part of a chunked upload.
+    """
+
+    def __init__(self, aesgcm: AESGCM, chunk_size: int, metadata: Optional[Dict[str, str]] = None,
+                 header: Optional[bytes] = None, first_index: int = 0):
+        self.aesgcm = aesgcm
+        if header is None:
+            self.chunk_size = chunk_size
+            self.nonce_prefix = os.urandom(7)
+            self.header = build_stream_header(chunk_size, self.nonce_prefix, metadata)
+        else:
+            parsed = parse_stream_header(header)
+            self.chunk_size = parsed.chunk_size
+            self.nonce_prefix = parsed.nonce_prefix
+            self.header = bytes(header[:parsed.size])
+        self.size = 0
+        self._index = first_index
+        self._buffer = bytearray()
+
+    def _seal(self, data: bytes, final: bool) -> bytes:
+        nonce = _chunk_nonce(self.nonce_prefix, self._index, final)
+        self._index += 1
+        return self.aesgcm.encrypt(nonce, data, self.header)
+
+    def update(self, data: bytes) -> bytes:
+        """Add plaintext and return the ciphertext of every completed chunk."""
+        self.size += len(data)
+        self._buffer += data
+        out = []
+        # Keep at least one byte back: only finalize() knows which chunk is last
+        while len(self._buffer) > self.chunk_size:
+            out.append(self._seal(bytes(self._buffer[:self.chunk_size]), False))
+            del self._buffer[:self.chunk_size]
+        return b"".join(out)
+
+    def finalize(self, final: bool = True) -> bytes:
+        """
+        Encrypt the remaining plaintext as the last chunk, flagged as the
+        final chunk of the stream unless final is False.
+        """
+        sealed = self._seal(bytes(self._buffer), final)
+        self._buffer = bytearray()
+        return sealed
+
+
+class StreamDecryptor:
+    """Incrementally decrypts (a contiguous run of chunks of) an encrypted stream.
+
+    first_index is the index of the first chunk fed in, which allows
+    decrypting a byte range of the object. When final_index is known each
+    chunk is decrypted as soon as it is complete; otherwise one chunk is
+    held back until finalize() and treated as the final one.
+    """
+
+    def __init__(self, aesgcm: AESGCM, header: bytes, first_index: int = 0, final_index: Optional[int] = None):
+        self.aesgcm = aesgcm
+        parsed = parse_stream_header(header)
+        self.header = bytes(header[:parsed.size])
+        self.chunk_size = parsed.chunk_size
+        self.nonce_prefix = parsed.nonce_prefix
+        self.final_index = final_index
+        self._index = first_index
+        self._buffer = bytearray()
+
+    def _open(self, data: bytes, final: bool) -> bytes:
+        nonce = _chunk_nonce(self.nonce_prefix, self._index, final)
+        self._index += 1
+        return self.aesgcm.decrypt(nonce, data, self.header)
+
+    def update(self, data: bytes) -> bytes:
+        """Add ciphertext and return the plaintext of every completed chunk."""
+        self._buffer += data
+        sealed_size = self.chunk_size + TAG_SIZE
+        out = []
+        while len(self._buffer) > sealed_size or (
+            self.final_index is not None and len(self._buffer) == sealed_size
+        ):
+            final = self._index == self.final_index
+            out.append(self._open(bytes(self._buffer[:sealed_size]), final))
+            del self._buffer[:sealed_size]
+        return b"".join(out)
+
+    def finalize(self) -> bytes:
+        """Decrypt the remaining ciphertext as the final chunk."""
+        if not self._buffer:
+            # Without a known final index the final chunk must have been held back
+            if self.final_index is None:
+                raise ValueError("Encrypted stream is truncated")
+            return b""
+        if self.final_index is not None and self._index != self.final_index:
+            raise ValueError("Encrypted stream is truncated")
+        plaintext = self._open(bytes(self._buffer), True)
+        self._buffer = bytearray()
+        return plaintext
+
+def _decode_master_key(value: str) -> bytes:
+    """Decode a master key, base64 unless it is given as raw bytes."""
+    try:
+        key = base64.b64decode(value)
+    except:
+        # If not base64, assume it's already in bytes format
+        key = value.encode()
+    # Ensure key is 32 bytes (256 bits) for AES-256
+    if len(key) != 32:
+        raise ValueError("Encryption key must be 32 bytes (256 bits)")
+    return key
+
+
+def parse_master_keys(legacy_key: str, keys: str) -> Dict[int, bytes]:
+    """Parse ENCRYPTION_KEY and ENCRYPTION_KEYS into master keys by version."""
+    master_keys = {LEGACY_KEY_VERSION: _decode_master_key(legacy_key)}
+    for item in keys.split(","):
+        if not item.strip():
+            continue
+        version, sep, value = item.strip().partition(":")
+        if not sep or not version.isdigit():
+            raise ValueError("ENCRYPTION_KEYS entries must look like <version>:<base64 key>")
+        if int(version) in master_keys:
+            raise ValueError(f"Master key version {int(version)} is defined twice")
+        master_keys[int(version)] = _decode_master_key(value)
+    return master_keys
+
+
+def wrapped_key_version(wrapped_key: str) -> int:
+    """Version of the master key a stored data key is wrapped with."""
+    version, sep, _ = wrapped_key.partition(":")
+    return int(version) if sep else LEGACY_KEY_VERSION
+
 
 class EncryptionManager:
     def __init__(self):
         # Get encryption key from environment variable
-        self.encryption_key = os.getenv("ENCRYPTION_KEY")
-        if not self.encryption_key:
+        encryption_key = os.getenv("ENCRYPTION_KEY")
+        if not encryption_key:
             raise ValueError("ENCRYPTION_KEY environment variable not set")
-        
-        # Convert the key from base64 to bytes if it's stored as base64
-        try:
-            self.encryption_key = base64.b64decode(self.encryption_key)
-        except:
-            # If not base64, assume it's already in bytes format
-            if isinstance(self.encryption_key, str):
-                self.encryption_key = self.encryption_key.encode()
-        
-        # Ensure key is 32 bytes (256 bits) for AES-256
-        if len(self.encryption_key) != 32:
-            raise ValueError("Encryption key must be 32 bytes (256 bits)")
+        master_keys = parse_master_keys(encryption_key, os.getenv("ENCRYPTION_KEYS", ""))
+        self.encryption_key = master_keys[LEGACY_KEY_VERSION]
+        self.key_version = int(os.getenv("ENCRYPTION_KEY_VERSION", str(max(master_keys))))
+        if self.key_version not in master_keys:
+            raise ValueError(f"ENCRYPTION_KEY_VERSION {self.key_version} has no key in ENCRYPTION_KEYS")
+
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        # AESGCM objects are stateless and thread-safe; build the ciphers once
+        self.master_keys = {version: AESGCM(key) for version, key in master_keys.items()}
+        self.aesgcm = self.master_keys[LEGACY_KEY_VERSION]
+        self.content_hash_key = hmac.new(self.encryption_key, CONTENT_HASH_LABEL, hashlib.sha256).digest()
+
+        # Unwrapping is cheap locally but would be a KMS call with a remote
+        # master key; hot files reuse their unwrapped data key
+        self._data_keys: "OrderedDict[str, bytes]" = OrderedDict()
+        self._data_keys_lock = threading.Lock()
+        self.data_key_hits = 0
+        self.data_key_misses = 0
+
+    @property
+    def metrics(self) -> Dict[str, int]:
+        """Master key version in use and data key cache counters."""
+        return {
+            "key_version": self.key_version,
+            "data_key_cache_hits": self.data_key_hits,
+            "data_key_cache_misses": self.data_key_misses,
+            "data_key_cache_size": len(self._data_keys),
+        }
 
     def encrypt_data(self, data: bytes) -> Tuple[bytes, bytes, bytes]:
         """
@@ -34,11 +283,8 @@ class EncryptionManager:
             # Generate a random 12-byte IV
             iv = os.urandom(12)
             
-            # Create AES-GCM cipher
-            aesgcm = AESGCM(self.encryption_key)
-            
             # Encrypt the data
-            encrypted_data = aesgcm.encrypt(iv, data, None)
+            encrypted_data = self.aesgcm.encrypt(iv, data, None)
             
             # Split the result into ciphertext and tag
             # The last 16 bytes are the authentication tag
@@ -58,14 +304,11 @@ class EncryptionManager:
         Decrypt data using AES-GCM.
         """
         try:
-            # Create AES-GCM cipher
-            aesgcm = AESGCM(self.encryption_key)
-            
             # Combine ciphertext and tag
             encrypted_data_with_tag = encrypted_data + tag
             
             # Decrypt the data
-            decrypted_data = aesgcm.decrypt(iv, encrypted_data_with_tag, None)
+            decrypted_data = self.aesgcm.decrypt(iv, encrypted_data_with_tag, None)
             
             return decrypted_data
             
@@ -75,5 +318,125 @@ class EncryptionManager:
                 detail=f"Error decrypting data: {str(e)}"
             )
 
+    def new_encryptor(self, metadata: Optional[Dict[str, str]] = None, chunk_size: Optional[int] = None,
+                      header: Optional[bytes] = None, first_index: int = 0,
+                      data_key: Optional[bytes] = None) -> StreamEncryptor:
+        """
+        Create an encryptor for a new object in the chunked stream format.
+        metadata is stored (authenticated, not encrypted) in the header.
+        Pass the header of an existing stream and first_index to encrypt
+        chunks of that stream from first_index on. Objects are encrypted
+        with the master key unless a per-file data key is given.
+        """
+        aesgcm = AESGCM(data_key) if data_key else self.aesgcm
+        return StreamEncryptor(aesgcm, chunk_size or self.chunk_size, metadata, header, first_index)
+
+    def new_stream_header(self, metadata: Optional[Dict[str, str]] = None) -> bytes:
+        """
+        Create the header for an object that is encrypted elsewhere,
+        e.g. in the browser, with a fresh nonce prefix.
+        """
+        return build_stream_header(self.chunk_size, os.urandom(7), metadata)
+
+    def content_hasher(self) -> "hmac.HMAC":
+        """
+        Create a keyed hash (HMAC-SHA256) for plaintext content, used to
+        find identical uploads. Because it is keyed, stored hashes cannot
+        be used to confirm guesses of what a file contains.
+        """
+        return hmac.new(self.content_hash_key, digestmod=hashlib.sha256)
+
+    def generate_data_key(self) -> Tuple[bytes, str]:
+        """
+        Create a random per-file data key.
+        Returns (data_key, wrapped_key); the wrapped key is the data key
+        encrypted with the current master key, encoded for storage.
+        """
+        data_key = AESGCM.generate_key(bit_length=256)
+        return data_key, self.wrap_data_key(data_key)
+
+    def wrap_data_key(self, data_key: bytes) -> str:
+        """Encrypt a data key with the current master key, encoded for storage with its version."""
+        nonce = os.urandom(12)
+        wrapped = nonce + self.master_keys[self.key_version].encrypt(nonce, data_key, DATA_KEY_AAD)
+        return f"{self.key_version}:{base64.b64encode(wrapped).decode()}"
+
+    def _unwrap(self, wrapped_key: str) -> bytes:
+        version = wrapped_key_version(wrapped_key)
+        if version not in self.master_keys:
+            raise ValueError(f"master key version {version} is not configured")
+        wrapped = base64.b64decode(wrapped_key.rpartition(":")[2])
+        return self.master_keys[version].decrypt(wrapped[:12], wrapped[12:], DATA_KEY_AAD)
+
+    def unwrap_data_key(self, wrapped_key: str) -> bytes:
+        """Recover a data key from its wrapped form, from the cache when it was used recently."""
+        with self._data_keys_lock:
+            data_key = self._data_keys.get(wrapped_key)
+            if data_key is not None:
+                self._data_keys.move_to_end(wrapped_key)
+                self.data_key_hits += 1
+                return data_key
+        try:
+            data_key = self._unwrap(wrapped_key)
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error decrypting data key: {str(e)}"
+            )
+        with self._data_keys_lock:
+            self.data_key_misses += 1
+            if DATA_KEY_CACHE_SIZE > 0:
+                self._data_keys[wrapped_key] = data_key
+                while len(self._data_keys) > DATA_KEY_CACHE_SIZE:
+                    self._data_keys.popitem(last=False)
+        return data_key
+
+    def needs_rewrap(self, wrapped_key: str) -> bool:
+        """Whether a data key is wrapped with a master key older than the current one."""
+        return wrapped_key_version(wrapped_key) < self.key_version
+
+    def rewrap_data_key(self, wrapped_key: str) -> str:
+        """Wrap a stored data key with the current master key instead, without touching what it encrypts."""
+        return self.wrap_data_key(self._unwrap(wrapped_key))
+
+    def new_decryptor(self, header: bytes, first_index: int = 0, final_index: Optional[int] = None,
+                      data_key: Optional[bytes] = None) -> StreamDecryptor:
+        """
+        Create a decryptor for an object written by new_encryptor(),
+        or with a per-file data key when one is given.
+        """
+        try:
+            aesgcm = AESGCM(data_key) if data_key else self.aesgcm
+            return StreamDecryptor(aesgcm, header, first_index, final_index)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error decrypting data: {str(e)}"
+            )
+
+    async def encrypt_stream(self, pieces: AsyncIterable[bytes], encryptor: Optional[StreamEncryptor] = None) -> AsyncIterator[bytes]:
+        """
+        Encrypt an async iterable of plaintext pieces on the CPU pool.
+        Yields the stream header followed by the encrypted chunks.
+        """
+        encryptor = encryptor or self.new_encryptor()
+        try:
+            yield encryptor.header
+            async for piece in pieces:
+                with timed("encrypt"):
+                    ciphertext = await cpu_pool.run(encryptor.update, piece)
+                if ciphertext:
+                    yield ciphertext
+            with timed("encrypt"):
+                final = await cpu_pool.run(encryptor.finalize)
+            yield final
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error encrypting data: {str(e)}"
+            )
+
 # Create a singleton instance
 encryption_manager = EncryptionManager() 
\ No newline at end of file
@@ -0,0 +1,87 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import secrets
+from datetime import datetime
+from fastapi import HTTPException
+from typing import Any, Dict
+from metadata_utils import MetadataStore, metadata_store
+from metrics_utils import get_logger
+
+logger = get_logger("ids")
+
+# Characters of the short, human-friendly part of share IDs; without
+# 0/O, 1/I/L so codes survive being read out or typed by hand
+SHARE_ID_ALPHABET = os.getenv("SHARE_ID_ALPHABET", "23456789ABCDEFGHJKMNPQRSTUVWXYZ")
+SHARE_ID_LENGTH = int(os.getenv("SHARE_ID_LENGTH", "6"))
+# Random bytes of an optional long token appended to every ID (0 disables it)
+SHARE_ID_TOKEN_BYTES = int(os.getenv("SHARE_ID_TOKEN_BYTES", "0"))
+# Attempts at finding a free ID before giving up
+SHARE_ID_MAX_ATTEMPTS = int(os.getenv("SHARE_ID_MAX_ATTEMPTS", "8"))
+
+class IdAllocator:
+    """
+    Allocates share IDs that are unique among active shares.
+    Candidates are drawn at random from the keyspace and claimed with the
+    store's atomic reserve(), so concurrent uploads (on any worker) never
+    get the same ID; a taken candidate is simply retried.
+    """
+
+    def __init__(self, store: MetadataStore, alphabet: str = SHARE_ID_ALPHABET,
+                 length: int = SHARE_ID_LENGTH, token_bytes: int = SHARE_ID_TOKEN_BYTES,
+                 max_attempts: int = SHARE_ID_MAX_ATTEMPTS):
+        self.store = store
+        self.alphabet = alphabet
+        self.length = length
+        self.token_bytes = token_bytes
+        self.max_attempts = max_attempts
+        self.allocated = 0
+        self.collisions = 0
+
+    @property
+    def keyspace(self) -> int:
+        """Number of distinct IDs."""
+        return len(self.alphabet) ** self.length * 256 ** self.token_bytes
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """Keyspace occupancy and allocation counters."""
+        active = len(self.store)
+        occupancy = active / self.keyspace
+        return {
+            "keyspace": self.keyspace,
+            "active": active,
+            "occupancy": occupancy,
+            # A random candidate is free with probability 1 - occupancy
+            "expected_attempts": 1 / (1 - occupancy) if occupancy < 1 else float("inf"),
+            "allocated": self.allocated,
+            "collisions": self.collisions,
+        }
+
+    def generate(self) -> str:
+        """Draw a random candidate ID."""
+        code = "".join(secrets.choice(self.alphabet) for _ in range(self.length))
+        if self.token_bytes:
+            return f"{code}-{secrets.token_urlsafe(self.token_bytes)}"
+        return code
+
+    def allocate(self, expires_at: datetime) -> str:
+        """
+        Reserve a new ID with a pending record that lasts until expires_at,
+        or until the upload's share record replaces it.
+        """
+        for _ in range(self.max_attempts):
+            file_id = self.generate()
+            if self.store.reserve(file_id, {"pending": True, "expires_at": expires_at}):
+                self.allocated += 1
+                return file_id
+            self.collisions += 1
+        logger.error("No free share ID; keyspace occupancy may be too high",
+                     extra={"attempts": self.max_attempts, "keyspace": self.keyspace})
+        raise HTTPException(status_code=503, detail="Could not allocate a share ID, please retry")
+
+# Create a singleton instance
+id_allocator = IdAllocator(metadata_store)
@@ -4,74 +4,403 @@ import os
 # Load environment variables from .env file
 load_dotenv()
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Header, Request
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
 from pathlib import Path
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-import random
-import string
+import secrets
+import hmac
+import time
 import io
-import zipfile
-from io import BytesIO
-from s3_utils import s3_manager
-from encryption_utils import encryption_manager
+import asyncio
 import base64
+from io import BytesIO
+from typing import AsyncIterable, AsyncIterator, List, Optional, Tuple
+from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from s3_utils import s3_manager, S3_PART_SIZE
+from encryption_utils import (
+    encryption_manager, parse_stream_header, chunk_count, encrypted_size, StreamEncryptor, TAG_SIZE,
+)
+from metadata_utils import metadata_store, upload_session_store, object_keys, run_store
+from reaper_utils import expiry_reaper, upload_session_reaper, blob_reaper, release_blobs
+from rotation_utils import key_rotator
+from zip_utils import stream_zip
+from pool_utils import cpu_pool
+from cache_utils import object_cache
+from password_utils import password_verifier, kdf_pool
+from id_utils import id_allocator
+from dedup_utils import DEDUP_ENABLED, blob_index
+from compression_utils import COMPRESSION_ENABLED, CompressedStream, accepts_encoding, decompress_stream
+from preview_utils import PreviewCapture, previewable_type, preview_text
+from metrics_utils import (
+    get_logger, observe_stage, timed, active, count_bytes, metered_download,
+    request_started, stats_collector, REQUEST_SECONDS, SHARES_CREATED, METRICS_SCAN_INTERVAL,
+)
+
+logger = get_logger("main")
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the expiry reapers, and any pending data key rotation, for the lifetime of the app."""
+    reaper_tasks = [
+        asyncio.create_task(expiry_reaper.run()),
+        asyncio.create_task(upload_session_reaper.run()),
+        asyncio.create_task(blob_reaper.run()),
+        asyncio.create_task(key_rotator.run()),
+    ]
+    yield
+    for task in reaper_tasks:
+        task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 # Mount the static directory to serve CSS and JavaScript files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# In-memory database for file metadata
-files_db = {}
-
-def generate_id(length: int = 4) -> str:
-    """Generate a unique ID with a pattern of 3 numbers and 1 letter."""
-    # Define the pattern: N-N-N-L (Number-Number-Number-Letter)
-    pattern = ['N', 'N', 'N', 'L']
-    
-    result = []
-    for char in pattern:
-        if char == 'N':
-            result.append(random.choice(string.digits))
-        else:  # 'L'
-            result.append(random.choice(string.ascii_uppercase))
-    
-    return ''.join(result)
-
-def upload_to_s3(file: UploadFile, expiration: int) -> dict:
-    """Upload a file to S3 and return its metadata."""
-    file_id = generate_id(length=6)
-    file_key = f"{file_id}/{file.filename}"
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Time every request, and make its start time available to handlers."""
+    started = time.perf_counter()
+    request_started.set(started)
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(
+        request.method, route.path if route else "unmatched", str(response.status_code)
+    ).observe(time.perf_counter() - started)
+    return response
+
+def observe_request_parse() -> None:
+    """Record the time from the start of the request until its body was parsed."""
+    observe_stage("request_parse", time.perf_counter() - request_started.get(time.perf_counter()))
+
+# Size of the pieces read from uploaded files
+UPLOAD_READ_SIZE = 1024 * 1024
+# Text and single files up to this size are kept encrypted in their metadata
+# record instead of as S3 objects (0 disables this)
+INLINE_MAX_SIZE = int(os.getenv("INLINE_MAX_SIZE", str(64 * 1024)))
+
+# Direct uploads send encrypted parts from the browser straight to S3.
+# They need a bucket CORS rule allowing PUT from the site and exposing
+# the ETag header, so they are opt-in.
+DIRECT_UPLOADS_ENABLED = os.getenv("DIRECT_UPLOADS_ENABLED", "").lower() == "true"
+# Seconds an unfinished upload session (and any presigned part URLs) stays
+# valid, and the longest any upload may take before its share ID lapses
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", "86400"))
+# S3 allows at most 10,000 parts per multipart upload
+S3_MAX_PARTS = 10000
+
+async def allocate_id(expires_in: int = UPLOAD_SESSION_TTL) -> str:
+    """Reserve a unique share ID for an upload that may take up to expires_in seconds."""
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+    file_id = await run_store(id_allocator.allocate, expires_at)
+    expiry_reaper.notify(expires_at)
+    return file_id
+
+def check_part_upload(filename: str, content_type: str) -> None:
+    """
+    Turn text files (logs, CSV, JSON and the like), which compress well,
+    away from direct and resumable uploads. Their parts are encrypted
+    independently as they arrive, possibly out of order, so they cannot be
+    compressed; /upload/ compresses the file whole.
+    """
+    if COMPRESSION_ENABLED and previewable_type(content_type, filename):
+        raise HTTPException(status_code=409, detail="Compressible files are uploaded with /upload/")
+
+def release_id(file_id: str) -> None:
+    """Give back the ID reserved for an upload that failed."""
+    record = metadata_store.get(file_id)
+    if record and record.get("pending"):
+        metadata_store.delete(file_id)
 
-    # Read file content
-    file_content = file.file.read()
-    
-    # Encrypt the file content
-    encrypted_data, iv, tag = encryption_manager.encrypt_data(file_content)
-    
-    # Combine encrypted data, IV, and tag
-    combined_data = iv + tag + encrypted_data
-    
-    # Upload encrypted file to S3 with metadata
+async def discard_upload(record: dict) -> None:
+    """Remove the stored content of an upload that did not become a share."""
+    await s3_manager.delete_files(object_keys(record))
+    await release_blobs(record)
+
+async def check_reservation(file_id: str) -> None:
+    """Make sure an upload session's ID is still reserved before registering its share."""
+    record = await run_store(metadata_store.get, file_id)
+    if not record or not record.get("pending"):
+        raise HTTPException(status_code=410, detail="Upload has expired")
+
+async def read_chunks(file: UploadFile, chunk_size: int = UPLOAD_READ_SIZE) -> AsyncIterator[bytes]:
+    """Read an uploaded file in pieces instead of loading it whole."""
+    while True:
+        piece = await file.read(chunk_size)
+        if not piece:
+            break
+        count_bytes("in", len(piece))
+        yield piece
+
+async def reread_chunks(file: UploadFile, chunk_size: int = UPLOAD_READ_SIZE) -> AsyncIterator[bytes]:
+    """Read an uploaded file again from the start, from the copy spooled while it was received."""
+    await file.seek(0)
+    while True:
+        piece = await file.read(chunk_size)
+        if not piece:
+            break
+        yield piece
+
+def object_data_key(data_key: Optional[bytes]) -> Tuple[bytes, dict]:
+    """
+    The key to encrypt a new object with, and the record fields storing it:
+    a password-protected share's key (stored with the share), or else a new
+    per-file data key, stored wrapped with the current master key.
+    """
+    if data_key is not None:
+        return data_key, {}
+    data_key, wrapped_key = encryption_manager.generate_data_key()
+    return data_key, {"data_key": wrapped_key}
+
+async def encrypt_to_s3(file_key: str, pieces: AsyncIterable[bytes], filename: str,
+                        content_type: str, expiration: int, data_key: Optional[bytes] = None) -> dict:
+    """
+    Encrypt plaintext pieces chunk by chunk while streaming them to S3,
+    compressing them first if they compress well.
+    Returns the object's fields for the metadata record.
+    """
+    data_key, key_fields = object_data_key(data_key)
+    content = CompressedStream(pieces, content_type, filename)
+    encryptor = encryption_manager.new_encryptor(
+        header_metadata({"filename": filename, "content_type": content_type}, await content.choose_codec()),
+        data_key=data_key,
+    )
     metadata = {
         "expiration": str(expiration),
-        "original_filename": file.filename,
-        "content_type": file.content_type or "application/octet-stream",
-        "encryption_iv": base64.b64encode(iv).decode(),
-        "encryption_tag": base64.b64encode(tag).decode()
+        "original_filename": filename,
+        "content_type": content_type,
+        "encryption_format": "chunked-v2",
     }
-    s3_manager.upload_file(combined_data, file_key, metadata)
-
-    # Store metadata in the in-memory database with timezone-aware datetime
-    expiration_time = datetime.now(timezone.utc) + timedelta(seconds=expiration)
-    files_db[file_id] = {
+    await s3_manager.upload_stream(encryption_manager.encrypt_stream(content.stream(), encryptor), file_key, metadata)
+    return {
         "key": file_key,
-        "filename": file.filename,
-        "expires_at": expiration_time,
+        "filename": filename,
+        "content_type": content_type,
+        **stored_fields(content, encryptor),
+        **key_fields,
     }
 
+def header_metadata(metadata: dict, codec: Optional[str]) -> dict:
+    """Object header metadata, recording the compression codec if there is one."""
+    return {**metadata, "encoding": codec} if codec else metadata
+
+def stored_fields(content: CompressedStream, encryptor: StreamEncryptor) -> dict:
+    """Record fields describing an uploaded object's size and header."""
+    fields = {"size": content.size, "header": base64.b64encode(encryptor.header).decode()}
+    if content.codec:
+        # Size of the compressed stream that was encrypted
+        fields["encoded_size"] = encryptor.size
+    return fields
+
+def content_encoding(stored: dict) -> Optional[str]:
+    """The codec a stored file was compressed with, from its header, or None."""
+    return parse_stream_header(base64.b64decode(stored["header"])).metadata.get("encoding")
+
+async def encrypt_inline(pieces: AsyncIterable[bytes], filename: str, content_type: str,
+                         data_key: Optional[bytes] = None) -> dict:
+    """
+    Encrypt a small file into an object kept in its metadata record
+    ("inline") rather than in S3, so serving it needs no S3 requests.
+    Returns the object's fields for the metadata record.
+    """
+    data_key, key_fields = object_data_key(data_key)
+    content = CompressedStream(pieces, content_type, filename)
+    encryptor = encryption_manager.new_encryptor(
+        header_metadata({"filename": filename, "content_type": content_type}, await content.choose_codec()),
+        data_key=data_key,
+    )
+    body = b"".join([piece async for piece in encryption_manager.encrypt_stream(content.stream(), encryptor)])
+    return {
+        "filename": filename,
+        "content_type": content_type,
+        **stored_fields(content, encryptor),
+        **key_fields,
+        "inline": base64.b64encode(body).decode(),
+    }
+
+async def encrypt_preview(preview: PreviewCapture, data_key: Optional[bytes] = None) -> dict:
+    """
+    Record fields holding a file's preview, if it has one: a small object
+    encrypted like the file and kept in its metadata record, so /info can
+    show it without fetching or decrypting the file.
+    """
+    if preview.sample is None:
+        return {}
+    data_key, key_fields = object_data_key(data_key)
+    encryptor = encryption_manager.new_encryptor(data_key=data_key)
+    body = b"".join([
+        piece async for piece in encryption_manager.encrypt_stream(inline_stream(preview.sample), encryptor)
+    ])
+    return {"preview": {
+        "size": len(preview.sample),
+        "header": base64.b64encode(encryptor.header).decode(),
+        "inline": base64.b64encode(body).decode(),
+        **key_fields,
+    }}
+
+async def deduplicate_to_s3(pieces: AsyncIterable[bytes], spooled: UploadFile, filename: str, content_type: str,
+                            expiration: int) -> dict:
+    """
+    Store a file's content once however often it is uploaded. The upload
+    is already spooled on the server, so its plaintext is hashed with a
+    keyed hash before anything is sent: content that is already stored
+    costs no S3 requests and the share references the stored blob, while
+    new content is read again from the spool, encrypted and uploaded.
+    Returns the object's fields for the metadata record.
+    """
+    hasher = encryption_manager.content_hasher()
+    async for piece in pieces:
+        await cpu_pool.run(hasher.update, piece)
+    content_hash = hasher.hexdigest()
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=expiration)
+
+    blob = await run_store(blob_index.acquire, content_hash, expires_at)
+    if blob is None:
+        # Blobs are shared between shares, so their headers carry no filename
+        data_key, key_fields = object_data_key(None)
+        content = CompressedStream(reread_chunks(spooled), content_type, filename)
+        encryptor = encryption_manager.new_encryptor(
+            header_metadata({"content_type": content_type}, await content.choose_codec()), data_key=data_key
+        )
+        key = f"blobs/{secrets.token_hex(16)}"
+        metadata = {"content_type": content_type, "encryption_format": "chunked-v2"}
+        await s3_manager.upload_stream(encryption_manager.encrypt_stream(content.stream(), encryptor), key, metadata)
+        blob = await run_store(
+            blob_index.register,
+            content_hash,
+            {"key": key, **stored_fields(content, encryptor), **key_fields},
+            expires_at,
+        )
+        if blob["key"] != key:
+            # An identical upload finished first; use its copy
+            await s3_manager.delete_files([key])
+    return {
+        "filename": filename,
+        "content_type": content_type,
+        **{field: blob[field] for field in ("key", "size", "encoded_size", "header", "data_key") if field in blob},
+        "blob": content_hash,
+    }
+
+async def store_file(file_key: str, pieces: AsyncIterable[bytes], filename: str, content_type: str,
+                     expiration: int, data_key: Optional[bytes] = None,
+                     spooled: Optional[UploadFile] = None) -> dict:
+    """
+    Store an uploaded file. Its content is deduplicated when the upload it
+    was read from (spooled) can be read again and the share is not
+    password-protected.
+    """
+    if DEDUP_ENABLED and data_key is None and spooled is not None:
+        return await deduplicate_to_s3(pieces, spooled, filename, content_type, expiration)
+    return await encrypt_to_s3(file_key, pieces, filename, content_type, expiration, data_key)
+
+EXPIRATION_POLICIES = {
+    "delete_after_first_download": 300,  # 5 minutes
+    "store_1_hour": 3600,  # 1 hour
+    "store_1_day": 86400,  # 1 day
+}
+POLICY_NAMES = {seconds: policy for policy, seconds in EXPIRATION_POLICIES.items()}
+
+def expiration_seconds(expiration_policy: str) -> int:
+    """Seconds a share is kept for an expiration policy."""
+    if expiration_policy not in EXPIRATION_POLICIES:
+        raise HTTPException(status_code=400, detail="Invalid expiration policy")
+    return EXPIRATION_POLICIES[expiration_policy]
+
+def plan_parts(size: int, chunk_size: int) -> Tuple[int, int]:
+    """
+    Split a file into multipart upload parts of whole encryption chunks.
+    Returns (chunks per part, number of parts); every part but the last
+    reaches S3's minimum part size.
+    """
+    chunks = chunk_count(size, chunk_size)
+    part_chunks = max(-(-S3_PART_SIZE // chunk_size), -(-chunks // S3_MAX_PARTS))
+    return part_chunks, -(-chunks // part_chunks)
+
+async def protect_share(password: Optional[str]) -> Tuple[Optional[bytes], Optional[dict]]:
+    """
+    For a password-protected share, create the data key its files are
+    encrypted with and the record fields holding the password hash and
+    that key wrapped with the password. Returns (None, None) otherwise.
+    """
+    if not password:
+        return None, None
+    data_key, _ = encryption_manager.generate_data_key()
+    return data_key, await password_verifier.protect(password, data_key)
+
+async def save_upload_session(file_id: str, session: dict, protection: Optional[dict] = None) -> datetime:
+    """Record an unfinished upload so it can be resumed, or aborted once stale."""
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=UPLOAD_SESSION_TTL)
+    session = {**session, **(protection or {}), "expires_at": expires_at}
+    await run_store(upload_session_store.put, file_id, session)
+    upload_session_reaper.notify(expires_at)
+    return expires_at
+
+def session_record(session: dict) -> dict:
+    """The share record for a completed upload session."""
+    record = {field: session[field] for field in ("key", "filename", "content_type", "size", "header")}
+    if "password" in session:
+        # Only the password unlocks the data key of a protected share
+        record["password"] = session["password"]
+        record["password_data_key"] = session["password_data_key"]
+    elif "data_key" in session:
+        record["data_key"] = session["data_key"]
+    if "preview" in session:
+        record["preview"] = session["preview"]
+    return record
+
+def replace_reservation(file_id: str, record: dict) -> bool:
+    """Swap an ID's reservation for its share record, unless the reservation has lapsed."""
+    pending = metadata_store.get(file_id)
+    return bool(pending and pending.get("pending") and metadata_store.replace(file_id, pending, record))
+
+async def save_record(file_id: str, record: dict, expiration: int, protection: Optional[dict] = None) -> None:
+    """
+    Record an uploaded share in the metadata store, in place of its ID's
+    reservation. If that has lapsed the ID may belong to another share by
+    now, so the upload is removed instead and 410 raised.
+    """
+    # Store metadata in the metadata store with timezone-aware datetime
+    expiration_time = datetime.now(timezone.utc) + timedelta(seconds=expiration)
+    policy = POLICY_NAMES.get(expiration, "custom")
+    record = {**record, **(protection or {}), "policy": policy, "expires_at": expiration_time}
+    try:
+        saved = await run_store(replace_reservation, file_id, record)
+    except Exception:
+        # Nothing would ever point at the upload's objects
+        await discard_upload(record)
+        raise
+    if not saved:
+        logger.warning("Upload outlived its share ID reservation", extra={"file_id": file_id})
+        await discard_upload(record)
+        raise HTTPException(status_code=410, detail="Upload has expired")
+    expiry_reaper.notify(expiration_time)
+    SHARES_CREATED.labels(policy).inc()
+
+async def upload_to_s3(file: UploadFile, expiration: int, password: Optional[str] = None) -> dict:
+    """Upload a file to S3 and return its metadata."""
+    file_id = await allocate_id()
+    file_key = f"{file_id}/{file.filename}"
+
+    try:
+        data_key, protection = await protect_share(password)
+        content_type = file.content_type or "application/octet-stream"
+        preview = PreviewCapture(read_chunks(file), content_type, file.filename)
+        if file.size is not None and file.size <= INLINE_MAX_SIZE:
+            record = await encrypt_inline(preview.stream(), file.filename, content_type, data_key)
+        else:
+            record = await store_file(
+                file_key, preview.stream(), file.filename, content_type, expiration, data_key, spooled=file
+            )
+        record.update(await encrypt_preview(preview, data_key))
+    except BaseException:
+        await run_store(release_id, file_id)
+        raise
+    await save_record(file_id, record, expiration, protection)
+
     return {"file_id": file_id, "message": "File uploaded successfully!"}
 
 @app.post("/upload/")
@@ -82,173 +411,737 @@ async def upload(
     password: str = Form(None),  # Add optional password parameter
 ):
     """Handle file uploads with expiration policies."""
+    observe_request_parse()
+    with active("upload"):
+        return await store_upload(files, expiration_policy, text_content, password)
+
+async def store_upload(files: List[UploadFile], expiration_policy: str, text_content: Optional[str],
+                       password: Optional[str]) -> dict:
+    """Encrypt and store the files and text of a form upload."""
     uploads = []
-    expiration = 0
+
+    # Turn the upload away early if encryption work is already backed up
+    cpu_pool.check_capacity()
 
     # Determine expiration time based on policy
-    if expiration_policy == "delete_after_first_download":
-        expiration = 300  # 5 minutes
-    elif expiration_policy == "store_1_hour":
-        expiration = 3600  # 1 hour
-    elif expiration_policy == "store_1_day":
-        expiration = 86400  # 1 day
-    else:
-        raise HTTPException(status_code=400, detail="Invalid expiration policy")
+    expiration = expiration_seconds(expiration_policy)
 
     # Case 1: Only text content
     if text_content and (not files or (len(files) == 1 and not files[0].filename)):
         # Create text file in memory
+        encoded = text_content.encode()
         text_file = UploadFile(
             filename="shared-text.txt",
-            file=BytesIO(text_content.encode()),
+            file=BytesIO(encoded),
+            size=len(encoded),
+            headers=Headers({"content-type": "text/plain"}),
         )
-        result = upload_to_s3(text_file, expiration)
-        if password:
-            # Store password hash in files_db
-            files_db[result["file_id"]]["password"] = password
+        result = await upload_to_s3(text_file, expiration, password)
         uploads.append(result)
 
     # Case 2: Single file, no text
     elif len(files) == 1 and files[0].filename and not text_content:
         file = files[0]
-        result = upload_to_s3(file, expiration)
-        if password:
-            # Store password hash in files_db
-            files_db[result["file_id"]]["password"] = password
+        result = await upload_to_s3(file, expiration, password)
         uploads.append(result)
 
     # Case 3 & 4: Multiple files or files with text
     elif len(files) > 0:
-        # Create a ZIP file
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w") as zipf:
-            # Add text content if present
-            if text_content:
-                zipf.writestr("shared-text.txt", text_content)
-            
-            # Add all files
-            for file in files:
-                if file.filename:  # Skip empty files
-                    file_content = await file.read()
-                    zipf.writestr(file.filename, file_content)
-                    await file.seek(0)
-        
-        zip_buffer.seek(0)
-
-        # Upload the ZIP file to S3
-        file_id = generate_id(length=6)
-        zip_file_key = f"{file_id}/uploaded_files.zip"
-        
-        # Get ZIP content
-        zip_content = zip_buffer.getvalue()
-        
-        # Encrypt the ZIP content
-        encrypted_data, iv, tag = encryption_manager.encrypt_data(zip_content)
-        
-        # Combine encrypted data, IV, and tag
-        combined_data = iv + tag + encrypted_data
-        
-        # Upload encrypted ZIP file with metadata
-        metadata = {
-            "expiration": str(expiration),
-            "original_filename": "uploaded_files.zip",
-            "content_type": "application/zip",
-            "encryption_iv": base64.b64encode(iv).decode(),
-            "encryption_tag": base64.b64encode(tag).decode()
-        }
-        s3_manager.upload_file(combined_data, zip_file_key, metadata)
+        # Add text content if present, then all files (skipping empty ones)
+        entries = []
+        if text_content:
+            entries.append(UploadFile(
+                filename="shared-text.txt",
+                file=BytesIO(text_content.encode()),
+                headers=Headers({"content-type": "text/plain"}),
+            ))
+        entries.extend(file for file in files if file.filename)
 
-        # Store metadata for the ZIP file
-        expiration_time = datetime.now(timezone.utc) + timedelta(seconds=expiration)
-        files_db[file_id] = {
-            "key": zip_file_key,
+        # Store every file as its own encrypted object; the manifest of
+        # members lets single files be served without the whole bundle,
+        # and the ZIP is built on the fly when the bundle is downloaded
+        file_id = await allocate_id()
+        members = []
+        try:
+            data_key, protection = await protect_share(password)
+            for index, file in enumerate(entries):
+                content_type = file.content_type or "application/octet-stream"
+                preview = PreviewCapture(read_chunks(file), content_type, file.filename)
+                member = await store_file(
+                    f"{file_id}/{index}/{file.filename}",
+                    preview.stream(),
+                    file.filename,
+                    content_type,
+                    expiration,
+                    data_key,
+                    spooled=file,
+                )
+                members.append(member)
+                member.update(await encrypt_preview(preview, data_key))
+        except BaseException:
+            await discard_upload({"members": members})
+            await run_store(release_id, file_id)
+            raise
+        await save_record(file_id, {
             "filename": "uploaded_files.zip",
-            "expires_at": expiration_time,
-        }
-        if password:
-            files_db[file_id]["password"] = password
+            "content_type": "application/zip",
+            "members": members,
+        }, expiration, protection)
         uploads.append({"file_id": file_id, "message": "ZIP file uploaded successfully!"})
 
     return {"uploads": uploads}
 
+class CompletedPart(BaseModel):
+    part_number: int
+    etag: str
+
+class DirectUploadCompletion(BaseModel):
+    parts: List[CompletedPart]
+
+@app.post("/upload/direct/")
+async def create_direct_upload(
+    filename: str = Form(...),
+    size: int = Form(...),
+    content_type: str = Form("application/octet-stream"),
+    expiration_policy: str = Form("delete_after_first_download"),
+    password: str = Form(None),
+):
+    """
+    Start an upload that the browser encrypts and sends straight to S3.
+    Returns a per-file data key, the stream header and presigned URLs for
+    every part; part 1 starts with the header, and each part holds
+    part_chunks encrypted chunks. The returned token must be sent as
+    X-Upload-Token to complete the upload.
+    """
+    if not DIRECT_UPLOADS_ENABLED:
+        raise HTTPException(status_code=404, detail="Direct uploads are not enabled")
+    if size < 0:
+        raise HTTPException(status_code=400, detail="Invalid file size")
+    check_part_upload(filename, content_type)
+    expiration = expiration_seconds(expiration_policy)
+
+    file_id = await allocate_id()
+    try:
+        return await start_direct_upload(file_id, filename, size, content_type, expiration, password)
+    except BaseException:
+        await run_store(release_id, file_id)
+        raise
+
+async def start_direct_upload(file_id: str, filename: str, size: int, content_type: str,
+                              expiration: int, password: Optional[str]) -> dict:
+    """Create the multipart upload and session for a direct upload."""
+    file_key = f"{file_id}/{filename}"
+    data_key, wrapped_key = encryption_manager.generate_data_key()
+    protection = await password_verifier.protect(password, data_key) if password else None
+    header = encryption_manager.new_stream_header({"filename": filename, "content_type": content_type})
+    chunk_size = parse_stream_header(header).chunk_size
+
+    part_chunks, part_count = plan_parts(size, chunk_size)
+
+    upload_id = await s3_manager.create_multipart_upload(file_key, {
+        "expiration": str(expiration),
+        "original_filename": filename,
+        "content_type": content_type,
+        "encryption_format": "chunked-v2",
+    })
+    part_urls = await asyncio.gather(*(
+        s3_manager.presign_upload_part(file_key, upload_id, part_number, UPLOAD_SESSION_TTL)
+        for part_number in range(1, part_count + 1)
+    ))
+    token = secrets.token_urlsafe(24)
+    await save_upload_session(file_id, {
+        "key": file_key,
+        "upload_id": upload_id,
+        "filename": filename,
+        "content_type": content_type,
+        "size": size,
+        "header": base64.b64encode(header).decode(),
+        "data_key": wrapped_key,
+        "expiration": expiration,
+        "part_count": part_count,
+        "token": token,
+        "direct": True,
+    }, protection)
+
+    return {
+        "file_id": file_id,
+        "token": token,
+        "header": base64.b64encode(header).decode(),
+        "data_key": base64.b64encode(data_key).decode(),
+        "chunk_size": chunk_size,
+        "part_chunks": part_chunks,
+        "part_urls": part_urls,
+    }
+
+@app.post("/upload/direct/{file_id}/complete")
+async def complete_direct_upload(file_id: str, completion: DirectUploadCompletion,
+                                 token: Optional[str] = Header(None, alias="X-Upload-Token")):
+    """Assemble the parts of a direct upload and register the share."""
+    await check_reservation(file_id)
+    if not valid_token(await run_store(upload_session_store.get, file_id), token, direct=True):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    # Claim the session so a concurrent completion or the reaper cannot also use it
+    session = await run_store(upload_session_store.consume, file_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+    parts = sorted(completion.parts, key=lambda part: part.part_number)
+    if [part.part_number for part in parts] != list(range(1, session["part_count"] + 1)):
+        await run_store(upload_session_store.put, file_id, session)
+        raise HTTPException(status_code=400, detail="Missing or unexpected upload parts")
+    try:
+        await s3_manager.complete_multipart_upload(
+            session["key"],
+            session["upload_id"],
+            [{"ETag": part.etag, "PartNumber": part.part_number} for part in parts],
+        )
+    except Exception:
+        await run_store(upload_session_store.put, file_id, session)
+        raise
+
+    # The parts were written by the client: check they add up to the declared file
+    header = base64.b64decode(session["header"])
+    parsed = parse_stream_header(header)
+    expected = encrypted_size(session["size"], parsed.chunk_size, parsed.size)
+    if await s3_manager.get_file_size(session["key"]) != expected:
+        await s3_manager.delete_file(session["key"])
+        raise HTTPException(status_code=400, detail="Uploaded data does not match the declared size")
+
+    await save_record(file_id, session_record(session), session["expiration"])
+
+    return {"uploads": [{"file_id": file_id, "message": "File uploaded successfully!"}]}
+
+def valid_token(session: Optional[dict], token: Optional[str], direct: bool = False) -> bool:
+    """Whether an upload session of the given kind exists and token is its token."""
+    return (
+        session is not None
+        and session.get("direct", False) == direct
+        # Direct sessions started before they had tokens cannot be completed
+        and "token" in session
+        and hmac.compare_digest(session["token"], token or "")
+    )
+
+async def get_upload_session(file_id: str, token: Optional[str]) -> dict:
+    """Look up a resumable upload session, checking its token."""
+    session = await run_store(upload_session_store.get, file_id)
+    if not valid_token(session, token):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+@app.post("/upload/sessions/")
+async def create_upload_session(
+    filename: str = Form(...),
+    size: int = Form(...),
+    content_type: str = Form("application/octet-stream"),
+    expiration_policy: str = Form("delete_after_first_download"),
+    password: str = Form(None),
+):
+    """
+    Start a resumable upload. The file is sent as chunk_count chunks of
+    chunk_size bytes (the last may be shorter) that can be PUT in any
+    order and in parallel; each becomes one part of an S3 multipart upload.
+    """
+    if size < 0:
+        raise HTTPException(status_code=400, detail="Invalid file size")
+    check_part_upload(filename, content_type)
+    expiration = expiration_seconds(expiration_policy)
+
+    file_id = await allocate_id()
+    try:
+        return await start_upload_session(file_id, filename, size, content_type, expiration, password)
+    except BaseException:
+        await run_store(release_id, file_id)
+        raise
+
+async def start_upload_session(file_id: str, filename: str, size: int, content_type: str,
+                               expiration: int, password: Optional[str]) -> dict:
+    """Create the multipart upload and session for a resumable upload."""
+    file_key = f"{file_id}/{filename}"
+    data_key, protection = await protect_share(password)
+    data_key, key_fields = object_data_key(data_key)
+    header = encryption_manager.new_stream_header({"filename": filename, "content_type": content_type})
+    part_chunks, part_count = plan_parts(size, encryption_manager.chunk_size)
+    upload_id = await s3_manager.create_multipart_upload(file_key, {
+        "expiration": str(expiration),
+        "original_filename": filename,
+        "content_type": content_type,
+        "encryption_format": "chunked-v2",
+    })
+    token = secrets.token_urlsafe(24)
+    session = {
+        "key": file_key,
+        "upload_id": upload_id,
+        "filename": filename,
+        "content_type": content_type,
+        "size": size,
+        "header": base64.b64encode(header).decode(),
+        "expiration": expiration,
+        "part_chunks": part_chunks,
+        "part_count": part_count,
+        "token": token,
+        # Chunks arrive without the password, so the session keeps the key wrapped with the master key
+        "data_key": key_fields.get("data_key") or encryption_manager.wrap_data_key(data_key),
+    }
+    await save_upload_session(file_id, session, protection)
+
+    return {
+        "file_id": file_id,
+        "token": token,
+        "chunk_size": part_chunks * encryption_manager.chunk_size,
+        "chunk_count": part_count,
+    }
+
+@app.put("/upload/sessions/{file_id}/chunks/{index}")
+async def upload_session_chunk(file_id: str, index: int, request: Request,
+                               token: Optional[str] = Header(None, alias="X-Upload-Token")):
+    """Receive, encrypt and store one chunk of a resumable upload."""
+    cpu_pool.check_capacity()
+    session = await get_upload_session(file_id, token)
+    if not 0 <= index < session["part_count"]:
+        raise HTTPException(status_code=400, detail="Invalid chunk index")
+
+    header = base64.b64decode(session["header"])
+    plain_chunk_size = session["part_chunks"] * parse_stream_header(header).chunk_size
+    expected = min(plain_chunk_size, session["size"] - index * plain_chunk_size)
+    plaintext = bytearray()
+    async for piece in request.stream():
+        plaintext += piece
+        if len(plaintext) > expected:
+            break
+    observe_request_parse()
+    if len(plaintext) != expected:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+    count_bytes("in", expected)
+
+    # Chunk nonces depend only on their index, so parts encrypt independently
+    final = index == session["part_count"] - 1
+    data_key = encryption_manager.unwrap_data_key(session["data_key"]) if "data_key" in session else None
+    encryptor = encryption_manager.new_encryptor(
+        header=header, first_index=index * session["part_chunks"], data_key=data_key
+    )
+    with active("upload"):
+        with timed("encrypt"):
+            body = await cpu_pool.run(encryptor.update, bytes(plaintext))
+            body += await cpu_pool.run(encryptor.finalize, final)
+        if index == 0:
+            body = header + body
+        await s3_manager.upload_part(session["key"], session["upload_id"], index + 1, body)
+    if index == 0 and "preview" not in session:
+        preview = PreviewCapture(empty_stream(), session["content_type"], session["filename"])
+        preview.add(bytes(plaintext))
+        # Without a password the session's data key is the file's own, kept with the file only
+        fields = await encrypt_preview(preview, data_key if "password" in session else None)
+        if fields:
+            # Leaves a session that was completed or changed meanwhile alone
+            await run_store(upload_session_store.replace, file_id, session, {**session, **fields})
+    return {"index": index, "size": expected}
+
+@app.get("/upload/sessions/{file_id}")
+async def upload_session_status(file_id: str, token: Optional[str] = Header(None, alias="X-Upload-Token")):
+    """Report which chunks of a resumable upload have been received."""
+    session = await get_upload_session(file_id, token)
+    parts = await s3_manager.list_parts(session["key"], session["upload_id"])
+    header = base64.b64decode(session["header"])
+    return {
+        "file_id": file_id,
+        "chunk_size": session["part_chunks"] * parse_stream_header(header).chunk_size,
+        "chunk_count": session["part_count"],
+        "received": [part["PartNumber"] - 1 for part in parts],
+    }
+
+@app.post("/upload/sessions/{file_id}/complete")
+async def complete_upload_session(file_id: str, token: Optional[str] = Header(None, alias="X-Upload-Token")):
+    """Assemble a resumable upload once every chunk is received and register the share."""
+    await get_upload_session(file_id, token)
+    await check_reservation(file_id)
+    # Claim the session so a concurrent completion or the reaper cannot also use it
+    session = await run_store(upload_session_store.consume, file_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    try:
+        # S3 keeps track of the received parts, so no per-chunk bookkeeping is needed here
+        parts = await s3_manager.list_parts(session["key"], session["upload_id"])
+        missing = sorted(set(range(session["part_count"])) - {part["PartNumber"] - 1 for part in parts})
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Missing chunks: {missing}")
+        await s3_manager.complete_multipart_upload(session["key"], session["upload_id"], parts)
+    except Exception:
+        await run_store(upload_session_store.put, file_id, session)
+        raise
+
+    await save_record(file_id, session_record(session), session["expiration"])
+
+    return {"uploads": [{"file_id": file_id, "message": "File uploaded successfully!"}]}
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single-range HTTP Range header into an inclusive (start, end).
+    Returns None when the whole file should be sent and raises 416 for
+    ranges that cannot be satisfied.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes="):].strip()
+    if "," in spec:
+        # Multiple ranges are not supported; fall back to the full file
+        return None
+    start_text, _, end_text = spec.partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            start = size - int(end_text)
+            end = size - 1
+    except ValueError:
+        return None
+    start = max(start, 0)
+    end = min(end, size - 1)
+    if start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+async def stream_decrypted(file_data: dict, start: int = 0, end: Optional[int] = None,
+                           cached: bool = False, data_key: Optional[bytes] = None) -> AsyncIterator[bytes]:
+    """
+    Stream the plaintext bytes start..end (inclusive) of a stored file,
+    as stored: still compressed if it was compressed on upload.
+    Only the encrypted chunks covering the range are fetched from S3,
+    through the object cache when cached is set. data_key is the share's
+    data key when it was unlocked with a password.
+    """
+    header = base64.b64decode(file_data["header"])
+    parsed = parse_stream_header(header)
+    chunk_size = parsed.chunk_size
+    size = file_data.get("encoded_size", file_data["size"])
+    if end is None:
+        end = size - 1
+    if end < start:
+        return empty_stream()
+
+    first_index = start // chunk_size
+    last_index = end // chunk_size
+    sealed_size = chunk_size + TAG_SIZE
+    object_size = encrypted_size(size, chunk_size, len(header))
+    byte_range = (
+        len(header) + first_index * sealed_size,
+        min(len(header) + (last_index + 1) * sealed_size, object_size) - 1,
+    )
+    if "inline" in file_data:
+        body = inline_stream(base64.b64decode(file_data["inline"])[byte_range[0]:byte_range[1] + 1])
+    elif cached and object_cache.enabled:
+        # The nonce prefix is unique per object, so it versions the cached blocks
+        body = await object_cache.stream(file_data["key"], parsed.nonce_prefix.hex(), byte_range, object_size)
+    else:
+        body = await s3_manager.stream_file(file_data["key"], byte_range)
+    # Files are encrypted with their own data key; ones stored before per-file keys with the master key
+    if data_key is None and "data_key" in file_data:
+        data_key = encryption_manager.unwrap_data_key(file_data["data_key"])
+    decryptor = encryption_manager.new_decryptor(
+        header, first_index, chunk_count(size, chunk_size) - 1, data_key
+    )
+
+    async def generate() -> AsyncIterator[bytes]:
+        skip = start - first_index * chunk_size
+        remaining = end - start + 1
+
+        def trim(plaintext: bytes) -> bytes:
+            nonlocal skip, remaining
+            if skip:
+                dropped = min(skip, len(plaintext))
+                plaintext = plaintext[dropped:]
+                skip -= dropped
+            plaintext = plaintext[:max(remaining, 0)]
+            remaining -= len(plaintext)
+            return plaintext
+
+        async for piece in body:
+            with timed("decrypt"):
+                plaintext = trim(await cpu_pool.run(decryptor.update, piece))
+            if plaintext:
+                yield plaintext
+        with timed("decrypt"):
+            plaintext = trim(await cpu_pool.run(decryptor.finalize))
+        if plaintext:
+            yield plaintext
+        if remaining > 0:
+            raise ValueError("Encrypted stream is truncated")
+
+    return generate()
+
+async def stream_content(file_data: dict, cached: bool = False,
+                         data_key: Optional[bytes] = None) -> AsyncIterator[bytes]:
+    """Stream the whole plaintext of a stored file, decompressing it if it was compressed."""
+    body = await stream_decrypted(file_data, cached=cached, data_key=data_key)
+    codec = content_encoding(file_data)
+    return decompress_stream(body, codec) if codec else body
+
+async def slice_stream(body: AsyncIterator[bytes], start: int, end: int) -> AsyncIterator[bytes]:
+    """The bytes start..end (inclusive) of a body stream, read from its beginning."""
+    offset = 0
+    try:
+        async for piece in body:
+            if offset + len(piece) > start:
+                yield piece[max(start - offset, 0):end + 1 - offset]
+            offset += len(piece)
+            if offset > end:
+                break
+    finally:
+        await body.aclose()
+
+async def inline_stream(data: bytes) -> AsyncIterator[bytes]:
+    """A body stream of bytes already in memory."""
+    yield data
+
+async def empty_stream() -> AsyncIterator[bytes]:
+    """An empty body stream."""
+    return
+    yield
+
+def is_single_download(file_data: dict, current_time: datetime) -> bool:
+    """Whether the file uses the delete_after_first_download policy."""
+    if "policy" in file_data:
+        return file_data["policy"] == "delete_after_first_download"
+    # Records saved before policies were recorded: only the
+    # delete_after_first_download policy expires within 5 minutes
+    return (file_data["expires_at"] - current_time) <= timedelta(seconds=300)
+
+def error_response(status_code: int, error: str, headers: Optional[dict] = None) -> JSONResponse:
+    """Build a JSON error response."""
+    return JSONResponse(
+        status_code=status_code,
+        content={"error": error},
+        headers={**(headers or {}), "Content-Type": "application/json"}
+    )
+
+async def get_share(file_id: str, password: Optional[str], current_time: datetime) -> Tuple[dict, Optional[bytes]]:
+    """
+    Look up a share, checking that it has not expired and that the password
+    matches. Raises HTTPException otherwise. Returns the record and, for
+    shares whose data key is wrapped with the password, that data key.
+    """
+    file_data = await find_share(file_id, current_time)
+    return file_data, await unlock_share(file_id, password, file_data)
+
+async def find_share(file_id: str, current_time: datetime) -> dict:
+    """Look up a share's record, raising HTTPException if there is none or it has expired."""
+    file_data = await run_store(metadata_store.get, file_id)
+    # Pending records are IDs reserved for uploads still in progress
+    if not file_data or file_data.get("pending"):
+        logger.info("File not found", extra={"file_id": file_id})
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Check if the file has expired
+    if current_time > file_data["expires_at"]:
+        logger.info("File has expired", extra={"file_id": file_id})
+        try:
+            # The reaper or another request may be removing it already
+            if await run_store(metadata_store.consume, file_id):
+                object_cache.discard(object_keys(file_data))
+                await s3_manager.delete_files(object_keys(file_data))
+                await release_blobs(file_data)
+        except Exception:
+            logger.exception("Error deleting expired file", extra={"file_id": file_id})
+        raise HTTPException(status_code=410, detail="File has expired")
+    return file_data
+
+async def unlock_share(file_id: str, password: Optional[str], file_data: dict) -> Optional[bytes]:
+    """
+    Check the password of a share that has one, raising HTTPException if it
+    is missing or wrong. Returns the data key the password unwraps, or None.
+    """
+    if "password" not in file_data:
+        return None
+    if not password:
+        raise HTTPException(status_code=401, detail="Password required for this file")
+    return await password_verifier.verify(file_id, password, file_data)
+
+async def claim_share(file_id: str) -> dict:
+    """
+    Atomically claim a delete_after_first_download share so that concurrent
+    requests (on any worker) cannot both get the file. Returns its record.
+    """
+    record = await run_store(metadata_store.consume, file_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="File not found")
+    return record
+
+async def claim_member(file_id: str, filename: str) -> dict:
+    """
+    Atomically take one file out of a delete_after_first_download bundle,
+    leaving the others for later requests; the last one consumes the
+    bundle. Returns a record holding just the member taken.
+    """
+    while True:
+        record = await run_store(metadata_store.get, file_id)
+        members = record.get("members", []) if record else []
+        member = next((m for m in members if m["filename"] == filename), None)
+        if member is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        rest = [m for m in members if m is not member]
+        if not rest:
+            return {"members": (await claim_share(file_id))["members"]}
+        # Retry if the bundle changed meanwhile, e.g. another member was taken
+        if await run_store(metadata_store.replace, file_id, record, {**record, "members": rest}):
+            return {"members": [member]}
+
+async def restore_members(file_id: str, file_data: dict, claimed: dict) -> None:
+    """
+    Put members taken from a delete_after_first_download bundle back when
+    sending them failed, recreating the bundle if taking them consumed it.
+    """
+    while True:
+        record = await run_store(metadata_store.get, file_id)
+        if record is None:
+            if await run_store(metadata_store.reserve, file_id, {**file_data, "members": claimed["members"]}):
+                return
+        # Retry if the bundle changed meanwhile, e.g. another member was taken or put back
+        elif await run_store(metadata_store.replace, file_id, record,
+                             {**record, "members": record["members"] + claimed["members"]}):
+            return
+
+async def delete_after_download(file_data: dict) -> None:
+    """Remove a consumed share's objects from S3 once it has been downloaded."""
+    keys = object_keys(file_data)
+    object_cache.discard(keys)
+    try:
+        failed = await s3_manager.delete_files(keys)
+        if failed:
+            logger.warning("Error deleting files after download", extra={"keys": failed})
+        # Released last: deduplicated content outlives a lost reference until it expires
+        await release_blobs(file_data)
+    except Exception:
+        logger.exception("Error deleting files after download", extra={"keys": keys})
+
+async def consume_stream(body: AsyncIterable[bytes], file_data: dict) -> AsyncIterator[bytes]:
+    """
+    Stream a claimed single-download share, then remove its objects even
+    if sending fails: the record is gone once claimed, so nothing else,
+    not even the reaper, would ever find them again.
+    """
+    try:
+        async for piece in body:
+            yield piece
+    finally:
+        # Finish the removal even when the response is cancelled, e.g. on disconnect
+        await asyncio.shield(delete_after_download(file_data))
+
+async def read_text(file_id: str, file_data: dict, stored: dict, single_download: bool,
+                    data_key: Optional[bytes] = None) -> str:
+    """Read a small stored text file whole, consuming single-download shares."""
+    if single_download:
+        await claim_share(file_id)
+    logger.debug("Reading text file", extra={"file_id": file_id, "key": stored.get("key")})
+    try:
+        file_content = b"".join([piece async for piece in await stream_content(stored, cached=not single_download, data_key=data_key)])
+    except Exception:
+        if single_download:
+            await run_store(metadata_store.put, file_id, file_data)
+        raise
+    count_bytes("out", len(file_content))
+    # Only delete for the delete_after_first_download policy,
+    # after password validation was successful
+    if single_download:
+        await delete_after_download(file_data)
+    return file_content.decode('utf-8')
+
+async def serve_file(file_id: str, file_data: dict, stored: dict, range_header: Optional[str],
+                     single_download: bool, data_key: Optional[bytes] = None,
+                     accept_encoding: Optional[str] = None) -> StreamingResponse:
+    """
+    Stream a stored file (or a byte range of it), decrypting chunk by chunk.
+    Compressed files are sent still compressed if the client accepts their
+    codec and decompressed while streaming otherwise; a byte range of one
+    is decompressed from its start. Single-download shares are sent whole,
+    and consumed by the request.
+    """
+    # The content type is recorded at upload time, so a download is a single GET
+    file_name = stored["filename"]
+    content_type = stored.get("content_type", "application/octet-stream")
+    size = stored["size"]
+    codec = content_encoding(stored)
+    # Every request for a single-download share consumes it, so a range
+    # of one could otherwise be fetched again and again
+    ranged = not single_download
+    byte_range = parse_range(range_header, size) if ranged else None
+    start, end = byte_range or (0, size - 1)
+    passthrough = codec is not None and byte_range is None and accepts_encoding(accept_encoding, codec)
+
+    if single_download:
+        # A bundle member is taken on its own, the bundle's other files stay
+        claimed = await claim_share(file_id) if stored is file_data else await claim_member(file_id, file_name)
+    logger.debug("Streaming file", extra={"file_id": file_id, "key": stored.get("key")})
+    try:
+        if codec is None:
+            body = await stream_decrypted(stored, start, end, cached=not single_download, data_key=data_key)
+        elif passthrough:
+            body = await stream_decrypted(stored, cached=not single_download, data_key=data_key)
+        else:
+            body = await stream_content(stored, cached=not single_download, data_key=data_key)
+            if byte_range:
+                # Offsets into a compressed stream cannot be mapped to the original bytes
+                body = slice_stream(body, start, end)
+    except Exception:
+        if single_download and stored is file_data:
+            await run_store(metadata_store.put, file_id, file_data)
+        elif single_download:
+            await restore_members(file_id, file_data, claimed)
+        raise
+
+    headers = {
+        "Content-Disposition": f'attachment; filename="{file_name}"',
+        "Content-Type": content_type,
+        "Content-Length": str(stored["encoded_size"] if passthrough else end - start + 1),
+        "Accept-Ranges": "bytes" if ranged else "none",
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    if codec is not None:
+        headers["Vary"] = "Accept-Encoding"
+    if passthrough:
+        headers["Content-Encoding"] = codec
+
+    if single_download:
+        body = consume_stream(body, claimed)
+    return StreamingResponse(
+        metered_download(body),
+        status_code=206 if byte_range else 200,
+        media_type=content_type,
+        headers=headers,
+    )
+
+async def stream_bundle(members: List[dict], cached: bool = False,
+                        data_key: Optional[bytes] = None) -> AsyncIterator[bytes]:
+    """Build a bundle's ZIP file on the fly from its separately stored members."""
+    async def entries():
+        for member in members:
+            yield member["filename"], await stream_content(member, cached=cached, data_key=data_key)
+
+    async for piece in stream_zip(entries()):
+        yield piece
+
 @app.get("/download/{file_id}")
-async def download(file_id: str, password: str = None):
+async def download(file_id: str, password: str = None, range_header: Optional[str] = Header(None, alias="Range"),
+                   accept_encoding: Optional[str] = Header(None, alias="Accept-Encoding")):
     """Download a file with proper decryption and content type handling."""
     try:
-        print(f"Attempting to download file with ID: {file_id}")
-        file_data = files_db.get(file_id)
-        if not file_data:
-            print(f"File ID {file_id} not found in files_db")
-            return JSONResponse(
-                status_code=404,
-                content={"error": "File not found"},
-                headers={"Content-Type": "application/json"}
-            )
-
-        # Check if the file has expired
+        logger.debug("Download requested", extra={"file_id": file_id})
+        cpu_pool.check_capacity()
         current_time = datetime.now(timezone.utc)
-        if current_time > file_data["expires_at"]:
-            print(f"File {file_id} has expired")
-            try:
-                s3_manager.delete_file(file_data["key"])
-                del files_db[file_id]
-            except Exception as e:
-                print(f"Error deleting expired file: {str(e)}")
-            return JSONResponse(
-                status_code=410,
-                content={"error": "File has expired"},
-                headers={"Content-Type": "application/json"}
-            )
-
-        # Check if password is required and validate it
-        if "password" in file_data:
-            if not password:
-                return JSONResponse(
-                    status_code=401,
-                    content={"error": "Password required for this file"},
-                    headers={"Content-Type": "application/json"}
-                )
-            if password != file_data["password"]:
-                return JSONResponse(
-                    status_code=403,
-                    content={"error": "Incorrect password"},
-                    headers={"Content-Type": "application/json"}
-                )
+        file_data, data_key = await get_share(file_id, password, current_time)
 
-        print(f"Downloading file from S3 with key: {file_data['key']}")
-        # Get file from S3
-        encrypted_data = s3_manager.download_file(file_data["key"])
-        print("Successfully downloaded encrypted data from S3")
-        
-        # Get encryption metadata
-        print("Retrieving file metadata")
-        metadata = s3_manager.get_file_metadata(file_data["key"])
-        iv = base64.b64decode(metadata["encryption_iv"])
-        tag = base64.b64decode(metadata["encryption_tag"])
-        
-        # Extract the encrypted data (after IV and tag)
-        encrypted_content = encrypted_data[28:]  # 12 bytes IV + 16 bytes tag
-        
-        # Decrypt the file content
-        print("Decrypting file content")
-        file_content = encryption_manager.decrypt_data(encrypted_content, iv, tag)
-        print("Successfully decrypted file content")
-        
         file_name = file_data["filename"]
-        print(f"Processing file: {file_name}")
+        single_download = is_single_download(file_data, current_time)
+        members = file_data.get("members")
 
         # Handle different file types
-        if file_name == "shared-text.txt":
+        if members is None and file_name == "shared-text.txt":
             # Text content preview
-            content = file_content.decode('utf-8')
-            # Only delete if expiration is within 5 minutes (delete_after_first_download policy)
-            # and password validation was successful
-            if (file_data["expires_at"] - current_time) <= timedelta(seconds=300):
-                try:
-                    s3_manager.delete_file(file_data["key"])
-                    del files_db[file_id]
-                except Exception as e:
-                    print(f"Error deleting file after download: {str(e)}")
+            content = await read_text(file_id, file_data, file_data, single_download, data_key)
             return JSONResponse(
                 content={
                     "type": "text",
@@ -257,69 +1150,159 @@ async def download(file_id: str, password: str = None):
                 },
                 headers={"Content-Type": "application/json"}
             )
-        elif file_name == "uploaded_files.zip":
-            # Handle ZIP file
-            zip_buffer = BytesIO(file_content)
-            with zipfile.ZipFile(zip_buffer, "r") as zipf:
-                # List files in ZIP
-                file_list = zipf.namelist()
-                if len(file_list) == 1 and file_list[0] == "shared-text.txt":
-                    # If only text file in ZIP, return its content
-                    content = zipf.read(file_list[0]).decode('utf-8')
-                    # Only delete if expiration is within 5 minutes and password validation was successful
-                    if (file_data["expires_at"] - current_time) <= timedelta(seconds=300):
-                        try:
-                            s3_manager.delete_file(file_data["key"])
-                            del files_db[file_id]
-                        except Exception as e:
-                            print(f"Error deleting file after download: {str(e)}")
-                    return JSONResponse(
-                        content={"content": content},
-                        headers={"Content-Type": "application/json"}
-                    )
-                else:
-                    # Return ZIP file for download
-                    # Only delete if expiration is within 5 minutes and password validation was successful
-                    if (file_data["expires_at"] - current_time) <= timedelta(seconds=300):
-                        try:
-                            s3_manager.delete_file(file_data["key"])
-                            del files_db[file_id]
-                        except Exception as e:
-                            print(f"Error deleting file after download: {str(e)}")
-                    return StreamingResponse(
-                        BytesIO(file_content),
-                        media_type="application/zip",
-                        headers={
-                            "Content-Disposition": f'attachment; filename="{file_name}"',
-                            "Content-Type": "application/zip"
-                        }
-                    )
-        else:
+        elif members is None:
             # Handle regular file download
-            content_type = metadata.get("content_type", "application/octet-stream")
-            # Only delete if expiration is within 5 minutes and password validation was successful
-            if (file_data["expires_at"] - current_time) <= timedelta(seconds=300):
-                try:
-                    s3_manager.delete_file(file_data["key"])
-                    del files_db[file_id]
-                except Exception as e:
-                    print(f"Error deleting file after download: {str(e)}")
+            return await serve_file(file_id, file_data, file_data, range_header, single_download, data_key,
+                                    accept_encoding)
+        elif [member["filename"] for member in members] == ["shared-text.txt"]:
+            # If only text file in the bundle, return its content
+            content = await read_text(file_id, file_data, members[0], single_download, data_key)
+            return JSONResponse(
+                content={"content": content},
+                headers={"Content-Type": "application/json"}
+            )
+        else:
+            # Return the bundle as a ZIP file built while streaming
+            if single_download:
+                # Files already taken from the bundle one by one are left out
+                claimed = await claim_share(file_id)
+                body = consume_stream(stream_bundle(claimed["members"], data_key=data_key), claimed)
+            else:
+                body = stream_bundle(members, cached=True, data_key=data_key)
             return StreamingResponse(
-                BytesIO(file_content),
-                media_type=content_type,
+                metered_download(body),
+                media_type="application/zip",
                 headers={
                     "Content-Disposition": f'attachment; filename="{file_name}"',
-                    "Content-Type": content_type
-                }
+                    "Content-Type": "application/zip"
+                },
             )
 
+    except HTTPException as e:
+        return error_response(e.status_code, e.detail, e.headers)
     except Exception as e:
-        print(f"Error in download endpoint: {str(e)}")
-        return JSONResponse(
-            status_code=500,
-            content={"error": f"Error downloading file: {str(e)}"},
-            headers={"Content-Type": "application/json"}
-        )
+        logger.exception("Error in download endpoint", extra={"file_id": file_id})
+        return error_response(500, f"Error downloading file: {str(e)}")
+
+@app.get("/download/{file_id}/{member:path}")
+async def download_member(file_id: str, member: str, password: str = None,
+                          range_header: Optional[str] = Header(None, alias="Range"),
+                          accept_encoding: Optional[str] = Header(None, alias="Accept-Encoding")):
+    """
+    Download a single file from a bundle without fetching the others.
+    Each file of a single-download bundle can be downloaded once.
+    """
+    try:
+        cpu_pool.check_capacity()
+        current_time = datetime.now(timezone.utc)
+        file_data, data_key = await get_share(file_id, password, current_time)
+        stored = next((m for m in file_data.get("members", []) if m["filename"] == member), None)
+        if stored is None:
+            return error_response(404, "File not found in bundle")
+        return await serve_file(file_id, file_data, stored, range_header,
+                                is_single_download(file_data, current_time), data_key, accept_encoding)
+
+    except HTTPException as e:
+        return error_response(e.status_code, e.detail, e.headers)
+    except Exception as e:
+        logger.exception("Error in download endpoint", extra={"file_id": file_id})
+        return error_response(500, f"Error downloading file: {str(e)}")
+
+def file_listing(stored: dict) -> dict:
+    """What share listings say about one stored file."""
+    return {"filename": stored["filename"], "size": stored["size"], "content_type": stored.get("content_type")}
+
+async def read_preview(stored: dict, data_key: Optional[bytes] = None) -> str:
+    """Decrypt the preview kept in a stored file's record."""
+    body = await stream_decrypted(stored["preview"], data_key=data_key)
+    return preview_text(b"".join([piece async for piece in body]))
+
+@app.get("/contents/{file_id}")
+async def contents(file_id: str, password: str = None):
+    """List the files in a share without downloading any of them."""
+    try:
+        file_data, _ = await get_share(file_id, password, datetime.now(timezone.utc))
+        stored_files = file_data.get("members") or [file_data]
+        return {
+            "filename": file_data["filename"],
+            "files": [file_listing(f) for f in stored_files],
+        }
+
+    except HTTPException as e:
+        return error_response(e.status_code, e.detail, e.headers)
+
+@app.get("/info/{file_id}")
+async def info(file_id: str, password: str = None, preview: bool = False):
+    """
+    Describe a share from its metadata record alone: no S3 requests, no
+    decryption of its files, and single-download shares are not used up.
+    A password-protected share only says so until the password is given.
+    Files already taken one by one from a single-download bundle are no
+    longer listed. With preview set, the start of each text file is included.
+    """
+    try:
+        current_time = datetime.now(timezone.utc)
+        file_data = await find_share(file_id, current_time)
+        summary = {
+            "file_id": file_id,
+            "expires_at": file_data["expires_at"].isoformat(),
+            "single_download": is_single_download(file_data, current_time),
+            "password_required": "password" in file_data,
+        }
+        if "password" in file_data and not password:
+            return summary
+        data_key = await unlock_share(file_id, password, file_data)
+
+        files = []
+        for stored in file_data.get("members") or [file_data]:
+            listing = {**file_listing(stored), "has_preview": "preview" in stored}
+            if preview and "preview" in stored:
+                listing["preview"] = await read_preview(stored, data_key)
+                listing["preview_truncated"] = stored["preview"]["size"] < stored["size"]
+            files.append(listing)
+        return {
+            **summary,
+            "filename": file_data["filename"],
+            "content_type": file_data.get("content_type"),
+            "size": sum(listing["size"] for listing in files),
+            "files": files,
+        }
+
+    except HTTPException as e:
+        return error_response(e.status_code, e.detail, e.headers)
+    except Exception as e:
+        logger.exception("Error in info endpoint", extra={"file_id": file_id})
+        return error_response(500, f"Error reading file info: {str(e)}")
+
+def share_counts() -> dict:
+    """Active shares per expiration policy; uploads still in progress count as pending."""
+    counts = {}
+    for policy, count in metadata_store.count_by("policy").items():
+        counts[policy or "pending"] = counts.get(policy or "pending", 0) + count
+    return counts
+
+stats_collector.add_source("cpu_pool", lambda: cpu_pool.metrics)
+stats_collector.add_source("kdf_pool", lambda: kdf_pool.metrics)
+stats_collector.add_source("password", lambda: password_verifier.metrics)
+stats_collector.add_source("reaper", lambda: expiry_reaper.metrics)
+stats_collector.add_source("upload_session_reaper", lambda: upload_session_reaper.metrics)
+stats_collector.add_source("object_cache", lambda: object_cache.metrics)
+stats_collector.add_source("dedup", lambda: blob_index.metrics, METRICS_SCAN_INTERVAL)
+stats_collector.add_source("blob_reaper", lambda: blob_reaper.metrics)
+stats_collector.add_source("encryption", lambda: encryption_manager.metrics)
+stats_collector.add_source("key_rotation", lambda: key_rotator.metrics)
+stats_collector.add_labeled(
+    "shares_active", "Active shares per expiration policy", "policy", share_counts, METRICS_SCAN_INTERVAL
+)
+# Occupancy counts the metadata store, so it is reused like the share counts
+stats_collector.add_source("share_ids", lambda: id_allocator.metrics, METRICS_SCAN_INTERVAL)
+
+@app.get("/metrics")
+async def metrics():
+    """Expose metrics in the Prometheus text format."""
+    # Some gauges scan the whole metadata store, so collect off the event loop
+    body = await asyncio.get_running_loop().run_in_executor(None, generate_latest)
+    return Response(body, media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/")
 async def homepage():
@@ -0,0 +1,360 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import asyncio
+import json
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import HTTPException
+
+# Seconds a store call waits for another worker's write lock before the
+# request gives up with a 503. Calls run on threads of their own (see
+# run_store), so waiting for a lock never blocks the event loop.
+METADATA_BUSY_TIMEOUT = float(os.getenv("METADATA_BUSY_TIMEOUT", "5"))
+# Threads running metadata store calls for the event loop
+METADATA_WORKERS = int(os.getenv("METADATA_WORKERS", "8"))
+
+def object_keys(record: Dict[str, Any]) -> List[str]:
+    """
+    S3 keys of every object belonging to a record, bundle members included.
+    Deduplicated content (marked with its "blob" hash) belongs to its blob
+    record instead, and is left out.
+    """
+    if "members" in record:
+        return [member["key"] for member in record["members"] if "blob" not in member]
+    # IDs reserved for uploads that are still in progress have no objects yet
+    return [record["key"]] if "key" in record and "blob" not in record else []
+
+class MetadataStore:
+    """
+    Interface for the file metadata store.
+    Records are dicts with a timezone-aware "expires_at" and either the
+    "key" of their S3 object or, for bundles, a list of "members" that
+    each have their own "key". Small files keep their encrypted object
+    in the record itself ("inline") and have no key. IDs reserved for
+    uploads in progress hold a "pending" record instead.
+    """
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """Return the record for a file ID, or None."""
+        raise NotImplementedError
+
+    def put(self, file_id: str, record: Dict[str, Any]) -> None:
+        """Create or replace the record for a file ID."""
+        raise NotImplementedError
+
+    def reserve(self, file_id: str, record: Dict[str, Any]) -> bool:
+        """
+        Atomically create the record for a file ID unless one exists.
+        Returns whether it was created.
+        """
+        raise NotImplementedError
+
+    def delete(self, file_id: str) -> None:
+        """Remove the record for a file ID if present."""
+        self.consume(file_id)
+
+    def consume(self, file_id: str, expired_before: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+        """
+        Atomically fetch and remove the record for a file ID, if given only
+        when it expires before expired_before.
+        Of several concurrent callers exactly one gets the record.
+        """
+        raise NotImplementedError
+
+    def acquire(self, file_id: str, expires_at: datetime) -> Optional[Dict[str, Any]]:
+        """
+        Atomically add a reference to a reference-counted record (one with
+        a "refs" count), extending its expires_at to at least the given time.
+        Returns the updated record, or None if there is none.
+        """
+        raise NotImplementedError
+
+    def release(self, file_id: str, now: datetime) -> Optional[Dict[str, Any]]:
+        """
+        Atomically drop a reference to a reference-counted record. Once none
+        remain the record expires at now, for the reaper to remove unless a
+        new reference is acquired first. Returns the updated record, or None.
+        """
+        raise NotImplementedError
+
+    def replace(self, file_id: str, expected: Dict[str, Any], record: Dict[str, Any]) -> bool:
+        """
+        Atomically replace a record, if it still exists and its fields
+        (expires_at aside) are unchanged from expected.
+        Returns whether it was replaced.
+        """
+        raise NotImplementedError
+
+    def scan(self, after: Optional[str] = None, limit: int = 1000) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return up to limit (file_id, record) pairs in file ID order, starting after a file ID."""
+        raise NotImplementedError
+
+    def expiring(self, before: datetime, limit: int = 1000) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return up to limit (file_id, record) pairs expiring before a time, soonest first."""
+        raise NotImplementedError
+
+    def next_expiry(self) -> Optional[datetime]:
+        """Return the earliest expires_at of any record, or None when empty."""
+        raise NotImplementedError
+
+    def count_by(self, field: str) -> Dict[Optional[str], int]:
+        """Count records by the value of a top-level field (None when absent). Scans every record."""
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+class InMemoryMetadataStore(MetadataStore):
+    """Process-local store; only suitable for a single worker."""
+
+    def __init__(self):
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        return self._records.get(file_id)
+
+    def put(self, file_id: str, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self._records[file_id] = record
+
+    def reserve(self, file_id: str, record: Dict[str, Any]) -> bool:
+        with self._lock:
+            if file_id in self._records:
+                return False
+            self._records[file_id] = record
+            return True
+
+    def consume(self, file_id: str, expired_before: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self._records.get(file_id)
+            if record is None or (expired_before and record["expires_at"] >= expired_before):
+                return None
+            return self._records.pop(file_id)
+
+    def acquire(self, file_id: str, expires_at: datetime) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self._records.get(file_id)
+            if record is None:
+                return None
+            record = {**record, "refs": record["refs"] + 1, "expires_at": max(record["expires_at"], expires_at)}
+            self._records[file_id] = record
+            return record
+
+    def release(self, file_id: str, now: datetime) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self._records.get(file_id)
+            if record is None:
+                return None
+            record = {**record, "refs": record["refs"] - 1}
+            if record["refs"] <= 0:
+                record["expires_at"] = now
+            self._records[file_id] = record
+            return record
+
+    def replace(self, file_id: str, expected: Dict[str, Any], record: Dict[str, Any]) -> bool:
+        with self._lock:
+            current = self._records.get(file_id)
+            if current is None or {**current, "expires_at": None} != {**expected, "expires_at": None}:
+                return False
+            self._records[file_id] = record
+            return True
+
+    def scan(self, after: Optional[str] = None, limit: int = 1000) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            file_ids = sorted(file_id for file_id in self._records if after is None or file_id > after)[:limit]
+            return [(file_id, self._records[file_id]) for file_id in file_ids]
+
+    def expiring(self, before: datetime, limit: int = 1000) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            expired = [(file_id, record) for file_id, record in self._records.items() if record["expires_at"] < before]
+        expired.sort(key=lambda item: item[1]["expires_at"])
+        return expired[:limit]
+
+    def next_expiry(self) -> Optional[datetime]:
+        with self._lock:
+            return min((record["expires_at"] for record in self._records.values()), default=None)
+
+    def count_by(self, field: str) -> Dict[Optional[str], int]:
+        with self._lock:
+            values = [record.get(field) for record in self._records.values()]
+        return dict(Counter(values))
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+class SQLiteMetadataStore(MetadataStore):
+    """
+    Durable store shared by every worker on a host.
+    Uses WAL mode so readers never block the single writer, and keeps
+    expires_at in an indexed column for expiry scans. Writers wait for
+    each other, giving up after METADATA_BUSY_TIMEOUT with a 503.
+    """
+
+    def __init__(self, path: str, table: str = "files"):
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+        # Workers start together, so creating the schema may wait for the others
+        with closing(sqlite3.connect(path, timeout=30, isolation_level=None)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                " file_id TEXT PRIMARY KEY,"
+                " expires_at REAL NOT NULL,"
+                " data TEXT NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_expires_at ON {table} (expires_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=METADATA_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        try:
+            return self._connection().execute(sql, parameters)
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+
+    @staticmethod
+    def _encode(record: Dict[str, Any]) -> Tuple[float, str]:
+        data = {k: v for k, v in record.items() if k != "expires_at"}
+        return record["expires_at"].timestamp(), json.dumps(data)
+
+    @staticmethod
+    def _decode(expires_at: float, data: str) -> Dict[str, Any]:
+        record = json.loads(data)
+        record["expires_at"] = datetime.fromtimestamp(expires_at, timezone.utc)
+        return record
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        row = self._execute(
+            f"SELECT expires_at, data FROM {self.table} WHERE file_id = ?", (file_id,)
+        ).fetchone()
+        return self._decode(*row) if row else None
+
+    def put(self, file_id: str, record: Dict[str, Any]) -> None:
+        self._execute(
+            f"INSERT OR REPLACE INTO {self.table} (file_id, expires_at, data) VALUES (?, ?, ?)",
+            (file_id, *self._encode(record)),
+        )
+
+    def reserve(self, file_id: str, record: Dict[str, Any]) -> bool:
+        cursor = self._execute(
+            f"INSERT OR IGNORE INTO {self.table} (file_id, expires_at, data) VALUES (?, ?, ?)",
+            (file_id, *self._encode(record)),
+        )
+        return cursor.rowcount == 1
+
+    def consume(self, file_id: str, expired_before: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+        if expired_before is None:
+            row = self._execute(
+                f"DELETE FROM {self.table} WHERE file_id = ? RETURNING expires_at, data", (file_id,)
+            ).fetchone()
+        else:
+            row = self._execute(
+                f"DELETE FROM {self.table} WHERE file_id = ? AND expires_at < ? RETURNING expires_at, data",
+                (file_id, expired_before.timestamp()),
+            ).fetchone()
+        return self._decode(*row) if row else None
+
+    def acquire(self, file_id: str, expires_at: datetime) -> Optional[Dict[str, Any]]:
+        row = self._execute(
+            f"UPDATE {self.table} SET"
+            " data = json_set(data, '$.refs', json_extract(data, '$.refs') + 1),"
+            " expires_at = MAX(expires_at, ?)"
+            " WHERE file_id = ? RETURNING expires_at, data",
+            (expires_at.timestamp(), file_id),
+        ).fetchone()
+        return self._decode(*row) if row else None
+
+    def release(self, file_id: str, now: datetime) -> Optional[Dict[str, Any]]:
+        row = self._execute(
+            f"UPDATE {self.table} SET"
+            " data = json_set(data, '$.refs', json_extract(data, '$.refs') - 1),"
+            " expires_at = CASE WHEN json_extract(data, '$.refs') <= 1 THEN ? ELSE expires_at END"
+            " WHERE file_id = ? RETURNING expires_at, data",
+            (now.timestamp(), file_id),
+        ).fetchone()
+        return self._decode(*row) if row else None
+
+    def replace(self, file_id: str, expected: Dict[str, Any], record: Dict[str, Any]) -> bool:
+        # json() normalizes formatting, e.g. of data rewritten by json_set()
+        cursor = self._execute(
+            f"UPDATE {self.table} SET expires_at = ?, data = ? WHERE file_id = ? AND json(data) = json(?)",
+            (*self._encode(record), file_id, self._encode(expected)[1]),
+        )
+        return cursor.rowcount == 1
+
+    def scan(self, after: Optional[str] = None, limit: int = 1000) -> List[Tuple[str, Dict[str, Any]]]:
+        rows = self._execute(
+            f"SELECT file_id, expires_at, data FROM {self.table} WHERE file_id > ? ORDER BY file_id LIMIT ?",
+            (after or "", limit),
+        ).fetchall()
+        return [(file_id, self._decode(expires_at, data)) for file_id, expires_at, data in rows]
+
+    def expiring(self, before: datetime, limit: int = 1000) -> List[Tuple[str, Dict[str, Any]]]:
+        rows = self._execute(
+            f"SELECT file_id, expires_at, data FROM {self.table} WHERE expires_at < ? ORDER BY expires_at LIMIT ?",
+            (before.timestamp(), limit),
+        ).fetchall()
+        return [(file_id, self._decode(expires_at, data)) for file_id, expires_at, data in rows]
+
+    def next_expiry(self) -> Optional[datetime]:
+        row = self._execute(f"SELECT MIN(expires_at) FROM {self.table}").fetchone()
+        return datetime.fromtimestamp(row[0], timezone.utc) if row[0] is not None else None
+
+    def count_by(self, field: str) -> Dict[Optional[str], int]:
+        rows = self._execute(
+            f"SELECT json_extract(data, ?), COUNT(*) FROM {self.table} GROUP BY 1", (f"$.{field}",)
+        ).fetchall()
+        return dict(rows)
+
+    def __len__(self) -> int:
+        return self._execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+def create_metadata_store(table: str = "files") -> MetadataStore:
+    """Create the metadata store selected by METADATA_BACKEND (sqlite or memory)."""
+    backend = os.getenv("METADATA_BACKEND", "sqlite").lower()
+    if backend == "memory":
+        return InMemoryMetadataStore()
+    if backend == "sqlite":
+        return SQLiteMetadataStore(os.getenv("METADATA_DB_PATH", "swiftshare.db"), table)
+    raise ValueError(f"Unknown METADATA_BACKEND: {backend}")
+
+async def run_store(func, *args):
+    """
+    Call func(*args), a store method or a function making store calls, on
+    the metadata threads: SQLite calls may wait for other workers' writes,
+    which must not hold up the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(metadata_executor, partial(func, *args))
+
+# Create singleton instances: shares, uploads that are still in progress,
+# and deduplicated content, and the threads store calls run on
+metadata_executor = ThreadPoolExecutor(max_workers=METADATA_WORKERS, thread_name_prefix="metadata")
+metadata_store = create_metadata_store()
+upload_session_store = create_metadata_store("upload_sessions")
+blob_store = create_metadata_store("blobs")
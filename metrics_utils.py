@@ -0,0 +1,193 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from contextlib import contextmanager
+from typing import AsyncIterable, AsyncIterator, Callable, Dict, Iterator
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+
+# Minimum level of log records to write (DEBUG, INFO, WARNING, ERROR)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Seconds to reuse share counts, which scan the metadata store
+METRICS_SCAN_INTERVAL = float(os.getenv("METRICS_SCAN_INTERVAL", "30"))
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as single-line JSON objects, extra fields included."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging(level: str = LOG_LEVEL) -> None:
+    """
+    Send the app's logs to stdout as JSON lines. Records are handed to a
+    background thread through a queue, so logging never blocks the event
+    loop on a slow stdout.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger("swiftshare")
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.propagate = False
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger for one of the app's modules."""
+    return logging.getLogger(f"swiftshare.{name}")
+
+# Time spent in each stage of handling uploads and downloads
+STAGE_SECONDS = Histogram(
+    "swiftshare_stage_seconds",
+    "Time spent per operation in each processing stage",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+REQUEST_SECONDS = Histogram(
+    "swiftshare_request_seconds",
+    "Time until the response starts, per route",
+    ["method", "route", "status"],
+)
+TRANSFER_BYTES = Counter(
+    "swiftshare_transfer_bytes",
+    "Plaintext bytes received from uploads (in) and sent to downloads (out)",
+    ["direction"],
+)
+ACTIVE_TRANSFERS = Gauge(
+    "swiftshare_active_transfers",
+    "Uploads and downloads in progress",
+    ["kind"],
+)
+SHARES_CREATED = Counter(
+    "swiftshare_shares_created",
+    "Shares created, per expiration policy",
+    ["policy"],
+)
+# Work done by each background reaper (files, sessions, blobs)
+REAPER_BATCH_SIZE = Histogram(
+    "swiftshare_reaper_batch_size",
+    "Objects removed per reaper batch",
+    ["reaper"],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+REAPER_LAG_SECONDS = Histogram(
+    "swiftshare_reaper_lag_seconds",
+    "Time between the latest expiry in a reaper batch and its removal",
+    ["reaper"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 15, 30, 60, 120, 300, 600),
+)
+
+# Start time of the current request, for stages measured from the start
+request_started: contextvars.ContextVar[float] = contextvars.ContextVar("request_started")
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """Record the duration of one operation in a stage."""
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Time the enclosed block as one operation of a stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+@contextmanager
+def active(kind: str) -> Iterator[None]:
+    """Count the enclosed block as an active transfer."""
+    ACTIVE_TRANSFERS.labels(kind).inc()
+    try:
+        yield
+    finally:
+        ACTIVE_TRANSFERS.labels(kind).dec()
+
+def count_bytes(direction: str, size: int) -> None:
+    """Record plaintext bytes received or sent."""
+    TRANSFER_BYTES.labels(direction).inc(size)
+
+async def metered_download(body: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Pass a response body through, counting it as an active download and
+    recording the bytes sent and the time taken to write the response.
+    """
+    started = time.perf_counter()
+    with active("download"):
+        try:
+            async for piece in body:
+                count_bytes("out", len(piece))
+                yield piece
+        finally:
+            observe_stage("response_write", time.perf_counter() - started)
+
+class StatsCollector:
+    """
+    Exposes the counters that components already keep (their metrics
+    properties) as Prometheus gauges, read at scrape time.
+    """
+
+    def __init__(self):
+        self._sources: Dict[str, Callable[[], Dict[str, object]]] = {}
+        self._labeled: Dict[str, tuple] = {}
+        self._cache: Dict[str, tuple] = {}
+
+    def add_source(self, prefix: str, metrics: Callable[[], Dict[str, object]],
+                   cache_seconds: float = 0) -> None:
+        """Export every numeric value of metrics() as swiftshare_<prefix>_<name>, optionally reused for a while."""
+        self._sources[prefix] = (metrics, cache_seconds)
+
+    def add_labeled(self, name: str, documentation: str, label: str,
+                    values: Callable[[], Dict[str, float]], cache_seconds: float = 0) -> None:
+        """Export values() as one gauge labelled by its keys, optionally reused for a while."""
+        self._labeled[name] = (documentation, label, values, cache_seconds)
+
+    def _read(self, name: str, values: Callable, cache_seconds: float):
+        cached = self._cache.get(name)
+        if cached and time.monotonic() - cached[0] < cache_seconds:
+            return cached[1]
+        result = values()
+        self._cache[name] = (time.monotonic(), result)
+        return result
+
+    def collect(self):
+        for prefix, (metrics, cache_seconds) in self._sources.items():
+            for key, value in self._read(prefix, metrics, cache_seconds).items():
+                if isinstance(value, (int, float)):
+                    yield GaugeMetricFamily(f"swiftshare_{prefix}_{key}", f"{prefix} {key}", value=value)
+        for name, (documentation, label, values, cache_seconds) in self._labeled.items():
+            family = GaugeMetricFamily(f"swiftshare_{name}", documentation, labels=[label])
+            for key, value in self._read(f"labeled:{name}", values, cache_seconds).items():
+                family.add_metric([str(key)], value)
+            yield family
+
+configure_logging()
+
+# Create a singleton instance
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
@@ -0,0 +1,179 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import asyncio
+import base64
+import hmac
+import time
+from collections import deque
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from fastapi import HTTPException
+from typing import Any, Deque, Dict, Optional, Tuple
+from pool_utils import WorkerPool
+from metrics_utils import timed
+
+# scrypt cost parameters for new passwords; stored with each hash, so
+# raising them later does not invalidate existing shares
+PASSWORD_SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", str(2 ** 14)))
+PASSWORD_SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", "8"))
+PASSWORD_SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", "1"))
+# Threads (and queued attempts) for password hashing, kept apart from the
+# encryption pool so guessing bursts cannot slow down downloads
+KDF_WORKERS = int(os.getenv("KDF_WORKERS", str(max(1, (os.cpu_count() or 1) // 2))))
+KDF_QUEUE_DEPTH = int(os.getenv("KDF_QUEUE_DEPTH", "128"))
+# Wrong passwords allowed per file ID within the window before new attempts
+# get a 429; no more checks than that run at once for one file ID either
+PASSWORD_MAX_FAILURES = int(os.getenv("PASSWORD_MAX_FAILURES", "5"))
+PASSWORD_FAILURE_WINDOW = float(os.getenv("PASSWORD_FAILURE_WINDOW", "60"))
+
+# Associated data binding password-wrapped data keys to their purpose
+PASSWORD_KEY_AAD = b"swiftshare-password-key"
+
+
+def derive(password: str, salt: bytes, n: int, r: int, p: int) -> Tuple[bytes, bytes]:
+    """
+    Run scrypt once and split the output into a verifier (stored) and a
+    key-encryption key (never stored) for the share's data key.
+    """
+    output = Scrypt(salt=salt, length=64, n=n, r=r, p=p).derive(password.encode())
+    return output[:32], output[32:]
+
+
+def protect(password: str, data_key: Optional[bytes] = None) -> Dict[str, Any]:
+    """
+    Hash a share password. Returns the record fields to store: the scrypt
+    parameters and verifier, and the data key wrapped with the
+    password-derived key when one is given.
+    """
+    salt = os.urandom(16)
+    verifier, kek = derive(password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    fields: Dict[str, Any] = {"password": {
+        "kdf": "scrypt",
+        "salt": base64.b64encode(salt).decode(),
+        "n": PASSWORD_SCRYPT_N,
+        "r": PASSWORD_SCRYPT_R,
+        "p": PASSWORD_SCRYPT_P,
+        "hash": base64.b64encode(verifier).decode(),
+    }}
+    if data_key is not None:
+        nonce = os.urandom(12)
+        wrapped = nonce + AESGCM(kek).encrypt(nonce, data_key, PASSWORD_KEY_AAD)
+        fields["password_data_key"] = base64.b64encode(wrapped).decode()
+    return fields
+
+
+def check(password: str, record: Dict[str, Any]) -> Tuple[bool, Optional[bytes]]:
+    """
+    Check a password against a record in constant time.
+    Returns whether it matches and, for shares whose data key is wrapped
+    with the password, the unwrapped data key.
+    """
+    stored = record["password"]
+    if isinstance(stored, str):
+        # Shares created before passwords were hashed
+        return hmac.compare_digest(password.encode(), stored.encode()), None
+
+    verifier, kek = derive(password, base64.b64decode(stored["salt"]), stored["n"], stored["r"], stored["p"])
+    if not hmac.compare_digest(verifier, base64.b64decode(stored["hash"])):
+        return False, None
+    if "password_data_key" not in record:
+        return True, None
+    wrapped = base64.b64decode(record["password_data_key"])
+    return True, AESGCM(kek).decrypt(wrapped[:12], wrapped[12:], PASSWORD_KEY_AAD)
+
+
+class PasswordVerifier:
+    """
+    Verifies share passwords on a bounded pool of its own and limits
+    failed attempts per file ID. Checks still running count against the
+    limit as well: further attempts wait for them to settle, so a burst
+    of concurrent guesses gets no more checks than max_failures, while
+    concurrent requests with the right password all get through.
+    Failure counts are kept per process.
+    """
+
+    def __init__(self, pool: WorkerPool, max_failures: int = PASSWORD_MAX_FAILURES,
+                 window: float = PASSWORD_FAILURE_WINDOW):
+        self.pool = pool
+        self.max_failures = max_failures
+        self.window = window
+        self.rejected = 0
+        self._failures: Dict[str, Deque[float]] = {}
+        self._checking: Dict[str, int] = {}
+        self._settled: Dict[str, asyncio.Event] = {}
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """Rate limiting counters."""
+        return {"rejected": self.rejected, "limited_file_ids": len(self._failures)}
+
+    def _recent_failures(self, file_id: str, now: float) -> Deque[float]:
+        failures = self._failures.get(file_id)
+        if failures is None:
+            return deque()
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[file_id]
+        return failures
+
+    async def _admit(self, file_id: str) -> None:
+        """Wait until a file ID may run another check, or raise 429 if it may not."""
+        while True:
+            now = time.monotonic()
+            failures = self._recent_failures(file_id, now)
+            checking = self._checking.get(file_id, 0)
+            if len(failures) + checking < self.max_failures:
+                self._checking[file_id] = checking + 1
+                return
+            if not checking:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many incorrect passwords, please retry later",
+                    headers={"Retry-After": str(max(1, int(failures[0] + self.window - now + 1)))}
+                )
+            # The checks running may still turn out to be right
+            await self._settled.setdefault(file_id, asyncio.Event()).wait()
+
+    def _settle(self, file_id: str) -> None:
+        """Finish a check and wake the attempts waiting on it."""
+        self._checking[file_id] -= 1
+        if not self._checking[file_id]:
+            del self._checking[file_id]
+        settled = self._settled.pop(file_id, None)
+        if settled is not None:
+            settled.set()
+
+    async def protect(self, password: str, data_key: Optional[bytes] = None) -> Dict[str, Any]:
+        """Hash a new share password on the pool; see protect()."""
+        self.pool.check_capacity()
+        with timed("kdf"):
+            return await self.pool.run(protect, password, data_key)
+
+    async def verify(self, file_id: str, password: str, record: Dict[str, Any]) -> Optional[bytes]:
+        """
+        Verify the password for a share, returning its password-wrapped
+        data key if it has one. Raises 429 once a file ID has seen too
+        many recent failures, 503 if the pool is saturated and 403 if
+        the password is wrong.
+        """
+        await self._admit(file_id)
+        try:
+            self.pool.check_capacity()
+            with timed("kdf"):
+                matches, data_key = await self.pool.run(check, password, record)
+            if not matches:
+                self._failures.setdefault(file_id, deque()).append(time.monotonic())
+                raise HTTPException(status_code=403, detail="Incorrect password")
+            return data_key
+        finally:
+            self._settle(file_id)
+
+# Create singleton instances
+kdf_pool = WorkerPool(max_workers=KDF_WORKERS, max_queue=KDF_QUEUE_DEPTH)
+password_verifier = PasswordVerifier(kdf_pool)
@@ -0,0 +1,75 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from functools import partial
+from typing import Any, Dict
+
+# Threads for CPU-bound work; AES-GCM (cryptography) and zlib release the
+# GIL while they run, so threads give real parallelism here
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 1)))
+# Tasks allowed to wait for a thread before new requests are turned away
+CPU_QUEUE_DEPTH = int(os.getenv("CPU_QUEUE_DEPTH", "64"))
+# Seconds clients are asked to wait before retrying when saturated
+CPU_RETRY_AFTER = int(os.getenv("CPU_RETRY_AFTER", "2"))
+
+class WorkerPool:
+    """
+    Bounded thread pool for CPU-bound work such as encryption and compression.
+    Work already admitted always runs, so responses that are streaming are
+    never cut off; new requests call check_capacity() first and get a 503
+    with Retry-After while the backlog is full, instead of queueing without
+    bound and letting latency collapse for everyone.
+    """
+
+    def __init__(self, max_workers: int = CPU_WORKERS, max_queue: int = CPU_QUEUE_DEPTH,
+                 retry_after: int = CPU_RETRY_AFTER):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.pending = 0
+        self.rejected = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cpu")
+
+    @property
+    def saturated(self) -> bool:
+        """Whether every thread is busy and the queue is full."""
+        return self.pending >= self.max_workers + self.max_queue
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """Current load and rejections so far."""
+        return {
+            "workers": self.max_workers,
+            "capacity": self.max_workers + self.max_queue,
+            "pending": self.pending,
+            "saturated": int(self.saturated),
+            "rejected": self.rejected,
+        }
+
+    def check_capacity(self) -> None:
+        """Raise a 503 with Retry-After if the pool cannot take more work."""
+        if self.saturated:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, please retry shortly",
+                headers={"Retry-After": str(self.retry_after)}
+            )
+
+    async def run(self, func, *args):
+        """Run func(*args) on the pool without blocking the event loop."""
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(func, *args))
+        finally:
+            self.pending -= 1
+
+# Create a singleton instance
+cpu_pool = WorkerPool()
@@ -0,0 +1,66 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import mimetypes
+from typing import AsyncIterable, AsyncIterator, Optional
+
+# Leading bytes of a text upload kept as its preview; 0 disables previews
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", str(4 * 1024)))
+
+# Non-text/* media types whose content is readable text
+TEXT_TYPES = {
+    "application/json", "application/xml", "application/javascript", "application/x-javascript",
+    "application/x-yaml", "application/yaml", "application/x-sh", "application/sql", "application/toml",
+}
+
+def previewable_type(content_type: str, filename: str) -> bool:
+    """Whether a file is text that can be previewed, judged by its content type or else its extension."""
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type in ("", "application/octet-stream"):
+        media_type = mimetypes.guess_type(filename)[0] or ""
+    return (
+        media_type.startswith("text/")
+        or media_type in TEXT_TYPES
+        or media_type.endswith(("+json", "+xml"))
+    )
+
+def preview_text(sample: bytes) -> str:
+    """Decode a preview, dropping a character cut off at its end."""
+    try:
+        return sample.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A UTF-8 character is at most 4 bytes long
+        if e.start >= len(sample) - 3 and e.reason == "unexpected end of data":
+            return sample[:e.start].decode("utf-8", errors="replace")
+        return sample.decode("utf-8", errors="replace")
+
+class PreviewCapture:
+    """
+    Plaintext of an upload on its way to storage. stream() passes it on
+    unchanged while keeping the first PREVIEW_SIZE bytes of text files,
+    so previews cost no extra read of the upload.
+    """
+
+    def __init__(self, pieces: AsyncIterable[bytes], content_type: str, filename: str):
+        self._pieces = pieces
+        self.enabled = PREVIEW_SIZE > 0 and previewable_type(content_type, filename)
+        self._sample = bytearray()
+
+    @property
+    def sample(self) -> Optional[bytes]:
+        """The captured preview, or None for files without one."""
+        return bytes(self._sample) if self._sample else None
+
+    def add(self, piece: bytes) -> None:
+        """Keep the part of a piece of plaintext that falls within the preview."""
+        if self.enabled and len(self._sample) < PREVIEW_SIZE:
+            self._sample += piece[:PREVIEW_SIZE - len(self._sample)]
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """The upload's plaintext, unchanged."""
+        async for piece in self._pieces:
+            self.add(piece)
+            yield piece
@@ -0,0 +1,157 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Set, Tuple
+from metadata_utils import MetadataStore, blob_store, metadata_store, object_keys, run_store, upload_session_store
+from s3_utils import AsyncS3Manager, S3_DELETE_BATCH_SIZE, s3_manager
+from cache_utils import object_cache
+from dedup_utils import blob_index
+from metrics_utils import REAPER_BATCH_SIZE, REAPER_LAG_SECONDS, get_logger
+
+logger = get_logger("reaper")
+
+# Longest the reaper sleeps before re-checking the store; other workers
+# may have added files that expire before its next known deadline
+REAPER_INTERVAL = float(os.getenv("REAPER_INTERVAL", "60"))
+
+class ExpiryReaper:
+    """
+    Background task that removes expired files.
+    It sleeps until the earliest expires_at in the metadata store (whose
+    expires_at index keeps this cheap), claims expired records with
+    consume() so that each one is reaped by a single worker, and removes
+    their objects with batched S3 delete_objects requests.
+    """
+
+    label = "files"
+
+    def __init__(self, store: MetadataStore, s3: AsyncS3Manager,
+                 batch_size: int = S3_DELETE_BATCH_SIZE, interval: float = REAPER_INTERVAL):
+        self.store = store
+        self.s3 = s3
+        self.batch_size = batch_size
+        self.interval = interval
+        self._next_deadline: Optional[datetime] = None
+        self._wakeup = asyncio.Event()
+        self.objects_reaped = 0
+        self.batches = 0
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """Counters describing the reaper's work so far."""
+        return {
+            "objects_reaped": self.objects_reaped,
+            "batches": self.batches,
+        }
+
+    def notify(self, expires_at: datetime) -> None:
+        """Wake the reaper early if a new file expires before its next deadline."""
+        if self._next_deadline is None or expires_at < self._next_deadline:
+            self._next_deadline = expires_at
+            self._wakeup.set()
+
+    async def remove(self, claimed: Dict[str, Dict[str, Any]]) -> Tuple[int, Set[str]]:
+        """
+        Remove the objects of claimed records.
+        Returns the number of objects removed and the file IDs that failed.
+        """
+        keys = [key for record in claimed.values() for key in object_keys(record)]
+        object_cache.discard(keys)
+        failed = set(await self.s3.delete_files(keys)) if keys else set()
+        failed_ids = {file_id for file_id, record in claimed.items() if failed.intersection(object_keys(record))}
+        for file_id, record in claimed.items():
+            if file_id not in failed_ids:
+                await release_blobs(record)
+        return len(keys) - len(failed), failed_ids
+
+    async def reap(self, now: Optional[datetime] = None) -> int:
+        """Remove every share that expired before now. Returns the number reaped."""
+        now = now or datetime.now(timezone.utc)
+        reaped = 0
+        while True:
+            expired = await run_store(self.store.expiring, now, self.batch_size)
+            claimed = {}
+            for file_id, _ in expired:
+                # Downloads and other workers may be removing the same files,
+                # and reference-counted records may have been extended since
+                record = await run_store(self.store.consume, file_id, now)
+                if record:
+                    claimed[file_id] = record
+
+            removed, failed = await self.remove(claimed) if claimed else (0, set())
+            for file_id in failed:
+                # Put the record back so a later pass retries the delete
+                await run_store(self.store.put, file_id, claimed.pop(file_id))
+
+            if claimed:
+                lag = max((now - record["expires_at"]).total_seconds() for record in claimed.values())
+                self.objects_reaped += removed
+                self.batches += 1
+                REAPER_BATCH_SIZE.labels(self.label).observe(removed)
+                REAPER_LAG_SECONDS.labels(self.label).observe(lag)
+                reaped += len(claimed)
+                logger.info(f"Reaped expired {self.label}", extra={
+                    "reaped": len(claimed), "failed": len(failed), "lag_seconds": round(lag, 3),
+                })
+
+            if failed or len(expired) < self.batch_size:
+                return reaped
+
+    async def run(self) -> None:
+        """Reap expired files until cancelled."""
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.reap()
+                self._next_deadline = await run_store(self.store.next_expiry)
+            except Exception:
+                logger.exception(f"Error reaping expired {self.label}")
+                self._next_deadline = None
+
+            timeout = self.interval
+            if self._next_deadline is not None:
+                until_deadline = (self._next_deadline - datetime.now(timezone.utc)).total_seconds()
+                # Sleep a little even when overdue, e.g. after failed deletes
+                timeout = min(timeout, max(until_deadline, 1.0))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+class UploadSessionReaper(ExpiryReaper):
+    """
+    Background task that aborts direct uploads the client never completed,
+    so their parts stop being stored (and billed) in S3.
+    """
+
+    label = "upload sessions"
+
+    async def remove(self, claimed: Dict[str, Dict[str, Any]]) -> Tuple[int, Set[str]]:
+        await asyncio.gather(*(
+            self.s3.abort_multipart_upload(record["key"], record["upload_id"])
+            for record in claimed.values()
+        ))
+        return len(claimed), set()
+
+class BlobReaper(ExpiryReaper):
+    """
+    Background task that removes deduplicated content once no share
+    references it any more.
+    """
+
+    label = "blobs"
+
+async def release_blobs(record: Dict[str, Any]) -> None:
+    """Drop a removed share's references to deduplicated content."""
+    if await run_store(blob_index.release, record):
+        blob_reaper.notify(datetime.now(timezone.utc))
+
+# Create singleton instances
+expiry_reaper = ExpiryReaper(metadata_store, s3_manager)
+upload_session_reaper = UploadSessionReaper(upload_session_store, s3_manager)
+blob_reaper = BlobReaper(blob_store, s3_manager)
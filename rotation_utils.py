@@ -0,0 +1,143 @@
+from dotenv import load_dotenv
+import os
+
+# Load environment variables from .env file
+load_dotenv()
+
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+from metadata_utils import MetadataStore, blob_store, metadata_store, run_store, upload_session_store
+from encryption_utils import EncryptionManager, encryption_manager
+from metrics_utils import get_logger
+
+logger = get_logger("rotation")
+
+# Records read from a store at a time while re-wrapping
+KEY_ROTATION_BATCH_SIZE = int(os.getenv("KEY_ROTATION_BATCH_SIZE", "500"))
+# Seconds before retrying records that changed while being re-wrapped
+KEY_ROTATION_RETRY_INTERVAL = float(os.getenv("KEY_ROTATION_RETRY_INTERVAL", "60"))
+
+def rewrap_record(record: Dict[str, Any], manager: EncryptionManager) -> Optional[Dict[str, Any]]:
+    """
+    A copy of a record with every data key it stores (its own, its
+    bundle members' and their previews') wrapped with the current master
+    key, or None if none of them needed it.
+    """
+    changed = False
+
+    def rewrap(entry: Dict[str, Any]) -> Dict[str, Any]:
+        nonlocal changed
+        if "preview" in entry:
+            entry = {**entry, "preview": rewrap(entry["preview"])}
+        if "data_key" not in entry or not manager.needs_rewrap(entry["data_key"]):
+            return entry
+        changed = True
+        return {**entry, "data_key": manager.rewrap_data_key(entry["data_key"])}
+
+    updated = rewrap(record)
+    if "members" in record:
+        updated = {**updated, "members": [rewrap(member) for member in record["members"]]}
+    return updated if changed else None
+
+class KeyRotator:
+    """
+    Background task that moves stored data keys to the current master key.
+    Only the wrapped keys in metadata records are rewritten: the encrypted
+    objects, whether in S3 or inline, are never read or copied, so rotation
+    costs O(number of files) however much data they hold. Each record is
+    swapped with replace() so that concurrent downloads, reference count
+    changes and other workers' rotators are never overwritten; records that
+    changed meanwhile are retried on a later pass. Once no data key uses an
+    older master key the task stops, and the older keys can be retired.
+    """
+
+    def __init__(self, stores: List[MetadataStore], manager: EncryptionManager,
+                 batch_size: int = KEY_ROTATION_BATCH_SIZE, interval: float = KEY_ROTATION_RETRY_INTERVAL):
+        self.stores = stores
+        self.manager = manager
+        self.batch_size = batch_size
+        self.interval = interval
+        self.rewrapped = 0
+        self.conflicts = 0
+        self.errors = 0
+        self.passes = 0
+        self.last_pass_seconds = 0.0
+        self.complete = False
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """Counters describing the rotator's work so far."""
+        return {
+            "rewrapped": self.rewrapped,
+            "conflicts": self.conflicts,
+            "errors": self.errors,
+            "passes": self.passes,
+            "last_pass_seconds": self.last_pass_seconds,
+            "complete": self.complete,
+        }
+
+    async def rotate_store(self, store: MetadataStore) -> int:
+        """
+        Re-wrap the outdated data keys in one store.
+        Returns the number of records left to retry.
+        """
+        remaining = 0
+        after = None
+        while True:
+            batch = await run_store(store.scan, after, self.batch_size)
+            for file_id, record in batch:
+                try:
+                    updated = rewrap_record(record, self.manager)
+                except Exception:
+                    # E.g. the record's master key version is not configured
+                    logger.exception("Error re-wrapping data key", extra={"file_id": file_id})
+                    self.errors += 1
+                    continue
+                if updated is None:
+                    continue
+                if await run_store(store.replace, file_id, record, updated):
+                    self.rewrapped += 1
+                else:
+                    # Changed or removed meanwhile; the next pass looks again
+                    self.conflicts += 1
+                    remaining += 1
+            if len(batch) < self.batch_size:
+                return remaining
+            after = batch[-1][0]
+
+    async def rotate(self) -> int:
+        """Make one pass over every store. Returns the number of records left to retry."""
+        started = time.monotonic()
+        remaining = 0
+        rewrapped = self.rewrapped
+        for store in self.stores:
+            remaining += await self.rotate_store(store)
+        self.passes += 1
+        self.last_pass_seconds = time.monotonic() - started
+        if self.rewrapped > rewrapped or remaining:
+            logger.info("Re-wrapped data keys", extra={
+                "key_version": self.manager.key_version,
+                "rewrapped": self.rewrapped - rewrapped,
+                "remaining": remaining,
+                "seconds": round(self.last_pass_seconds, 3),
+            })
+        return remaining
+
+    async def run(self) -> None:
+        """Re-wrap outdated data keys until none are left, or until cancelled."""
+        # With a single master key every data key is already wrapped with it
+        if len(self.manager.master_keys) == 1:
+            self.complete = True
+            return
+        while True:
+            try:
+                if await self.rotate() == 0:
+                    self.complete = True
+                    return
+            except Exception:
+                logger.exception("Error rotating data keys")
+            await asyncio.sleep(self.interval)
+
+# Create a singleton instance
+key_rotator = KeyRotator([metadata_store, upload_session_store, blob_store], encryption_manager)
@@ -4,10 +4,48 @@ import os
 # Load environment variables from .env file
 load_dotenv()
 
+import asyncio
 import boto3
+import time
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import HTTPException
-from typing import Optional, Dict, Any
+from functools import partial
+from typing import Optional, Dict, Any, AsyncIterable, AsyncIterator, List, Tuple
+from metrics_utils import get_logger, observe_stage
+
+logger = get_logger("s3")
+
+# Size of the pieces read from S3 response bodies
+S3_READ_SIZE = 256 * 1024
+
+# Size of the HTTP connection pool, and of the thread pool that drives it
+S3_MAX_CONNECTIONS = int(os.getenv("S3_MAX_CONNECTIONS", "32"))
+
+# delete_objects accepts at most 1000 keys per request
+S3_DELETE_BATCH_SIZE = 1000
+
+# S3 requires every multipart part except the last to be at least 5 MiB
+S3_PART_SIZE = max(int(os.getenv("S3_PART_SIZE", str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+
+# Latency stage recorded for each blocking S3 call, by method name
+S3_STAGES = {
+    "upload_file": "s3_put",
+    "create_multipart_upload": "s3_put",
+    "upload_part": "s3_put",
+    "complete_multipart_upload": "s3_put",
+    "abort_multipart_upload": "s3_delete",
+    "presign_upload_part": "s3_presign",
+    "download_file": "s3_get",
+    "open_file": "s3_get",
+    "read": "s3_get",
+    "delete_file": "s3_delete",
+    "delete_files": "s3_delete",
+    "get_file_metadata": "s3_head",
+    "get_file_size": "s3_head",
+    "list_parts": "s3_list",
+}
 
 class S3Manager:
     def __init__(self, skip_verification: bool = False):
@@ -15,6 +53,8 @@ class S3Manager:
         self.aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
         self.region = os.getenv("AWS_REGION")
         self.bucket_name = os.getenv("S3_BUCKET_NAME")
+        # Optional custom endpoint, e.g. a local S3 stand-in such as moto or MinIO
+        self.endpoint_url = os.getenv("S3_ENDPOINT_URL") or None
         
         if not all([self.aws_access_key_id, self.aws_secret_access_key, self.region, self.bucket_name]):
             raise ValueError("Missing required AWS credentials in environment variables")
@@ -25,6 +65,8 @@ class S3Manager:
                 aws_access_key_id=self.aws_access_key_id,
                 aws_secret_access_key=self.aws_secret_access_key,
                 region_name=self.region,
+                endpoint_url=self.endpoint_url,
+                config=Config(max_pool_connections=S3_MAX_CONNECTIONS),
             )
             # Verify bucket exists and is accessible (skip in test mode)
             if not skip_verification:
@@ -58,21 +100,119 @@ class S3Manager:
                 detail=f"Error uploading file to S3: {str(e)}"
             )
 
+    def create_multipart_upload(self, key: str, metadata: Optional[Dict[str, Any]] = None) -> str:
+        """Start a multipart upload and return its upload ID."""
+        try:
+            extra_args = {'Metadata': metadata} if metadata else {}
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                **extra_args
+            )
+            return response['UploadId']
+        except ClientError as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error uploading file to S3: {str(e)}"
+            )
+
+    def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> Dict[str, Any]:
+        """Upload one part of a multipart upload and return its completion entry."""
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body
+            )
+            return {'ETag': response['ETag'], 'PartNumber': part_number}
+        except ClientError as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error uploading file to S3: {str(e)}"
+            )
+
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: List[Dict[str, Any]]) -> None:
+        """Assemble the uploaded parts into the final object."""
+        try:
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except ClientError as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error uploading file to S3: {str(e)}"
+            )
+
+    def list_parts(self, key: str, upload_id: str) -> List[Dict[str, Any]]:
+        """Return the completion entries of every part uploaded so far, in order."""
+        try:
+            parts = []
+            paginator = self.client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.bucket_name, Key=key, UploadId=upload_id):
+                parts.extend(
+                    {'ETag': part['ETag'], 'PartNumber': part['PartNumber']}
+                    for part in page.get('Parts', [])
+                )
+            return sorted(parts, key=lambda part: part['PartNumber'])
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchUpload':
+                raise HTTPException(
+                    status_code=404,
+                    detail="Upload not found in S3"
+                )
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error listing uploaded parts in S3: {str(e)}"
+            )
+
+    def abort_multipart_upload(self, key: str, upload_id: str) -> None:
+        """Abort a multipart upload, discarding any uploaded parts."""
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id
+            )
+        except ClientError as e:
+            logger.warning("Error aborting multipart upload", extra={"key": key, "error": str(e)})
+
+    def presign_upload_part(self, key: str, upload_id: str, part_number: int, expires_in: int) -> str:
+        """Create a URL that lets a client PUT one part of a multipart upload directly."""
+        try:
+            return self.client.generate_presigned_url(
+                'upload_part',
+                Params={
+                    'Bucket': self.bucket_name,
+                    'Key': key,
+                    'UploadId': upload_id,
+                    'PartNumber': part_number
+                },
+                ExpiresIn=expires_in
+            )
+        except ClientError as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error presigning upload to S3: {str(e)}"
+            )
+
     def download_file(self, key: str) -> bytes:
         """Download a file from S3."""
         try:
-            print(f"Attempting to download file with key: {key}")
-            print(f"Using bucket: {self.bucket_name}")
+            logger.debug("Downloading file", extra={"key": key, "bucket": self.bucket_name})
             response = self.client.get_object(
                 Bucket=self.bucket_name,
                 Key=key
             )
-            print("Successfully retrieved object from S3")
             return response['Body'].read()
         except ClientError as e:
             error_code = e.response['Error']['Code']
             error_message = e.response['Error']['Message']
-            print(f"S3 Error - Code: {error_code}, Message: {error_message}")
+            logger.warning("S3 error", extra={"key": key, "code": error_code, "error": error_message})
             if error_code == 'NoSuchKey':
                 raise HTTPException(
                     status_code=404,
@@ -83,7 +223,30 @@ class S3Manager:
                 detail=f"Error downloading file from S3: {str(e)}"
             )
         except Exception as e:
-            print(f"Unexpected error during download: {str(e)}")
+            logger.exception("Unexpected error during download", extra={"key": key})
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error downloading file from S3: {str(e)}"
+            )
+
+    def open_file(self, key: str, byte_range: Optional[Tuple[int, int]] = None):
+        """Open a file (or an inclusive byte range of it) in S3 and return its streaming body."""
+        try:
+            extra_args = {'Range': f"bytes={byte_range[0]}-{byte_range[1]}"} if byte_range else {}
+            response = self.client.get_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                **extra_args
+            )
+            return response['Body']
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            logger.warning("S3 error", extra={"key": key, "code": error_code, "error": e.response['Error']['Message']})
+            if error_code == 'NoSuchKey':
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"File not found in S3: {key}"
+                )
             raise HTTPException(
                 status_code=500,
                 detail=f"Error downloading file from S3: {str(e)}"
@@ -102,6 +265,25 @@ class S3Manager:
                 detail=f"Error deleting file from S3: {str(e)}"
             )
 
+    def delete_files(self, keys: List[str]) -> List[str]:
+        """
+        Delete many files from S3 with batched delete_objects requests.
+        Returns the keys that could not be deleted.
+        """
+        failed = []
+        for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            batch = keys[start:start + S3_DELETE_BATCH_SIZE]
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+                )
+                failed.extend(error['Key'] for error in response.get('Errors', []))
+            except ClientError as e:
+                logger.warning("Error deleting files from S3", extra={"keys": len(batch), "error": str(e)})
+                failed.extend(batch)
+        return failed
+
     def get_file_metadata(self, key: str) -> Dict[str, Any]:
         """Get metadata for a file in S3."""
         try:
@@ -121,6 +303,156 @@ class S3Manager:
                 detail=f"Error getting file metadata from S3: {str(e)}"
             )
 
+    def get_file_size(self, key: str) -> int:
+        """Get the size in bytes of a file in S3."""
+        try:
+            response = self.client.head_object(
+                Bucket=self.bucket_name,
+                Key=key
+            )
+            return response['ContentLength']
+        except ClientError as e:
+            if e.response['Error']['Code'] == '404':
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"File not found in S3: {key}"
+                )
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error getting file metadata from S3: {str(e)}"
+            )
+
+class AsyncS3Manager:
+    """
+    Async interface to S3Manager for use from request handlers.
+    Every blocking boto3 call runs on a thread pool sized to match the
+    client's HTTP connection pool, so the event loop is never blocked.
+    """
+
+    def __init__(self, manager: S3Manager, max_workers: int = S3_MAX_CONNECTIONS):
+        self.manager = manager
+        self.bucket_name = manager.bucket_name
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, partial(func, *args))
+        finally:
+            observe_stage(S3_STAGES.get(func.__name__, "s3_other"), time.perf_counter() - started)
+
+    async def upload_file(self, file_data: bytes, key: str, metadata: Optional[Dict[str, Any]] = None) -> None:
+        """Upload a file to S3 with optional metadata."""
+        await self._run(self.manager.upload_file, file_data, key, metadata)
+
+    async def upload_stream(self, chunks: AsyncIterable[bytes], key: str, metadata: Optional[Dict[str, Any]] = None) -> int:
+        """
+        Upload an async iterable of byte chunks to S3 without holding the whole object.
+        Uses a multipart upload once the data exceeds one part and a single
+        put_object otherwise. Returns the number of bytes uploaded.
+        """
+        buffer = bytearray()
+        parts = []
+        upload_id = None
+        total = 0
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                total += len(chunk)
+                if len(buffer) < S3_PART_SIZE:
+                    continue
+                if upload_id is None:
+                    upload_id = await self._run(self.manager.create_multipart_upload, key, metadata)
+                body = bytes(buffer[:S3_PART_SIZE])
+                del buffer[:S3_PART_SIZE]
+                parts.append(await self._run(self.manager.upload_part, key, upload_id, len(parts) + 1, body))
+
+            if upload_id is None:
+                # Small object: a single request is cheaper than a multipart upload
+                await self._run(self.manager.upload_file, bytes(buffer), key, metadata)
+                return total
+
+            if buffer:
+                parts.append(await self._run(self.manager.upload_part, key, upload_id, len(parts) + 1, bytes(buffer)))
+            await self._run(self.manager.complete_multipart_upload, key, upload_id, parts)
+            return total
+        except BaseException as e:
+            if upload_id is not None:
+                await self._run(self.manager.abort_multipart_upload, key, upload_id)
+            if isinstance(e, (HTTPException, asyncio.CancelledError)):
+                raise
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error uploading file to S3: {str(e)}"
+            )
+
+    async def create_multipart_upload(self, key: str, metadata: Optional[Dict[str, Any]] = None) -> str:
+        """Start a multipart upload and return its upload ID."""
+        return await self._run(self.manager.create_multipart_upload, key, metadata)
+
+    async def presign_upload_part(self, key: str, upload_id: str, part_number: int, expires_in: int) -> str:
+        """Create a URL that lets a client PUT one part of a multipart upload directly."""
+        return await self._run(self.manager.presign_upload_part, key, upload_id, part_number, expires_in)
+
+    async def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> Dict[str, Any]:
+        """Upload one part of a multipart upload and return its completion entry."""
+        return await self._run(self.manager.upload_part, key, upload_id, part_number, body)
+
+    async def list_parts(self, key: str, upload_id: str) -> List[Dict[str, Any]]:
+        """Return the completion entries of every part uploaded so far, in order."""
+        return await self._run(self.manager.list_parts, key, upload_id)
+
+    async def complete_multipart_upload(self, key: str, upload_id: str, parts: List[Dict[str, Any]]) -> None:
+        """Assemble the uploaded parts into the final object."""
+        await self._run(self.manager.complete_multipart_upload, key, upload_id, parts)
+
+    async def abort_multipart_upload(self, key: str, upload_id: str) -> None:
+        """Abort a multipart upload, discarding any uploaded parts."""
+        await self._run(self.manager.abort_multipart_upload, key, upload_id)
+
+    async def download_file(self, key: str) -> bytes:
+        """Download a file from S3."""
+        return await self._run(self.manager.download_file, key)
+
+    async def stream_file(self, key: str, byte_range: Optional[Tuple[int, int]] = None) -> AsyncIterator[bytes]:
+        """
+        Stream a file (or an inclusive byte range of it) from S3.
+        The request is sent before returning so missing keys fail early.
+        """
+        body = await self._run(self.manager.open_file, key, byte_range)
+
+        async def iter_body() -> AsyncIterator[bytes]:
+            try:
+                while True:
+                    piece = await self._run(body.read, S3_READ_SIZE)
+                    if not piece:
+                        break
+                    yield piece
+            finally:
+                body.close()
+
+        return iter_body()
+
+    async def delete_file(self, key: str) -> None:
+        """Delete a file from S3."""
+        await self._run(self.manager.delete_file, key)
+
+    async def delete_files(self, keys: List[str]) -> List[str]:
+        """Delete many files from S3, returning the keys that could not be deleted."""
+        if not keys:
+            # Shares kept inline or deduplicated may have no objects of their own
+            return []
+        return await self._run(self.manager.delete_files, keys)
+
+    async def get_file_metadata(self, key: str) -> Dict[str, Any]:
+        """Get metadata for a file in S3."""
+        return await self._run(self.manager.get_file_metadata, key)
+
+    async def get_file_size(self, key: str) -> int:
+        """Get the size in bytes of a file in S3."""
+        return await self._run(self.manager.get_file_size, key)
+
 # Create a singleton instance
 is_test_mode = os.getenv("TESTING", "").lower() == "true"
-s3_manager = S3Manager(skip_verification=is_test_mode) 
\ No newline at end of file
+s3_manager = AsyncS3Manager(S3Manager(skip_verification=is_test_mode))
@@ -98,50 +98,254 @@ fileInput.addEventListener("change", function () {
   renderFileList(this.files); // Render the file list with remove options
 });
 
-// ✅ Upload Files + Show File IDs
-async function uploadFiles() {
-  const textInput = document.getElementById("textInput").value.trim();
-  const expirationPolicy = document.getElementById("expirationPolicy").value;
-  const uploadPassword = document.getElementById("uploadPassword").value.trim();
-  const uploadResult = document.getElementById("uploadResult");
+// Files smaller than one S3 part (the server's S3_PART_SIZE default) are
+// uploaded in a single form request, which also lets the server keep them
+// inline or deduplicate them; larger ones use direct or resumable uploads
+const LARGE_UPLOAD_SIZE = 8 * 1024 * 1024;
 
-  try {
-    showLoadingScreen(); // Show loading screen at start
+function base64ToBytes(value) {
+  return Uint8Array.from(atob(value), (c) => c.charCodeAt(0));
+}
 
-    const formData = new FormData();
-    formData.append("expiration_policy", expirationPolicy);
+// ✅ Direct upload: encrypt in the browser and send parts straight to S3.
+// Chunks use the server's stream format, so downloads work unchanged.
+// Returns null when the server does not offer direct uploads for the file.
+async function uploadDirect(file, expirationPolicy, password) {
+  const form = new FormData();
+  form.append("filename", file.name);
+  form.append("size", file.size);
+  form.append("content_type", file.type || "application/octet-stream");
+  form.append("expiration_policy", expirationPolicy);
+  if (password) {
+    form.append("password", password);
+  }
 
-    if (textInput) {
-      formData.append("text_content", textInput);
+  const response = await fetch("/upload/direct/", {
+    method: "POST",
+    body: form,
+  });
+  // 409: the server compresses this file, which only /upload/ can do
+  if (response.status === 404 || response.status === 409) {
+    return null;
+  }
+  if (!response.ok) {
+    throw new Error(`HTTP error! status: ${response.status}`);
+  }
+  const upload = await response.json();
+
+  const header = base64ToBytes(upload.header);
+  const noncePrefix = header.slice(9, 16); // after magic, version and chunk size
+  const key = await crypto.subtle.importKey(
+    "raw",
+    base64ToBytes(upload.data_key),
+    "AES-GCM",
+    false,
+    ["encrypt"]
+  );
+  const chunkSize = upload.chunk_size;
+  const totalChunks = Math.max(1, Math.ceil(file.size / chunkSize));
+  const parts = [];
+
+  for (let part = 0; part < upload.part_urls.length; part++) {
+    // The header goes at the start of the object, i.e. in part 1
+    const pieces = part === 0 ? [header] : [];
+    const firstChunk = part * upload.part_chunks;
+    const lastChunk = Math.min(firstChunk + upload.part_chunks, totalChunks);
+    for (let index = firstChunk; index < lastChunk; index++) {
+      const plaintext = await file
+        .slice(index * chunkSize, (index + 1) * chunkSize)
+        .arrayBuffer();
+      // Nonce: prefix | chunk index (big-endian) | final chunk flag
+      const iv = new Uint8Array(12);
+      iv.set(noncePrefix);
+      new DataView(iv.buffer).setUint32(7, index);
+      iv[11] = index === totalChunks - 1 ? 1 : 0;
+      const sealed = await crypto.subtle.encrypt(
+        { name: "AES-GCM", iv: iv, additionalData: header },
+        key,
+        plaintext
+      );
+      pieces.push(new Uint8Array(sealed));
     }
 
-    // Add password if provided
-    if (uploadPassword) {
-      formData.append("password", uploadPassword);
+    const partResponse = await fetch(upload.part_urls[part], {
+      method: "PUT",
+      body: new Blob(pieces),
+    });
+    if (!partResponse.ok) {
+      throw new Error(`HTTP error! status: ${partResponse.status}`);
     }
+    parts.push({
+      part_number: part + 1,
+      etag: partResponse.headers.get("ETag"),
+    });
+    updateProgress(Math.round(((part + 1) / upload.part_urls.length) * 95));
+  }
 
-    // Add files if present
-    const fileInput = document.getElementById("fileInput");
-    if (fileInput && fileInput.files.length > 0) {
-      for (const file of fileInput.files) {
-        formData.append("files", file);
+  const completion = await fetch(`/upload/direct/${upload.file_id}/complete`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json", "X-Upload-Token": upload.token },
+    body: JSON.stringify({ parts: parts }),
+  });
+  if (!completion.ok) {
+    throw new Error(`HTTP error! status: ${completion.status}`);
+  }
+  return completion.json();
+}
+
+// ✅ Resumable upload: the file goes up in chunks, several at a time.
+// The session is remembered so a retried upload of the same file only
+// sends the chunks the server has not received yet.
+const UPLOAD_PARALLELISM = 4;
+const UPLOAD_RETRIES = 5;
+
+function putChunk(url, token, body, onProgress) {
+  // XMLHttpRequest, unlike fetch, reports upload progress
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open("PUT", url);
+    xhr.setRequestHeader("X-Upload-Token", token);
+    xhr.upload.onprogress = (event) => onProgress(event.loaded);
+    xhr.onload = () => {
+      if (xhr.status >= 200 && xhr.status < 300) {
+        resolve();
+      } else {
+        reject(new Error(`HTTP error! status: ${xhr.status}`));
+      }
+    };
+    xhr.onerror = () => reject(new Error("Network error"));
+    xhr.send(body);
+  });
+}
+
+async function uploadChunk(session, file, index, onProgress) {
+  const start = index * session.chunk_size;
+  const chunk = file.slice(start, start + session.chunk_size);
+  const url = `/upload/sessions/${session.file_id}/chunks/${index}`;
+  for (let attempt = 1; ; attempt++) {
+    try {
+      await putChunk(url, session.token, chunk, onProgress);
+      onProgress(chunk.size);
+      return;
+    } catch (error) {
+      onProgress(0);
+      if (attempt >= UPLOAD_RETRIES) {
+        throw error;
       }
+      // Back off before retrying, e.g. after a dropped connection or a 503
+      await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** attempt));
     }
+  }
+}
 
-    updateProgress(50); // Update progress to show activity
+// Returns null when the server compresses the file, so it goes through /upload/
+async function uploadResumable(file, expirationPolicy, password) {
+  const resumeKey = `upload:${file.name}:${file.size}:${file.lastModified}:${expirationPolicy}`;
+  let session = JSON.parse(localStorage.getItem(resumeKey) || "null");
+  let received = [];
 
-    const response = await fetch("/upload/", {
-      method: "POST",
-      body: formData,
+  if (session) {
+    const status = await fetch(`/upload/sessions/${session.file_id}`, {
+      headers: { "X-Upload-Token": session.token },
     });
+    if (status.ok) {
+      received = (await status.json()).received;
+    } else {
+      session = null; // Expired or already completed: start over
+    }
+  }
 
-    updateProgress(90);
-
+  if (!session) {
+    const form = new FormData();
+    form.append("filename", file.name);
+    form.append("size", file.size);
+    form.append("content_type", file.type || "application/octet-stream");
+    form.append("expiration_policy", expirationPolicy);
+    if (password) {
+      form.append("password", password);
+    }
+    const response = await fetch("/upload/sessions/", {
+      method: "POST",
+      body: form,
+    });
+    if (response.status === 409) {
+      return null;
+    }
     if (!response.ok) {
       throw new Error(`HTTP error! status: ${response.status}`);
     }
+    session = await response.json();
+    localStorage.setItem(resumeKey, JSON.stringify(session));
+  }
 
-    const data = await response.json();
+  // Bytes sent per chunk, for byte-level progress across parallel requests
+  const sent = new Array(session.chunk_count).fill(0);
+  const pending = [];
+  for (let index = 0; index < session.chunk_count; index++) {
+    if (received.includes(index)) {
+      sent[index] = Math.min(session.chunk_size, file.size - index * session.chunk_size);
+    } else {
+      pending.push(index);
+    }
+  }
+  const reportProgress = () => {
+    const total = sent.reduce((sum, bytes) => sum + bytes, 0);
+    updateProgress(Math.floor((total / Math.max(file.size, 1)) * 99));
+  };
+  reportProgress();
+
+  async function worker() {
+    while (pending.length > 0) {
+      const index = pending.shift();
+      await uploadChunk(session, file, index, (bytes) => {
+        sent[index] = bytes;
+        reportProgress();
+      });
+    }
+  }
+  await Promise.all(
+    Array.from({ length: Math.min(UPLOAD_PARALLELISM, pending.length) }, worker)
+  );
+
+  const completion = await fetch(`/upload/sessions/${session.file_id}/complete`, {
+    method: "POST",
+    headers: { "X-Upload-Token": session.token },
+  });
+  if (!completion.ok) {
+    throw new Error(`HTTP error! status: ${completion.status}`);
+  }
+  localStorage.removeItem(resumeKey);
+  return completion.json();
+}
+
+// ✅ Upload Files + Show File IDs
+async function uploadFiles() {
+  const textInput = document.getElementById("textInput").value.trim();
+  const expirationPolicy = document.getElementById("expirationPolicy").value;
+  const uploadPassword = document.getElementById("uploadPassword").value.trim();
+  const uploadResult = document.getElementById("uploadResult");
+
+  try {
+    showLoadingScreen(); // Show loading screen at start
+
+    // A single large file goes straight to S3 when possible, otherwise
+    // through a resumable upload session, unless it is worth compressing
+    const fileInput = document.getElementById("fileInput");
+    let data = null;
+    if (
+      !textInput &&
+      fileInput &&
+      fileInput.files.length === 1 &&
+      fileInput.files[0].size >= LARGE_UPLOAD_SIZE
+    ) {
+      const file = fileInput.files[0];
+      data =
+        (await uploadDirect(file, expirationPolicy, uploadPassword)) ||
+        (await uploadResumable(file, expirationPolicy, uploadPassword));
+    }
+    if (!data) {
+      data = await uploadForm(textInput, expirationPolicy, uploadPassword);
+    }
     updateProgress(100);
 
     if (data.uploads && data.uploads.length > 0) {
@@ -160,6 +364,44 @@ async function uploadFiles() {
   }
 }
 
+// ✅ Upload through the server, which encrypts and stores the files
+async function uploadForm(textInput, expirationPolicy, uploadPassword) {
+  const formData = new FormData();
+  formData.append("expiration_policy", expirationPolicy);
+
+  if (textInput) {
+    formData.append("text_content", textInput);
+  }
+
+  // Add password if provided
+  if (uploadPassword) {
+    formData.append("password", uploadPassword);
+  }
+
+  // Add files if present
+  const fileInput = document.getElementById("fileInput");
+  if (fileInput && fileInput.files.length > 0) {
+    for (const file of fileInput.files) {
+      formData.append("files", file);
+    }
+  }
+
+  updateProgress(50); // Update progress to show activity
+
+  const response = await fetch("/upload/", {
+    method: "POST",
+    body: formData,
+  });
+
+  updateProgress(90);
+
+  if (!response.ok) {
+    throw new Error(`HTTP error! status: ${response.status}`);
+  }
+
+  return response.json();
+}
+
 // ✅ Download File by ID
 let currentTextContent = null;
 let currentTextFilename = null;
@@ -194,6 +436,63 @@ function downloadTextFile() {
   closeTextPreview();
 }
 
+function formatSize(bytes) {
+  const units = ["B", "KB", "MB", "GB"];
+  let unit = 0;
+  while (bytes >= 1024 && unit < units.length - 1) {
+    bytes /= 1024;
+    unit++;
+  }
+  return `${unit ? bytes.toFixed(1) : bytes} ${units[unit]}`;
+}
+
+// Describe a share without downloading it (or using up a single download)
+async function showFileInfo() {
+  const fileId = document.getElementById("fileIdInput").value.trim();
+  const downloadPassword = document
+    .getElementById("downloadPassword")
+    .value.trim();
+  const downloadResult = document.getElementById("downloadResult");
+
+  if (!fileId) {
+    downloadResult.textContent = "Please enter a file ID";
+    return;
+  }
+
+  try {
+    const response = await fetch(
+      `/info/${fileId}${
+        downloadPassword
+          ? `?password=${encodeURIComponent(downloadPassword)}`
+          : ""
+      }`
+    );
+    const data = await response.json();
+    if (!response.ok) {
+      downloadResult.textContent =
+        response.status === 403
+          ? "Incorrect password"
+          : data.error || "Error reading file details";
+      return;
+    }
+
+    const expires = new Date(data.expires_at).toLocaleString();
+    if (!data.files) {
+      downloadResult.textContent = `This file requires a password (expires ${expires})`;
+      return;
+    }
+    const names = data.files
+      .map((file) => `${file.filename} (${formatSize(file.size)})`)
+      .join(", ");
+    downloadResult.textContent = `${names}, expires ${expires}${
+      data.single_download ? ", can be downloaded once" : ""
+    }`;
+  } catch (error) {
+    console.error("Info error:", error);
+    downloadResult.textContent = "Error reading file details";
+  }
+}
+
 async function downloadFile() {
   const fileId = document.getElementById("fileIdInput").value.trim();
   const downloadPassword = document
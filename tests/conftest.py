@@ -0,0 +1,89 @@
+import base64
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = "swiftshare-test"
+
+# The app's modules read their settings when imported: configure a test
+# environment (no S3 bucket check, in-memory metadata) before any import
+os.environ.update(
+    ENCRYPTION_KEY=base64.b64encode(b"k" * 32).decode(),
+    AWS_ACCESS_KEY_ID="testing",
+    AWS_SECRET_ACCESS_KEY="testing",
+    AWS_REGION="us-east-1",
+    S3_BUCKET_NAME=BUCKET,
+    TESTING="true",
+    METADATA_BACKEND="memory",
+    METADATA_BUSY_TIMEOUT="5",
+    # Small chunks so that small test files still span several of them
+    ENCRYPTION_CHUNK_SIZE="1024",
+)
+sys.path.insert(0, ROOT)
+
+import boto3
+import pytest
+from fastapi.testclient import TestClient
+from moto import mock_aws
+
+from metadata_utils import InMemoryMetadataStore, SQLiteMetadataStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    """Each metadata store backend, empty."""
+    if request.param == "memory":
+        return InMemoryMetadataStore()
+    return SQLiteMetadataStore(str(tmp_path / "metadata.db"))
+
+
+@pytest.fixture
+def s3():
+    """A mocked S3 client with the app's bucket created."""
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def app(s3, monkeypatch):
+    """
+    The main module, imported afresh (with every *_utils module but the
+    Prometheus registry's) so each test starts with empty stores, caches
+    and counters.
+    """
+    monkeypatch.chdir(ROOT)
+    for name in list(sys.modules):
+        if name == "main" or (name.endswith("_utils") and name != "metrics_utils"):
+            del sys.modules[name]
+    import main
+    return main
+
+
+@pytest.fixture
+def client(app):
+    """A test client for the app, with its background tasks running."""
+    with TestClient(app.app) as client:
+        yield client
+
+
+@pytest.fixture
+def share(client):
+    """Create a share through the form upload endpoint and return its file ID."""
+    def share(files=None, text=None, policy="store_1_hour", password=None) -> str:
+        data = {"expiration_policy": policy}
+        if text is not None:
+            data["text_content"] = text
+        if password is not None:
+            data["password"] = password
+        response = client.post("/upload/", data=data, files=files or [])
+        assert response.status_code == 200, response.text
+        return response.json()["uploads"][0]["file_id"]
+    return share
+
+
+@pytest.fixture
+def stored_keys(s3):
+    """List the keys of every object in the app's bucket."""
+    return lambda: [item["Key"] for item in s3.list_objects_v2(Bucket=BUCKET).get("Contents", [])]
@@ -0,0 +1,80 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+from cache_utils import DiskBlockStore
+
+BLOCK_SIZE = 64 * 1024
+
+
+@pytest.fixture(params=["memory", "disk"])
+def cache(request, app, tmp_path):
+    cache = app.object_cache
+    cache.capacity = 3 * BLOCK_SIZE
+    cache.block_size = BLOCK_SIZE
+    if request.param == "disk":
+        cache.store = DiskBlockStore(str(tmp_path))
+    return cache
+
+
+@pytest.fixture
+def gets(app, monkeypatch):
+    ranges = []
+    manager = app.s3_manager.manager
+    open_file = manager.open_file
+
+    def recording_open_file(key, byte_range=None):
+        ranges.append(byte_range)
+        return open_file(key, byte_range)
+    monkeypatch.setattr(manager, "open_file", recording_open_file)
+    return ranges
+
+
+def test_concurrent_downloads_share_one_get_per_block(client, share, app, cache, gets):
+    # Three blocks once encrypted
+    data = os.urandom(2 * BLOCK_SIZE + 77)
+    file_id = share(files=[("files", ("c.bin", data))])
+
+    async def download() -> list:
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await asyncio.gather(*(http.get(f"/download/{file_id}") for _ in range(30)))
+
+    assert all(response.content == data for response in asyncio.run(download()))
+    assert len(gets) == 3
+    assert cache.metrics["blocks"] == 3 and cache.metrics["misses"] == 3
+
+    response = client.get(f"/download/{file_id}", headers={"Range": "bytes=65000-66000"})
+    assert response.content == data[65000:66001]
+    assert len(gets) == 3
+
+
+def test_least_recently_used_blocks_are_evicted(client, share, cache):
+    data, other = os.urandom(2 * BLOCK_SIZE), os.urandom(2 * BLOCK_SIZE)
+    first = share(files=[("files", ("a.bin", data))])
+    second = share(files=[("files", ("b.bin", other))])
+    assert client.get(f"/download/{first}").content == data
+    assert client.get(f"/download/{second}").content == other
+    assert cache.evictions >= 1
+    assert cache.size <= cache.capacity
+
+
+def test_expired_objects_leave_the_cache(client, share, app, cache, tmp_path):
+    data = os.urandom(2 * BLOCK_SIZE)
+    file_id = share(files=[("files", ("a.bin", data))])
+    assert client.get(f"/download/{file_id}").content == data
+    assert cache.metrics["blocks"] > 0
+
+    client.portal.call(app.expiry_reaper.reap, datetime.now(timezone.utc) + timedelta(hours=2))
+    assert cache.metrics["blocks"] == 0 and cache.size == 0
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".blk")]
+
+
+def test_single_downloads_bypass_the_cache(client, share, cache, gets):
+    data = os.urandom(2 * BLOCK_SIZE)
+    file_id = share(files=[("files", ("a.bin", data))], policy="delete_after_first_download")
+    assert client.get(f"/download/{file_id}").content == data
+    assert cache.metrics["blocks"] == 0 and cache.metrics["misses"] == 0
@@ -0,0 +1,118 @@
+import gzip
+import io
+import os
+import sys
+import zipfile
+
+import pytest
+import zstandard
+
+from compression_utils import accepts_encoding, compressible_type
+
+CSV = b"".join(b"%d,name-%d,%d.5,some text here\n" % (i, i % 97, i * 3) for i in range(60000))
+
+
+@pytest.fixture
+def s3_only(app, monkeypatch):
+    # Keep every file in S3 rather than inline in its record
+    monkeypatch.setattr(app, "INLINE_MAX_SIZE", 0)
+    return app
+
+
+@pytest.mark.parametrize("content_type, filename, expected", [
+    ("text/csv", "data.csv", True),
+    ("application/octet-stream", "server.log", True),
+    ("image/svg+xml", "logo.svg", True),
+    ("image/jpeg", "photo.jpg", False),
+    ("application/zip", "archive.zip", False),
+    ("application/octet-stream", "archive.tar.gz", False),
+])
+def test_compressible_type(content_type, filename, expected):
+    assert compressible_type(content_type, filename) is expected
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("zstd", True),
+    ("gzip, zstd", True),
+    ("zstd;q=0.5", True),
+    ("zstd;q=0", False),
+    ("gzip", False),
+    ("*", False),
+    (None, False),
+])
+def test_accepts_encoding(header, expected):
+    assert accepts_encoding(header, "zstd") is expected
+
+
+def test_compressible_file_is_stored_compressed(client, share, s3_only):
+    file_id = share(files=[("files", ("data.csv", CSV, "text/csv"))])
+    record = s3_only.metadata_store.get(file_id)
+    assert record["size"] == len(CSV) and record["encoded_size"] < len(CSV) / 3
+    assert s3_only.content_encoding(record) == "zstd"
+
+    response = client.get(f"/download/{file_id}", headers={"Accept-Encoding": "identity"})
+    assert response.content == CSV
+    assert "content-encoding" not in response.headers
+    assert response.headers["content-length"] == str(len(CSV))
+
+
+def test_incompressible_file_is_stored_as_is(client, share, s3_only):
+    data = os.urandom(300000)
+    file_id = share(files=[("files", ("x.bin", data))])
+    assert "encoded_size" not in s3_only.metadata_store.get(file_id)
+    assert client.get(f"/download/{file_id}").content == data
+
+
+def test_passthrough_to_accepting_clients(client, share, s3_only):
+    file_id = share(files=[("files", ("data.csv", CSV, "text/csv"))])
+    with client.stream("GET", f"/download/{file_id}", headers={"Accept-Encoding": "gzip, zstd"}) as response:
+        raw = b"".join(response.iter_raw())
+        assert response.headers["content-encoding"] == "zstd"
+        assert response.headers["content-length"] == str(len(raw))
+    assert len(raw) == s3_only.metadata_store.get(file_id)["encoded_size"]
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(raw) == CSV
+
+
+def test_gzip_codec(client, share, s3_only, monkeypatch):
+    # The app fixture imported its own copy of the module
+    monkeypatch.setattr(sys.modules["compression_utils"], "COMPRESSION_CODEC", "gzip")
+    data = b"abc " * 100000
+    file_id = share(files=[("files", ("a.log", data, "text/plain"))])
+    with client.stream("GET", f"/download/{file_id}", headers={"Accept-Encoding": "gzip"}) as response:
+        raw = b"".join(response.iter_raw())
+        assert response.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(raw) == data
+    assert client.get(f"/download/{file_id}", headers={"Accept-Encoding": "identity"}).content == data
+
+
+@pytest.mark.parametrize("range_header, start, end", [
+    ("bytes=0-9", 0, 10),
+    ("bytes=1000-", 1000, len(CSV)),
+    ("bytes=-7", len(CSV) - 7, len(CSV)),
+    ("bytes=150000-150010", 150000, 150011),
+])
+def test_ranges_are_decompressed(client, share, s3_only, range_header, start, end):
+    file_id = share(files=[("files", ("data.csv", CSV, "text/csv"))])
+    response = client.get(f"/download/{file_id}", headers={"Range": range_header, "Accept-Encoding": "zstd"})
+    assert response.status_code == 206
+    assert response.content == CSV[start:end]
+    assert "content-encoding" not in response.headers
+
+
+def test_compressed_text_and_bundles(client, share, s3_only):
+    text = "hello world " * 500
+    file_id = share(text=text)
+    assert s3_only.metadata_store.get(file_id)["encoded_size"] < 500
+    assert client.get(f"/download/{file_id}").json()["content"] == text
+
+    data = os.urandom(3000)
+    file_id = share(files=[("files", ("data.csv", CSV, "text/csv")), ("files", ("x.bin", data))])
+    archive = zipfile.ZipFile(io.BytesIO(client.get(f"/download/{file_id}").content))
+    assert archive.read("data.csv") == CSV and archive.read("x.bin") == data
+    assert client.get(f"/download/{file_id}/data.csv", headers={"Accept-Encoding": "identity"}).content == CSV
+
+
+def test_compressed_protected_share(client, share, s3_only):
+    file_id = share(files=[("files", ("data.csv", CSV, "text/csv"))], password="pw")
+    assert "encoded_size" in s3_only.metadata_store.get(file_id)
+    assert client.get(f"/download/{file_id}?password=pw").content == CSV
@@ -0,0 +1,95 @@
+import io
+import os
+import zipfile
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+@pytest.fixture
+def dedup(app, monkeypatch):
+    monkeypatch.setattr(app, "DEDUP_ENABLED", True)
+    # Inline files are kept in their record, not deduplicated
+    monkeypatch.setattr(app, "INLINE_MAX_SIZE", 0)
+    return app
+
+
+def blob_refs(app):
+    return sorted(blob["refs"] for _, blob in app.blob_index.store.scan())
+
+
+def test_blob_refcounts(store):
+    now = datetime.now(timezone.utc)
+    assert store.acquire("hash", now) is None
+    assert store.reserve("hash", {"key": "blobs/hash", "size": 1, "refs": 1, "expires_at": now + timedelta(hours=1)})
+    # A reference lasts as long as the longest-lived share using the blob
+    blob = store.acquire("hash", now + timedelta(hours=2))
+    assert blob["refs"] == 2 and blob["expires_at"] == now + timedelta(hours=2)
+    assert store.release("hash", now)["refs"] == 1
+    assert store.consume("hash", now + timedelta(hours=1)) is None
+    # The last reference gone, the blob expires right away
+    assert store.release("hash", now) == {**blob, "refs": 0, "expires_at": now}
+    assert store.consume("hash", now + timedelta(seconds=1))["key"] == "blobs/hash"
+
+
+def test_identical_uploads_are_stored_once(client, share, stored_keys, dedup, monkeypatch):
+    data = os.urandom(5000)
+    uploads = []
+    upload_stream = dedup.s3_manager.upload_stream
+
+    async def counting(*args, **kwargs):
+        uploads.append(args)
+        return await upload_stream(*args, **kwargs)
+
+    monkeypatch.setattr(dedup.s3_manager, "upload_stream", counting)
+    file_ids = [share(files=[("files", ("a.bin", data))]) for _ in range(2)]
+    renamed = share(files=[("files", ("other.bin", data))])
+    bundle = share(files=[("files", ("x.bin", data)), ("files", ("y.bin", b"y" * 10))])
+    protected = share(files=[("files", ("a.bin", data))], password="pw")
+
+    # One blob for the shared content, one for y.bin, and the protected share's own copy
+    assert len(uploads) == 3
+    assert len([key for key in stored_keys() if key.startswith("blobs/")]) == 2
+    assert len(stored_keys()) == 3
+    assert blob_refs(dedup) == [1, 4]
+    assert dedup.blob_index.metrics["hits"] == 3
+
+    for file_id in file_ids:
+        assert client.get(f"/download/{file_id}").content == data
+    response = client.get(f"/download/{renamed}")
+    assert response.content == data and "other.bin" in response.headers["content-disposition"]
+    assert zipfile.ZipFile(io.BytesIO(client.get(f"/download/{bundle}").content)).read("x.bin") == data
+    assert client.get(f"/download/{protected}?password=pw").content == data
+
+
+def test_single_download_releases_its_reference(client, share, stored_keys, dedup):
+    data = os.urandom(5000)
+    kept = share(files=[("files", ("a.bin", data))])
+    single = share(files=[("files", ("a.bin", data))], policy="delete_after_first_download")
+    assert blob_refs(dedup) == [2]
+
+    assert client.get(f"/download/{single}").content == data
+    assert blob_refs(dedup) == [1]
+    assert client.get(f"/download/{kept}").content == data
+    assert len(stored_keys()) == 1
+
+
+def test_blob_reaper_removes_unreferenced_content(client, share, stored_keys, dedup, monkeypatch):
+    # Keep the app's own blob reaper asleep so the reaps below do all the work
+    monkeypatch.setattr(dedup.blob_reaper, "notify", lambda expires_at: None)
+    data = os.urandom(5000)
+    share(files=[("files", ("a.bin", data))])
+    longer = share(files=[("files", ("a.bin", data))], policy="store_1_day")
+    now = datetime.now(timezone.utc)
+
+    # The blob outlives the share that expired first
+    assert client.portal.call(dedup.expiry_reaper.reap, now + timedelta(hours=2)) == 1
+    assert client.portal.call(dedup.blob_reaper.reap, now + timedelta(hours=2)) == 0
+    assert blob_refs(dedup) == [1]
+    assert client.get(f"/download/{longer}").content == data
+
+    later = now + timedelta(days=2)
+    assert client.portal.call(dedup.expiry_reaper.reap, later) == 1
+    assert client.portal.call(dedup.blob_reaper.reap, later) == 1
+    assert stored_keys() == []
+    assert len(dedup.blob_index.store) == 0
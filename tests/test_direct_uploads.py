@@ -0,0 +1,127 @@
+import base64
+import os
+import struct
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import requests
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from encryption_utils import parse_stream_header
+
+
+@pytest.fixture
+def direct(app):
+    app.DIRECT_UPLOADS_ENABLED = True
+    return app
+
+
+def start(client, data: bytes, **fields) -> dict:
+    response = client.post("/upload/direct/", data={
+        "filename": "d.bin",
+        "size": str(len(data)),
+        "content_type": "application/x-test",
+        "expiration_policy": "store_1_hour",
+        **fields,
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def send_parts(upload: dict, data: bytes) -> list:
+    """Encrypt and PUT every part as the browser does; returns the completed parts."""
+    header = base64.b64decode(upload["header"])
+    nonce_prefix = parse_stream_header(header).nonce_prefix
+    aesgcm = AESGCM(base64.b64decode(upload["data_key"]))
+    chunk_size = upload["chunk_size"]
+    chunks = max(1, -(-len(data) // chunk_size))
+    parts = []
+    for part, url in enumerate(upload["part_urls"]):
+        body = [header] if part == 0 else []
+        for index in range(part * upload["part_chunks"], min((part + 1) * upload["part_chunks"], chunks)):
+            nonce = nonce_prefix + struct.pack(">IB", index, int(index == chunks - 1))
+            body.append(aesgcm.encrypt(nonce, data[index * chunk_size:(index + 1) * chunk_size], header))
+        response = requests.put(url, data=b"".join(body))
+        assert response.ok, response.text
+        parts.append({"part_number": part + 1, "etag": response.headers["ETag"]})
+    return parts
+
+
+def complete(client, upload: dict, parts: list, token=None):
+    return client.post(
+        f"/upload/direct/{upload['file_id']}/complete",
+        json={"parts": parts},
+        headers={"X-Upload-Token": upload["token"] if token is None else token},
+    )
+
+
+def test_disabled_by_default(client):
+    assert client.post("/upload/direct/", data={"filename": "a.bin", "size": "1"}).status_code == 404
+
+
+def test_direct_upload(client, direct):
+    data = os.urandom(12 * 1024 * 1024 + 5)
+    upload = start(client, data)
+    assert len(upload["part_urls"]) >= 2
+    assert complete(client, upload, send_parts(upload, data)).status_code == 200
+    assert len(direct.upload_session_store) == 0
+
+    response = client.get(f"/download/{upload['file_id']}")
+    assert response.content == data
+    assert response.headers["content-type"] == "application/x-test"
+    response = client.get(f"/download/{upload['file_id']}", headers={"Range": "bytes=5000000-5000100"})
+    assert response.status_code == 206 and response.content == data[5000000:5000101]
+
+
+def test_empty_direct_upload(client, direct):
+    upload = start(client, b"")
+    assert complete(client, upload, send_parts(upload, b"")).status_code == 200
+    assert client.get(f"/download/{upload['file_id']}").content == b""
+
+
+def test_completion_needs_the_token(client, direct):
+    data = os.urandom(3000)
+    upload = start(client, data)
+    parts = send_parts(upload, data)
+    assert complete(client, upload, parts, token="").status_code == 404
+    assert complete(client, upload, parts, token="guess").status_code == 404
+    # The session was not claimed by the failed attempts
+    assert complete(client, upload, parts).status_code == 200
+    assert client.get(f"/download/{upload['file_id']}").content == data
+
+
+def test_direct_session_is_not_a_resumable_one(client, direct):
+    upload = start(client, b"abc")
+    headers = {"X-Upload-Token": upload["token"]}
+    assert client.get(f"/upload/sessions/{upload['file_id']}", headers=headers).status_code == 404
+
+
+def test_missing_parts_keep_the_session(client, direct):
+    data = os.urandom(3000)
+    upload = start(client, data)
+    parts = send_parts(upload, data)
+    assert complete(client, upload, []).status_code == 400
+    assert complete(client, upload, parts).status_code == 200
+
+
+def test_wrong_size_is_rejected(client, direct, stored_keys):
+    upload = start(client, os.urandom(3000))
+    assert complete(client, upload, send_parts(upload, os.urandom(2000))).status_code == 400
+    assert client.get(f"/download/{upload['file_id']}").status_code == 404
+    assert stored_keys() == []
+
+
+def test_password_protected_direct_upload(client, direct):
+    data = os.urandom(3000)
+    upload = start(client, data, password="s3cret")
+    assert "s3cret" not in repr(direct.upload_session_store.get(upload["file_id"]))
+    assert complete(client, upload, send_parts(upload, data)).status_code == 200
+    assert client.get(f"/download/{upload['file_id']}").status_code == 401
+    assert client.get(f"/download/{upload['file_id']}?password=s3cret").content == data
+
+
+def test_stale_sessions_are_reaped(client, direct):
+    upload = start(client, b"abc")
+    reaped = client.portal.call(direct.upload_session_reaper.reap, datetime.now(timezone.utc) + timedelta(days=2))
+    assert reaped == 1 and len(direct.upload_session_store) == 0
+    assert complete(client, upload, []).status_code == 404
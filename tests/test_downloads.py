@@ -0,0 +1,124 @@
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from main import parse_range
+
+SIZE = 100
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("items=0-1", None),
+    ("bytes=0-1,5-6", None),
+    ("bytes=a-b", None),
+    ("bytes=0-0", (0, 0)),
+    ("bytes=0-", (0, SIZE - 1)),
+    ("bytes=10-19", (10, 19)),
+    ("bytes=99-", (SIZE - 1, SIZE - 1)),
+    ("bytes=50-1000", (50, SIZE - 1)),
+    ("bytes=-1", (SIZE - 1, SIZE - 1)),
+    ("bytes=-10", (SIZE - 10, SIZE - 1)),
+    ("bytes=-1000", (0, SIZE - 1)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=100-", SIZE),
+    ("bytes=20-10", SIZE),
+    ("bytes=-0", SIZE),
+    ("bytes=0-", 0),
+    ("bytes=-5", 0),
+])
+def test_unsatisfiable_range(header, size):
+    with pytest.raises(HTTPException) as error:
+        parse_range(header, size)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == f"bytes */{size}"
+
+
+@pytest.fixture
+def stored(app, monkeypatch, share):
+    """Upload a file kept in S3 and return its content and file ID."""
+    monkeypatch.setattr(app, "INLINE_MAX_SIZE", 0)
+
+    def stored(size: int = 5500, policy: str = "store_1_hour"):
+        data = os.urandom(size)
+        return data, share(files=[("files", ("a.bin", data))], policy=policy)
+    return stored
+
+
+@pytest.mark.parametrize("header, start, end", [
+    ("bytes=0-0", 0, 0),
+    ("bytes=999-1001", 999, 1001),  # across a chunk boundary
+    ("bytes=1024-2047", 1024, 2047),  # exactly one chunk
+    ("bytes=1000-", 1000, 5499),
+    ("bytes=-10", 5490, 5499),
+    ("bytes=5000-99999", 5000, 5499),
+])
+def test_range_request(client, stored, header, start, end):
+    data, file_id = stored()
+    response = client.get(f"/download/{file_id}", headers={"Range": header})
+    assert response.status_code == 206
+    assert response.content == data[start:end + 1]
+    assert response.headers["content-length"] == str(end - start + 1)
+    assert response.headers["content-range"] == f"bytes {start}-{end}/5500"
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+def test_range_fetches_only_its_chunks(client, stored, app, monkeypatch):
+    data, file_id = stored(size=10 * 1024)
+    ranges = []
+    manager = app.s3_manager.manager
+    open_file = manager.open_file
+
+    def recording_open_file(key, byte_range=None):
+        ranges.append(byte_range)
+        return open_file(key, byte_range)
+    monkeypatch.setattr(manager, "open_file", recording_open_file)
+    response = client.get(f"/download/{file_id}", headers={"Range": "bytes=4096-4100"})
+    assert response.content == data[4096:4101]
+    first, last = ranges[0]
+    # One encrypted chunk (1 KiB + tag) rather than the whole object
+    assert last - first + 1 == 1024 + 16
+
+
+def test_unsatisfiable_range_request(client, stored):
+    _, file_id = stored()
+    response = client.get(f"/download/{file_id}", headers={"Range": "bytes=6000-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */5500"
+
+
+def test_single_download_ignores_range(client, stored, stored_keys):
+    data, file_id = stored(size=3000, policy="delete_after_first_download")
+    response = client.get(f"/download/{file_id}", headers={"Range": "bytes=0-99"})
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["accept-ranges"] == "none"
+    assert client.get(f"/download/{file_id}", headers={"Range": "bytes=0-99"}).status_code == 404
+    assert stored_keys() == []
+
+
+def test_single_download_removes_objects_when_blob_release_fails(client, stored, stored_keys, app, monkeypatch):
+    data, file_id = stored(size=3000, policy="delete_after_first_download")
+
+    def busy(record):
+        raise HTTPException(status_code=503, detail="Server is busy, please retry shortly")
+    monkeypatch.setattr(app.blob_index, "release", busy)
+    assert client.get(f"/download/{file_id}").content == data
+    assert stored_keys() == []
+
+
+def test_single_download_of_text(client, share):
+    file_id = share(text="once", policy="delete_after_first_download")
+    assert client.get(f"/download/{file_id}").json()["content"] == "once"
+    assert client.get(f"/download/{file_id}").status_code == 404
+
+
+def test_missing_share(client):
+    assert client.get("/download/NOPE42").status_code == 404
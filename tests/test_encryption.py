@@ -0,0 +1,111 @@
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from encryption_utils import (
+    TAG_SIZE, StreamDecryptor, StreamEncryptor, chunk_count, encrypted_size, parse_stream_header,
+)
+
+CHUNK_SIZE = 64
+KEY = AESGCM(bytes(range(32)))
+
+
+def encrypt(plaintext: bytes, piece_size: int = 10, metadata=None) -> StreamEncryptor:
+    """Encrypt plaintext fed in pieces; returns the encryptor with .stream set."""
+    encryptor = StreamEncryptor(KEY, CHUNK_SIZE, metadata)
+    out = [encryptor.header]
+    for offset in range(0, len(plaintext), piece_size):
+        out.append(encryptor.update(plaintext[offset:offset + piece_size]))
+    out.append(encryptor.finalize())
+    encryptor.stream = b"".join(out)
+    return encryptor
+
+
+def decrypt(stream: bytes, piece_size: int = 7) -> bytes:
+    decryptor = StreamDecryptor(KEY, stream)
+    body = stream[len(decryptor.header):]
+    out = [decryptor.update(body[offset:offset + piece_size]) for offset in range(0, len(body), piece_size)]
+    out.append(decryptor.finalize())
+    return b"".join(out)
+
+
+def chunks(encryptor: StreamEncryptor):
+    """The sealed chunks of an encrypted stream, without its header."""
+    body = encryptor.stream[len(encryptor.header):]
+    size = CHUNK_SIZE + TAG_SIZE
+    return [body[offset:offset + size] for offset in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize("size", [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 5 * CHUNK_SIZE, 1000])
+def test_round_trip(size):
+    plaintext = os.urandom(size)
+    encryptor = encrypt(plaintext)
+    assert len(encryptor.stream) == encrypted_size(size, CHUNK_SIZE, len(encryptor.header))
+    assert len(chunks(encryptor)) == chunk_count(size, CHUNK_SIZE)
+    assert decrypt(encryptor.stream) == plaintext
+
+
+def test_empty_file_is_one_final_chunk():
+    encryptor = encrypt(b"")
+    assert chunks(encryptor) and len(chunks(encryptor)[0]) == TAG_SIZE
+    assert decrypt(encryptor.stream) == b""
+
+
+def test_header_metadata_is_authenticated():
+    encryptor = encrypt(b"hello", metadata={"filename": "a.txt"})
+    header = parse_stream_header(encryptor.stream)
+    assert header.metadata == {"filename": "a.txt"}
+
+    tampered = encryptor.stream.replace(b"a.txt", b"b.txt")
+    with pytest.raises(InvalidTag):
+        decrypt(tampered)
+
+
+def test_truncated_stream_is_rejected():
+    encryptor = encrypt(os.urandom(3 * CHUNK_SIZE))
+    # Dropping whole chunks leaves a non-final chunk where the final one should be
+    truncated = encryptor.header + b"".join(chunks(encryptor)[:-1])
+    with pytest.raises(InvalidTag):
+        decrypt(truncated)
+    with pytest.raises(ValueError):
+        decrypt(encryptor.header)
+
+
+def test_reordered_chunks_are_rejected():
+    encryptor = encrypt(os.urandom(3 * CHUNK_SIZE + 5))
+    sealed = chunks(encryptor)
+    reordered = encryptor.header + sealed[1] + sealed[0] + b"".join(sealed[2:])
+    with pytest.raises(InvalidTag):
+        decrypt(reordered)
+
+
+def test_extended_stream_is_rejected():
+    encryptor = encrypt(os.urandom(2 * CHUNK_SIZE))
+    sealed = chunks(encryptor)
+    # A final chunk followed by more data: the final chunk is opened as non-final
+    with pytest.raises(InvalidTag):
+        decrypt(encryptor.stream + sealed[0])
+
+
+def test_decrypt_range_of_chunks():
+    plaintext = os.urandom(5 * CHUNK_SIZE + 3)
+    encryptor = encrypt(plaintext)
+    sealed = chunks(encryptor)
+
+    # final_index is the stream's last chunk, so chunks before it need no finalize()
+    decryptor = StreamDecryptor(KEY, encryptor.header, first_index=1, final_index=5)
+    assert decryptor.update(b"".join(sealed[1:3])) + decryptor.finalize() == plaintext[CHUNK_SIZE:3 * CHUNK_SIZE]
+
+    decryptor = StreamDecryptor(KEY, encryptor.header, first_index=4, final_index=5)
+    assert decryptor.update(b"".join(sealed[4:])) + decryptor.finalize() == plaintext[4 * CHUNK_SIZE:]
+
+
+def test_chunks_encrypted_separately_join_into_one_stream():
+    plaintext = os.urandom(4 * CHUNK_SIZE)
+    first = StreamEncryptor(KEY, CHUNK_SIZE)
+    part = first.update(plaintext[:2 * CHUNK_SIZE]) + first.finalize(final=False)
+    second = StreamEncryptor(KEY, CHUNK_SIZE, header=first.header, first_index=2)
+    rest = second.update(plaintext[2 * CHUNK_SIZE:]) + second.finalize()
+    assert decrypt(first.header + part + rest) == plaintext
@@ -0,0 +1,68 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from id_utils import IdAllocator
+
+
+def expires_at():
+    return datetime.now(timezone.utc) + timedelta(hours=1)
+
+
+def test_allocates_until_keyspace_is_full(store):
+    allocator = IdAllocator(store, alphabet="AB", length=3, max_attempts=200)
+    file_ids = {allocator.allocate(expires_at()) for _ in range(8)}
+    assert len(file_ids) == 8 and len(store) == 8
+    assert all(store.get(file_id)["pending"] for file_id in file_ids)
+    assert allocator.metrics["occupancy"] == 1
+
+    collisions = allocator.collisions
+    with pytest.raises(HTTPException) as error:
+        allocator.allocate(expires_at())
+    assert error.value.status_code == 503
+    assert allocator.collisions == collisions + 200
+
+
+def test_taken_candidates_are_retried(store, monkeypatch):
+    allocator = IdAllocator(store)
+    store.put("TAKEN", {"filename": "a.txt", "expires_at": expires_at()})
+    candidates = iter(["TAKEN", "TAKEN", "FREE"])
+    monkeypatch.setattr(allocator, "generate", lambda: next(candidates))
+    assert allocator.allocate(expires_at()) == "FREE"
+    assert allocator.collisions == 2
+    assert store.get("TAKEN")["filename"] == "a.txt"
+
+
+def test_token_suffix(store):
+    file_id = IdAllocator(store, length=6, token_bytes=16).generate()
+    code, token = file_id.split("-", 1)
+    assert len(code) == 6 and len(token) >= 21
+
+
+def test_pending_ids_are_not_shares(client, app):
+    file_id = client.portal.call(app.allocate_id)
+    assert client.get(f"/download/{file_id}").status_code == 404
+    assert client.get(f"/info/{file_id}").status_code == 404
+    app.release_id(file_id)
+    assert app.metadata_store.get(file_id) is None
+
+
+def test_lapsed_reservation_removes_upload(client, app, stored_keys, monkeypatch):
+    monkeypatch.setattr(app, "INLINE_MAX_SIZE", 0)
+    store_file = app.store_file
+    other = {"filename": "other.txt", "size": 1, "expires_at": expires_at()}
+
+    async def lapsing(file_key, *args, **kwargs):
+        record = await store_file(file_key, *args, **kwargs)
+        # The reservation is reaped meanwhile and its ID goes to another share
+        app.metadata_store.put(file_key.split("/")[0], other)
+        return record
+
+    monkeypatch.setattr(app, "store_file", lapsing)
+    response = client.post("/upload/", data={"expiration_policy": "store_1_hour"},
+                           files={"files": ("a.bin", os.urandom(3000))})
+    assert response.status_code == 410
+    assert stored_keys() == []
+    assert other in [record for _, record in app.metadata_store.scan()]
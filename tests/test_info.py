@@ -0,0 +1,51 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+
+def test_info_does_not_touch_s3_or_consume(client, share, app, monkeypatch):
+    text = "héllo " * 2000
+    file_id = share(text=text, policy="delete_after_first_download")
+    reads = []
+    stream_file = app.s3_manager.stream_file
+
+    async def spy(*args, **kwargs):
+        reads.append(args)
+        return await stream_file(*args, **kwargs)
+
+    monkeypatch.setattr(app.s3_manager, "stream_file", spy)
+    info = client.get(f"/info/{file_id}?preview=true").json()
+    assert info["single_download"] and not info["password_required"]
+    listing = info["files"][0]
+    assert listing["size"] == len(text.encode())
+    assert listing["has_preview"] and listing["preview_truncated"]
+    assert text.startswith(listing["preview"]) and len(listing["preview"]) > 1000
+    assert reads == []
+    # Still there for its one download
+    assert client.get(f"/download/{file_id}").json()["content"] == text
+    assert client.get(f"/info/{file_id}").status_code == 404
+
+
+def test_info_of_protected_bundle(client, share):
+    file_id = share(files=[("files", ("b.bin", os.urandom(3000)))], text="note", password="pw")
+    info = client.get(f"/info/{file_id}").json()
+    assert info["password_required"] and "files" not in info
+    assert client.get(f"/info/{file_id}?password=bad").status_code == 403
+
+    info = client.get(f"/info/{file_id}?password=pw&preview=true").json()
+    assert [listing["filename"] for listing in info["files"]] == ["shared-text.txt", "b.bin"]
+    assert info["files"][0]["preview"] == "note" and not info["files"][0]["preview_truncated"]
+    assert not info["files"][1]["has_preview"]
+
+
+def test_single_download_follows_policy(client, share, app):
+    file_id = share(text="hi", policy="store_1_hour")
+    # A share about to expire is not a single-download one
+    record = app.metadata_store.get(file_id)
+    app.metadata_store.put(file_id, {**record, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=60)})
+    assert client.get(f"/info/{file_id}").json()["single_download"] is False
+    assert client.get(f"/download/{file_id}").json()["content"] == "hi"
+    assert client.get(f"/download/{file_id}").json()["content"] == "hi"
+
+
+def test_info_of_missing_share(client):
+    assert client.get("/info/nope").status_code == 404
@@ -0,0 +1,36 @@
+import os
+
+
+def stored_records(app, file_id):
+    record = app.metadata_store.get(file_id)
+    return record.get("members") or [record]
+
+
+def test_small_shares_stay_out_of_s3(client, share, app, stored_keys):
+    text_id = share(text="hello inline")
+    data = os.urandom(3000)
+    file_id = share(files=[("files", ("s.bin", data))])
+    assert stored_keys() == []
+    for stored in stored_records(app, text_id) + stored_records(app, file_id):
+        assert "inline" in stored and "key" not in stored
+
+    assert client.get(f"/download/{text_id}").json()["content"] == "hello inline"
+    assert client.get(f"/download/{file_id}").content == data
+    response = client.get(f"/download/{file_id}", headers={"Range": "bytes=1000-2500"})
+    assert response.status_code == 206 and response.content == data[1000:2501]
+
+
+def test_inline_single_download_and_password(client, share):
+    file_id = share(text="hello once", policy="delete_after_first_download")
+    assert client.get(f"/download/{file_id}").json()["content"] == "hello once"
+    assert client.get(f"/download/{file_id}").status_code == 404
+
+    file_id = share(text="secret", password="pw")
+    assert client.get(f"/download/{file_id}?password=pw").json()["content"] == "secret"
+
+
+def test_larger_files_go_to_s3(client, share, app, stored_keys):
+    data = os.urandom(app.INLINE_MAX_SIZE + 1)
+    file_id = share(files=[("files", ("b.bin", data))])
+    assert len(stored_keys()) == 1
+    assert client.get(f"/download/{file_id}").content == data
@@ -0,0 +1,133 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from metadata_utils import SQLiteMetadataStore, run_store
+
+THREADS = 8
+
+
+def make_record(**fields):
+    # Whole seconds survive the SQLite store's timestamp column unchanged
+    expires_at = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(hours=1)
+    return {"filename": "a.txt", "size": 1, **fields, "expires_at": expires_at}
+
+
+def run_concurrently(function, arguments):
+    with ThreadPoolExecutor(THREADS) as pool:
+        return list(pool.map(function, arguments))
+
+
+def test_reserve_only_once(store):
+    assert store.reserve("id", make_record(pending=True))
+    assert not store.reserve("id", make_record())
+    assert store.get("id")["pending"] is True
+
+
+def test_concurrent_reserve_has_one_winner(store):
+    results = run_concurrently(lambda i: store.reserve("id", make_record(owner=i)), range(THREADS * 4))
+    assert results.count(True) == 1
+    assert store.get("id")["owner"] == results.index(True)
+
+
+def test_consume_returns_record_once(store):
+    record = make_record()
+    store.put("id", record)
+    assert store.consume("id") == record
+    assert store.consume("id") is None
+    assert store.get("id") is None
+
+
+def test_consume_only_expired(store):
+    record = make_record()
+    store.put("id", record)
+    assert store.consume("id", expired_before=record["expires_at"]) is None
+    assert store.consume("id", expired_before=record["expires_at"] + timedelta(seconds=1)) == record
+
+
+def test_concurrent_consume_has_one_winner(store):
+    for attempt in range(20):
+        store.put(f"id{attempt}", make_record())
+        results = run_concurrently(lambda _: store.consume(f"id{attempt}"), range(THREADS))
+        assert sum(result is not None for result in results) == 1
+
+
+def test_put_get_delete(store):
+    record = make_record(members=[{"key": "k", "filename": "a.txt"}])
+    store.put("id", record)
+    assert store.get("id") == record
+    store.delete("id")
+    assert store.get("id") is None
+    assert len(store) == 0
+
+
+def test_expiring_and_next_expiry(store):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    assert store.next_expiry() is None
+    for index, minutes in enumerate([30, -10, -20, 60]):
+        store.put(f"id{index}", {**make_record(), "expires_at": now + timedelta(minutes=minutes)})
+    assert [file_id for file_id, _ in store.expiring(now)] == ["id2", "id1"]
+    assert [file_id for file_id, _ in store.expiring(now, limit=1)] == ["id2"]
+    assert store.next_expiry() == now - timedelta(minutes=20)
+
+
+def test_replace_compares_and_swaps(store):
+    record = make_record()
+    store.put("id", record)
+    assert store.replace("id", record, {**record, "size": 2})
+    # The stored record changed, so a swap expecting the old one fails
+    assert not store.replace("id", record, {**record, "size": 3})
+    assert store.get("id")["size"] == 2
+    assert not store.replace("missing", record, record)
+
+
+def test_replace_ignores_and_sets_expiry(store):
+    record = make_record(pending=True)
+    store.put("id", record)
+    later = {**record, "pending": False, "expires_at": record["expires_at"] + timedelta(days=1)}
+    assert store.replace("id", {**record, "expires_at": datetime.now(timezone.utc)}, later)
+    assert store.get("id") == later
+
+
+def test_concurrent_replace_has_one_winner(store):
+    record = make_record()
+    store.put("id", record)
+    results = run_concurrently(lambda i: store.replace("id", record, {**record, "owner": i}), range(THREADS * 4))
+    assert results.count(True) == 1
+    assert store.get("id")["owner"] == results.index(True)
+
+
+def test_scan_and_count_by(store):
+    for index in range(5):
+        store.put(f"id{index}", make_record(policy="store_1_hour" if index % 2 else "store_1_day"))
+    assert [file_id for file_id, _ in store.scan(limit=2)] == ["id0", "id1"]
+    assert [file_id for file_id, _ in store.scan("id1", limit=10)] == ["id2", "id3", "id4"]
+    assert store.count_by("policy") == {"store_1_day": 3, "store_1_hour": 2}
+    assert len(store) == 5
+
+
+def test_lock_waits_do_not_block_the_event_loop(tmp_path):
+    path = str(tmp_path / "metadata.db")
+    store = SQLiteMetadataStore(path)
+    # Another worker holding the write lock for a while
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+
+    async def write_while_locked() -> int:
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+        ticker = asyncio.create_task(tick())
+        asyncio.get_running_loop().call_later(0.3, other.execute, "COMMIT")
+        await run_store(store.put, "id", make_record())
+        ticker.cancel()
+        return ticks
+
+    # The write waited for the lock instead of failing, and the loop kept running
+    assert asyncio.run(write_while_locked()) >= 10
+    assert store.get("id") is not None
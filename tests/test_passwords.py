@@ -0,0 +1,98 @@
+import asyncio
+import os
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import password_utils
+from password_utils import PasswordVerifier
+from pool_utils import WorkerPool
+
+
+@pytest.fixture(autouse=True)
+def cheap_scrypt(monkeypatch):
+    # Lower the cost of new hashes; the parameters are stored with each hash
+    monkeypatch.setattr(password_utils, "PASSWORD_SCRYPT_N", 2 ** 10)
+
+
+def burst(verifier: PasswordVerifier, record: dict, passwords: list, file_id: str = "ABC123") -> list:
+    """Check passwords concurrently; returns the status code (200 for a match) of each."""
+    async def attempt(password: str) -> int:
+        try:
+            await verifier.verify(file_id, password, record)
+        except HTTPException as e:
+            return e.status_code
+        return 200
+
+    async def run() -> list:
+        return await asyncio.gather(*(attempt(password) for password in passwords))
+    return asyncio.run(run())
+
+
+def test_check_round_trip():
+    data_key = os.urandom(32)
+    record = password_utils.protect("s3cret", data_key)
+    assert "s3cret" not in repr(record)
+    assert password_utils.check("s3cret", record) == (True, data_key)
+    assert password_utils.check("S3cret", record) == (False, None)
+
+
+def test_legacy_plaintext_password():
+    assert password_utils.check("old", {"password": "old"}) == (True, None)
+    assert password_utils.check("new", {"password": "old"}) == (False, None)
+
+
+def test_failures_are_limited_per_file_id():
+    verifier = PasswordVerifier(WorkerPool(max_workers=2, max_queue=8), max_failures=3)
+    record = password_utils.protect("s3cret")
+    assert burst(verifier, record, ["wrong"] * 3) == [403] * 3
+    assert burst(verifier, record, ["s3cret"]) == [429]
+    # Other shares are not affected
+    assert burst(verifier, record, ["s3cret"], file_id="XYZ789") == [200]
+
+
+def test_concurrent_guesses_are_limited():
+    # Every guess of a burst is admitted before any of them has failed
+    verifier = PasswordVerifier(WorkerPool(max_workers=4, max_queue=200), max_failures=5)
+    record = password_utils.protect("s3cret")
+    statuses = burst(verifier, record, ["wrong"] * 100)
+    assert statuses.count(403) == 5
+    assert statuses.count(429) == 95
+
+
+def test_correct_passwords_do_not_count():
+    verifier = PasswordVerifier(WorkerPool(max_workers=2, max_queue=8), max_failures=2)
+    record = password_utils.protect("s3cret")
+    assert burst(verifier, record, ["s3cret"] * 10) == [200] * 10
+    assert burst(verifier, record, ["wrong", "s3cret"]) == [403, 200]
+    assert verifier.metrics["limited_file_ids"] == 1
+
+
+def test_password_share(client, share, app):
+    data = os.urandom(5000)
+    file_id = share(files=[("files", ("p.bin", data))], password="s3cret")
+    record = app.metadata_store.get(file_id)
+    assert record["password"]["kdf"] == "scrypt"
+    assert "data_key" not in record and "password_data_key" in record
+    assert client.get(f"/download/{file_id}").status_code == 401
+    assert client.get(f"/download/{file_id}?password=nope").status_code == 403
+    assert client.get(f"/download/{file_id}?password=s3cret").content == data
+
+
+def test_concurrent_guesses_through_the_app(client, share, app):
+    file_id = share(text="secret text", password="s3cret")
+
+    async def guess() -> list:
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            responses = await asyncio.gather(*(
+                http.get(f"/download/{file_id}?password=wrong{index}") for index in range(50)
+            ))
+        return [response.status_code for response in responses]
+
+    statuses = asyncio.run(guess())
+    assert statuses.count(403) == password_utils.PASSWORD_MAX_FAILURES
+    assert statuses.count(429) == 50 - password_utils.PASSWORD_MAX_FAILURES
+    response = client.get(f"/download/{file_id}?password=s3cret")
+    assert response.status_code == 429 and "retry-after" in response.headers
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from prometheus_client import REGISTRY
+
+
+@pytest.fixture
+def s3_only(app, monkeypatch):
+    # Keep every file in S3 rather than inline in its record
+    monkeypatch.setattr(app, "INLINE_MAX_SIZE", 0)
+    return app
+
+
+def sample(name, reaper="files"):
+    return REGISTRY.get_sample_value(name, {"reaper": reaper}) or 0
+
+
+def test_reaps_expired_shares(client, share, stored_keys, s3_only):
+    file_ids = [share(files=[("files", (f"{i}.bin", b"x" * 100))]) for i in range(3)]
+    assert len(stored_keys()) == 3
+    assert client.portal.call(s3_only.expiry_reaper.reap, datetime.now(timezone.utc)) == 0
+
+    reaped = client.portal.call(s3_only.expiry_reaper.reap, datetime.now(timezone.utc) + timedelta(hours=2))
+    assert reaped == 3
+    assert stored_keys() == []
+    for file_id in file_ids:
+        assert client.get(f"/download/{file_id}").status_code == 404
+
+
+def test_batches_are_exported(client, share, s3_only):
+    batches = sample("swiftshare_reaper_batch_size_count")
+    objects = sample("swiftshare_reaper_batch_size_sum")
+    lags = sample("swiftshare_reaper_lag_seconds_count")
+    for i in range(2):
+        share(files=[("files", (f"{i}.bin", b"x" * 100))])
+
+    client.portal.call(s3_only.expiry_reaper.reap, datetime.now(timezone.utc) + timedelta(hours=2))
+    assert sample("swiftshare_reaper_batch_size_count") == batches + 1
+    assert sample("swiftshare_reaper_batch_size_sum") == objects + 2
+    assert sample("swiftshare_reaper_lag_seconds_count") == lags + 1
+    assert 'swiftshare_reaper_batch_size_bucket{le="5.0",reaper="files"}' in client.get("/metrics").text
@@ -0,0 +1,114 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+
+def start(client, data: bytes, **fields) -> dict:
+    response = client.post("/upload/sessions/", data={
+        "filename": "r.bin",
+        "size": str(len(data)),
+        "expiration_policy": "store_1_hour",
+        **fields,
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def put_chunk(client, session: dict, index: int, data: bytes, token=None):
+    size = session["chunk_size"]
+    return client.put(
+        f"/upload/sessions/{session['file_id']}/chunks/{index}",
+        content=data[index * size:(index + 1) * size],
+        headers={"X-Upload-Token": session["token"] if token is None else token},
+    )
+
+
+def complete(client, session: dict):
+    return client.post(f"/upload/sessions/{session['file_id']}/complete",
+                       headers={"X-Upload-Token": session["token"]})
+
+
+def test_chunks_in_any_order(client):
+    data = os.urandom(17 * 1024 * 1024 + 333)
+    session = start(client, data)
+    assert session["chunk_count"] == 3
+    for index in reversed(range(session["chunk_count"])):
+        assert put_chunk(client, session, index, data).status_code == 200
+    status = client.get(f"/upload/sessions/{session['file_id']}", headers={"X-Upload-Token": session["token"]})
+    assert status.json()["received"] == [0, 1, 2]
+
+    assert complete(client, session).status_code == 200
+    assert client.get(f"/download/{session['file_id']}").content == data
+    response = client.get(f"/download/{session['file_id']}", headers={"Range": "bytes=8388600-8388620"})
+    assert response.status_code == 206 and response.content == data[8388600:8388621]
+    # The session is used up
+    assert complete(client, session).status_code == 404
+
+
+def test_small_and_empty_files(client):
+    for data in (b"", os.urandom(3000)):
+        session = start(client, data)
+        assert put_chunk(client, session, 0, data).status_code == 200
+        assert complete(client, session).status_code == 200
+        assert client.get(f"/download/{session['file_id']}").content == data
+
+
+def test_missing_chunks_keep_the_session(client):
+    data = os.urandom(9 * 1024 * 1024)
+    session = start(client, data)
+    assert put_chunk(client, session, 1, data).status_code == 200
+    response = complete(client, session)
+    assert response.status_code == 400 and "[0]" in response.text
+    assert client.get(f"/download/{session['file_id']}").status_code == 404
+
+    assert put_chunk(client, session, 0, data).status_code == 200
+    assert complete(client, session).status_code == 200
+    assert client.get(f"/download/{session['file_id']}").content == data
+
+
+def test_token_required(client):
+    data = os.urandom(3000)
+    session = start(client, data)
+    assert put_chunk(client, session, 0, data, token="wrong").status_code == 404
+    assert put_chunk(client, session, 0, data, token="").status_code == 404
+    response = client.get(f"/upload/sessions/{session['file_id']}", headers={"X-Upload-Token": "wrong"})
+    assert response.status_code == 404
+
+
+def test_chunk_of_wrong_size_rejected(client):
+    data = os.urandom(3000)
+    session = start(client, data)
+    assert put_chunk(client, session, 0, data[:-1]).status_code == 400
+    assert put_chunk(client, session, 1, data).status_code == 400
+
+
+def test_password_protected(client, app):
+    data = os.urandom(3000)
+    session = start(client, data, password="s3cret")
+    assert "s3cret" not in repr(app.upload_session_store.get(session["file_id"]))
+    assert put_chunk(client, session, 0, data).status_code == 200
+    assert complete(client, session).status_code == 200
+    assert client.get(f"/download/{session['file_id']}").status_code == 401
+    assert client.get(f"/download/{session['file_id']}?password=s3cret").content == data
+
+
+def test_compressible_files_use_the_form_upload(client, app, monkeypatch):
+    assert client.post("/upload/sessions/", data={
+        "filename": "data.csv", "size": "10", "expiration_policy": "store_1_hour",
+    }).status_code == 409
+
+    monkeypatch.setattr(app, "COMPRESSION_ENABLED", False)
+    data = b"abc" * 1000
+    session = start(client, data, filename="notes.txt", content_type="text/plain")
+    assert put_chunk(client, session, 0, data).status_code == 200
+    assert complete(client, session).status_code == 200
+    listing = client.get(f"/info/{session['file_id']}?preview=true").json()["files"][0]
+    assert listing["preview"] == data[:4096].decode() and not listing["preview_truncated"]
+
+
+def test_stale_sessions_are_reaped(client, app):
+    data = os.urandom(3000)
+    session = start(client, data)
+    assert put_chunk(client, session, 0, data).status_code == 200
+    reaped = client.portal.call(app.upload_session_reaper.reap, datetime.now(timezone.utc) + timedelta(days=2))
+    assert reaped == 1 and len(app.upload_session_store) == 0
+    assert complete(client, session).status_code == 404
@@ -0,0 +1,88 @@
+import base64
+import os
+
+import pytest
+
+NEW_KEY = base64.b64encode(b"n" * 32).decode()
+
+
+@pytest.fixture
+def rotating(monkeypatch):
+    # Shares are stored under master key 1 until the test moves to key 2
+    monkeypatch.setenv("ENCRYPTION_KEYS", f"2:{NEW_KEY}")
+    monkeypatch.setenv("ENCRYPTION_KEY_VERSION", "1")
+
+
+def headers(record):
+    return [entry["header"] for entry in [record, *record.get("members", [])] if "header" in entry]
+
+
+def wrapped_keys(record):
+    entries = [record, *record.get("members", [])]
+    entries += [entry["preview"] for entry in entries if "preview" in entry]
+    return [entry["data_key"] for entry in entries if "data_key" in entry]
+
+
+def test_rotation_rewraps_every_data_key(rotating, client, share, app, stored_keys, monkeypatch):
+    monkeypatch.setattr(app, "INLINE_MAX_SIZE", 0)
+    data = os.urandom(5000)
+    file_ids = {
+        "file": share(files=[("files", ("a.bin", data))]),
+        "text": share(text="hello there"),
+        "bundle": share(files=[("files", ("b.bin", data))], text="note"),
+    }
+    before = {name: app.metadata_store.get(file_id) for name, file_id in file_ids.items()}
+    assert all(key.startswith("1:") for record in before.values() for key in wrapped_keys(record))
+    manager = app.s3_manager.manager
+    etags = lambda: {key: manager.client.head_object(Bucket=manager.bucket_name, Key=key)["ETag"] for key in stored_keys()}
+    objects = etags()
+
+    encryption_manager = app.encryption_manager
+    monkeypatch.setattr(encryption_manager, "key_version", 2)
+    assert client.portal.call(app.key_rotator.rotate) == 0
+    assert app.key_rotator.rewrapped == 3
+    for name, file_id in file_ids.items():
+        record = app.metadata_store.get(file_id)
+        assert all(key.startswith("2:") for key in wrapped_keys(record))
+        # Only the wrapped keys change, not the stream headers they decrypt
+        assert headers(record) == headers(before[name])
+    # The encrypted objects are never rewritten
+    assert etags() == objects
+
+    # Master key 1 can be retired
+    monkeypatch.delitem(encryption_manager.master_keys, 1)
+    encryption_manager._data_keys.clear()
+    assert client.get(f"/download/{file_ids['file']}").content == data
+    assert client.get(f"/download/{file_ids['text']}").json()["content"] == "hello there"
+    assert client.get(f"/download/{file_ids['bundle']}/b.bin").content == data
+    assert client.get(f"/info/{file_ids['text']}?preview=true").json()["files"][0]["preview"] == "hello there"
+    assert client.portal.call(app.key_rotator.rotate) == 0
+
+
+def test_protected_shares_keep_their_keys(rotating, client, share, app, monkeypatch):
+    file_id = share(text="secret", password="pw")
+    record = app.metadata_store.get(file_id)
+    monkeypatch.setattr(app.encryption_manager, "key_version", 2)
+    assert client.portal.call(app.key_rotator.rotate) == 0
+    assert wrapped_keys(app.metadata_store.get(file_id)) == wrapped_keys(record)
+    assert client.get(f"/download/{file_id}?password=pw").json()["content"] == "secret"
+
+
+def test_changed_records_are_retried(rotating, client, share, app, monkeypatch):
+    file_id = share(text="hello")
+    stale = app.metadata_store.get(file_id)
+    # A download or another worker changes the record after the rotator read it
+    app.metadata_store.put(file_id, {**stale, "changed": True})
+    monkeypatch.setattr(app.metadata_store, "scan", lambda after=None, limit=None: [(file_id, stale)] if after is None else [])
+    monkeypatch.setattr(app.encryption_manager, "key_version", 2)
+
+    assert client.portal.call(app.key_rotator.rotate) == 1
+    assert app.key_rotator.conflicts == 1
+    record = app.metadata_store.get(file_id)
+    assert record["changed"] and all(key.startswith("1:") for key in wrapped_keys(record))
+
+    monkeypatch.undo()
+    monkeypatch.setattr(app.encryption_manager, "key_version", 2)
+    assert client.portal.call(app.key_rotator.rotate) == 0
+    record = app.metadata_store.get(file_id)
+    assert record["changed"] and all(key.startswith("2:") for key in wrapped_keys(record))
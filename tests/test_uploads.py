@@ -0,0 +1,68 @@
+import base64
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from encryption_utils import TAG_SIZE, encrypted_size, parse_stream_header
+
+
+@pytest.fixture
+def s3_only(app, monkeypatch):
+    # Keep every file in S3 rather than inline in its record
+    monkeypatch.setattr(app, "INLINE_MAX_SIZE", 0)
+    return app
+
+
+@pytest.mark.parametrize("size", [0, 1, 1024, 3000])
+def test_round_trip(client, share, s3_only, size):
+    data = os.urandom(size)
+    file_id = share(files=[("files", ("a.bin", data, "application/x-test"))])
+    response = client.get(f"/download/{file_id}")
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["content-type"] == "application/x-test"
+    assert response.headers["content-length"] == str(size)
+
+
+def test_stored_encrypted(client, share, s3_only, s3):
+    data = os.urandom(5000)
+    file_id = share(files=[("files", ("a.bin", data))])
+    record = s3_only.metadata_store.get(file_id)
+    stored = s3.get_object(Bucket=s3_only.s3_manager.bucket_name, Key=record["key"])["Body"].read()
+    header = base64.b64decode(record["header"])
+    assert stored.startswith(header)
+    assert data[:64] not in stored
+    assert len(stored) == encrypted_size(len(data), parse_stream_header(header).chunk_size, len(header))
+
+
+def test_multipart_upload(client, share, s3_only, s3):
+    # Larger than one S3 part, so the stream goes up as a multipart upload
+    data = os.urandom(11 * 1024 * 1024 + 7)
+    file_id = share(files=[("files", ("big.bin", data))])
+    record = s3_only.metadata_store.get(file_id)
+    head = s3.head_object(Bucket=s3_only.s3_manager.bucket_name, Key=record["key"])
+    assert "-" in head["ETag"]
+    assert head["ContentLength"] > len(data) + TAG_SIZE
+    assert client.get(f"/download/{file_id}").content == data
+
+
+def test_text_share(client, share):
+    file_id = share(text="hello world")
+    response = client.get(f"/download/{file_id}")
+    assert response.json()["content"] == "hello world"
+
+
+def test_unknown_expiration_policy(client):
+    response = client.post("/upload/", data={"expiration_policy": "forever", "text_content": "x"})
+    assert response.status_code == 400
+
+
+def test_upload_removed_when_its_record_cannot_be_saved(client, s3_only, stored_keys, monkeypatch):
+    def busy(file_id, expected, record):
+        raise HTTPException(status_code=503, detail="Server is busy, please retry shortly")
+    monkeypatch.setattr(s3_only.metadata_store, "replace", busy)
+    response = client.post("/upload/", data={"expiration_policy": "store_1_hour"},
+                           files=[("files", ("a.bin", os.urandom(3000)))])
+    assert response.status_code == 503
+    assert stored_keys() == []
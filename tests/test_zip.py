@@ -0,0 +1,80 @@
+import io
+import os
+import zipfile
+
+from zip_utils import ZipStreamWriter
+
+
+def build_zip(entries, piece_size: int = 1000) -> bytes:
+    writer = ZipStreamWriter()
+    out = []
+    for filename, data, compress in entries:
+        out.append(writer.start_entry(filename, compress))
+        for offset in range(0, len(data), piece_size):
+            out.append(writer.write(data[offset:offset + piece_size]))
+        out.append(writer.end_entry())
+    out.append(writer.finish())
+    return b"".join(out)
+
+
+def test_archive_opens_with_zipfile():
+    entries = [
+        ("notes.txt", b"hello world\n" * 1000, True),
+        ("photo.jpg", os.urandom(5000), False),
+        ("empty.txt", b"", True),
+        ("dossier/résumé.txt", "ünïcödé".encode(), True),
+    ]
+    archive = zipfile.ZipFile(io.BytesIO(build_zip(entries)))
+    assert archive.testzip() is None
+    assert archive.namelist() == [filename for filename, _, _ in entries]
+    for filename, data, compress in entries:
+        info = archive.getinfo(filename)
+        assert info.compress_type == (zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+        assert info.file_size == len(data)
+        assert archive.read(filename) == data
+
+
+def test_empty_archive():
+    archive = zipfile.ZipFile(io.BytesIO(build_zip([])))
+    assert archive.namelist() == []
+
+
+def test_zip64_entry_count():
+    # More entries than the classic end record can count need the ZIP64 end records
+    count = 0xFFFF + 1
+    archive = zipfile.ZipFile(io.BytesIO(build_zip((f"{i}.txt", b"x", False) for i in range(count))))
+    assert len(archive.infolist()) == count
+    assert archive.read("65535.txt") == b"x"
+
+
+def test_bundle_download(client, share):
+    first, second = os.urandom(5000), b"x" * 5000
+    file_id = share(files=[("files", ("a.bin", first)), ("files", ("b.txt", second))], text="hi")
+    response = client.get(f"/download/{file_id}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.testzip() is None
+    assert archive.read("a.bin") == first
+    assert archive.read("b.txt") == second
+    assert archive.read("shared-text.txt") == b"hi"
+
+
+def test_bundle_member_restored_when_sending_fails(client, share, app, monkeypatch):
+    first, second = os.urandom(5000), os.urandom(5000)
+    file_id = share(files=[("files", ("a.bin", first)), ("files", ("b.bin", second))],
+                    policy="delete_after_first_download")
+    stream_decrypted = app.stream_decrypted
+
+    async def failing(*args, **kwargs):
+        raise RuntimeError("S3 unavailable")
+
+    # The last member taken consumes the bundle, which has to come back too
+    for filename, data in [("a.bin", first), ("b.bin", second)]:
+        monkeypatch.setattr(app, "stream_decrypted", failing)
+        assert client.get(f"/download/{file_id}/{filename}").status_code == 500
+        monkeypatch.setattr(app, "stream_decrypted", stream_decrypted)
+        response = client.get(f"/download/{file_id}/{filename}")
+        assert response.status_code == 200
+        assert response.content == data
+    assert client.get(f"/download/{file_id}").status_code == 404
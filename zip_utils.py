@@ -0,0 +1,176 @@
+import struct
+import time
+import zlib
+from typing import AsyncIterable, AsyncIterator, List, Tuple
+from pool_utils import cpu_pool
+from metrics_utils import timed
+
+# File types that are already compressed; DEFLATE only burns CPU on them
+COMPRESSED_EXTENSIONS = {
+    "jpg", "jpeg", "png", "gif", "webp", "heic", "heif", "avif",
+    "mp4", "m4v", "mov", "mkv", "avi", "webm", "wmv", "flv",
+    "mp3", "m4a", "aac", "ogg", "oga", "opus", "flac", "wma",
+    "zip", "gz", "tgz", "bz2", "xz", "7z", "rar", "zst", "lz4", "br",
+    "jar", "apk", "ipa", "docx", "xlsx", "pptx", "odt", "ods", "odp", "epub",
+    "pdf", "woff", "woff2",
+}
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+# Bit 3: sizes and CRC follow the data in a data descriptor; bit 11: UTF-8 names
+ZIP_FLAGS = 0x0808
+ZIP_VERSION = 45  # 4.5: ZIP64 extensions
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+DATA_DESCRIPTOR = struct.Struct("<IIQQ")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END_OF_CENTRAL_DIRECTORY = struct.Struct("<IHHHHIIH")
+
+
+def should_compress(filename: str) -> bool:
+    """Whether DEFLATE is worth running on a file, judged by its extension."""
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    return extension not in COMPRESSED_EXTENSIONS
+
+
+def _dos_datetime(timestamp: float) -> Tuple[int, int]:
+    t = time.localtime(timestamp)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ZipStreamWriter:
+    """
+    Writes a ZIP archive front to back without seeking or buffering entries.
+    Each entry's CRC and sizes go in a data descriptor after its data, and
+    ZIP64 records are used wherever sizes, offsets or counts need them.
+    """
+
+    def __init__(self):
+        self._offset = 0
+        self._entries: List[dict] = []
+        self._current = None
+        self._compressor = None
+
+    def _emit(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+    def start_entry(self, filename: str, compress: bool = True) -> bytes:
+        """Begin a new entry and return its local file header."""
+        if self._current is not None:
+            raise ValueError("Previous ZIP entry was not ended")
+        dos_time, dos_date = _dos_datetime(time.time())
+        method = ZIP_DEFLATED if compress else ZIP_STORED
+        name = filename.encode("utf-8")
+        # Sizes are unknown up front: mark them as ZIP64 with zeroed values
+        extra = struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+        self._current = {
+            "name": name,
+            "method": method,
+            "time": dos_time,
+            "date": dos_date,
+            "offset": self._offset,
+            "crc": 0,
+            "compressed_size": 0,
+            "size": 0,
+        }
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if compress else None
+        header = LOCAL_HEADER.pack(
+            0x04034b50, ZIP_VERSION, ZIP_FLAGS, method, dos_time, dos_date,
+            0, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra),
+        )
+        return self._emit(header + name + extra)
+
+    def write(self, data: bytes) -> bytes:
+        """Add data to the current entry and return the bytes ready to send."""
+        entry = self._current
+        entry["crc"] = zlib.crc32(data, entry["crc"])
+        entry["size"] += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        entry["compressed_size"] += len(data)
+        return self._emit(data)
+
+    def end_entry(self) -> bytes:
+        """Finish the current entry and return its remaining data and descriptor."""
+        entry = self._current
+        tail = b""
+        if self._compressor is not None:
+            tail = self._compressor.flush()
+            entry["compressed_size"] += len(tail)
+        descriptor = DATA_DESCRIPTOR.pack(0x08074b50, entry["crc"], entry["compressed_size"], entry["size"])
+        self._entries.append(entry)
+        self._current = None
+        self._compressor = None
+        return self._emit(tail + descriptor)
+
+    def finish(self) -> bytes:
+        """Return the central directory and end records that close the archive."""
+        if self._current is not None:
+            raise ValueError("Last ZIP entry was not ended")
+        directory_offset = self._offset
+        records = []
+        for entry in self._entries:
+            extra = b""
+            size, compressed_size, offset = entry["size"], entry["compressed_size"], entry["offset"]
+            # ZIP64 fields appear in this fixed order, only for values that overflow
+            if size >= ZIP64_LIMIT:
+                extra += struct.pack("<Q", size)
+                size = ZIP64_LIMIT
+            if compressed_size >= ZIP64_LIMIT:
+                extra += struct.pack("<Q", compressed_size)
+                compressed_size = ZIP64_LIMIT
+            if offset >= ZIP64_LIMIT:
+                extra += struct.pack("<Q", offset)
+                offset = ZIP64_LIMIT
+            if extra:
+                extra = struct.pack("<HH", 0x0001, len(extra)) + extra
+            records.append(CENTRAL_HEADER.pack(
+                0x02014b50, (3 << 8) | ZIP_VERSION, ZIP_VERSION, ZIP_FLAGS, entry["method"],
+                entry["time"], entry["date"], entry["crc"], compressed_size, size,
+                len(entry["name"]), len(extra), 0, 0, 0, 0o100644 << 16, offset,
+            ) + entry["name"] + extra)
+        directory = self._emit(b"".join(records))
+        directory_size = len(directory)
+
+        count = len(self._entries)
+        end = b""
+        if count >= 0xFFFF or directory_size >= ZIP64_LIMIT or directory_offset >= ZIP64_LIMIT:
+            zip64_end_offset = self._offset
+            end += ZIP64_END.pack(
+                0x06064b50, ZIP64_END.size - 12, ZIP_VERSION, ZIP_VERSION, 0, 0,
+                count, count, directory_size, directory_offset,
+            )
+            end += ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1)
+            count = min(count, 0xFFFF)
+            directory_size = min(directory_size, ZIP64_LIMIT)
+            directory_offset = min(directory_offset, ZIP64_LIMIT)
+        end += END_OF_CENTRAL_DIRECTORY.pack(
+            0x06054b50, 0, 0, count, count, directory_size, directory_offset, 0,
+        )
+        return directory + self._emit(end)
+
+
+async def stream_zip(entries: AsyncIterable[Tuple[str, AsyncIterable[bytes]]]) -> AsyncIterator[bytes]:
+    """
+    Build a ZIP archive from (filename, async pieces) entries as they arrive.
+    Entries with already-compressed file types are stored, not deflated,
+    and compression runs on the CPU pool.
+    """
+    writer = ZipStreamWriter()
+    async for filename, pieces in entries:
+        yield writer.start_entry(filename, should_compress(filename))
+        async for piece in pieces:
+            with timed("zip"):
+                data = await cpu_pool.run(writer.write, piece)
+            if data:
+                yield data
+        with timed("zip"):
+            data = await cpu_pool.run(writer.end_entry)
+        yield data
+    yield writer.finish()